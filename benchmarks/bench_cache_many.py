@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""Measures keys per second read and written through the cache stores, one
+key per call against the `load_many` / `save_many` batch calls.
+
+Redis stores are included when a server answers on localhost:6379, which is
+where batching saves a network round trip per key.
+
+    $ python benchmarks/bench_cache_many.py
+"""
+
+import time
+import timeit
+
+from brubeck.caching import LRUCacheStore, RedisCacheStore
+
+
+KEYS = ['key:%d' % i for i in xrange(1000)]
+VALUE = 'x' * 200
+ROUNDS = 20
+
+
+def run(label, store):
+    expire = time.time() + 600
+    items = [(key, VALUE) for key in KEYS]
+
+    def save_loop():
+        for i in xrange(ROUNDS):
+            for key, value in items:
+                store.save(key, value, expire=expire)
+
+    def save_many():
+        for i in xrange(ROUNDS):
+            store.save_many(items, expire=expire)
+
+    def load_loop():
+        for i in xrange(ROUNDS):
+            [store.load(key) for key in KEYS]
+
+    def load_many():
+        for i in xrange(ROUNDS):
+            store.load_many(KEYS)
+
+    for name, fn in (('save', save_loop), ('save_many', save_many),
+                     ('load', load_loop), ('load_many', load_many)):
+        elapsed = min(timeit.repeat(fn, number=1, repeat=3))
+        print '%-8s %-10s %12.0f keys/s' % (label, name,
+                                            ROUNDS * len(KEYS) / elapsed)
+    store.delete_many(KEYS)
+
+
+def redis_connection():
+    try:
+        import redis
+        connection = redis.StrictRedis(host='localhost', port=6379, db=0)
+        connection.ping()
+    except Exception:
+        return None
+    return connection
+
+
+if __name__ == '__main__':
+    run('lru', LRUCacheStore())
+
+    connection = redis_connection()
+    if connection is None:
+        print 'redis not reachable on localhost:6379, skipping'
+    else:
+        run('redis', RedisCacheStore(connection))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""Compares the memory a million items take in `DictQueryset` with the
+default dictionary per item against `compact=True`, and how long reading
+them back takes. Each layout is built in its own forked process so one
+doesn't inherit the other's heap.
+
+    $ python benchmarks/bench_dict_storage.py
+
+Rows are stored with `_store` directly, in the shape `to_python` produces,
+so only the storage layout is measured.
+"""
+
+import os
+import time
+
+from brubeck.queryset import DictQueryset
+
+
+ITEMS = 1000000
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def resident_bytes():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * PAGE_SIZE
+
+
+def datum(i):
+    return {
+        'id': str(i),
+        'owner_id': 'owner:%d' % (i % 1000),
+        'name': 'item %d' % i,
+        'count': i,
+        'score': i / 7.0,
+        'active': i % 2 == 0,
+    }
+
+
+def measure(compact):
+    queryset = DictQueryset(compact=compact)
+    before = resident_bytes()
+    for i in xrange(ITEMS):
+        queryset._store(str(i), datum(i))
+    used = resident_bytes() - before
+
+    start = time.time()
+    for i in xrange(0, ITEMS, 10):
+        queryset.read_one(i)
+    read_time = time.time() - start
+    return used, read_time
+
+
+def run(compact):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        os.write(write_fd, '%d %f' % measure(compact))
+        os._exit(0)
+    os.close(write_fd)
+    used, read_time = os.read(read_fd, 64).split()
+    os.waitpid(pid, 0)
+    return int(used), float(read_time)
+
+
+if __name__ == '__main__':
+    print 'Storing %d items' % ITEMS
+    for (label, compact) in (('dict', False), ('compact', True)):
+        used, read_time = run(compact)
+        print '  %-8s %7.1f MB  %6.1f bytes/item  %.3fs per %d reads' % (
+            label, used / 1048576.0, used / float(ITEMS), read_time,
+            ITEMS / 10)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""Measures the longest pause a ticking coroutine sees while a large number
+of cache items expire, with `delete_expired` called directly against the
+background expiry sweeper.
+
+    $ python benchmarks/bench_expiry_sweep.py
+"""
+
+import time
+
+import gevent
+
+from brubeck.request_handling import coro_spawn_later
+from brubeck.caching import BaseCacheStore
+
+
+KEYS = 500000
+
+
+def filled_store():
+    store = BaseCacheStore()
+    expire = time.time() + 0.5
+    store.save_many([('key:%d' % i, i) for i in xrange(KEYS)], expire=expire)
+    return store
+
+
+def longest_pause(until_done):
+    """Ticks every millisecond until `until_done()` is true and returns the
+    longest gap seen between ticks.
+    """
+    gaps = [0.0]
+    last = [time.time()]
+
+    def tick():
+        now = time.time()
+        gaps.append(now - last[0])
+        last[0] = now
+        if not until_done():
+            coro_spawn_later(0.001, tick)
+
+    tick()
+    while not until_done():
+        gevent.sleep(0.01)
+    return max(gaps)
+
+
+def run_blocking():
+    store = filled_store()
+    gevent.sleep(0.5)
+    done = []
+    coro_spawn_later(0.01, lambda: (store.delete_expired(), done.append(1)))
+    pause = longest_pause(lambda: done)
+    print '%-16s %8.1f ms longest pause' % ('delete_expired', pause * 1000)
+
+
+def run_sweeper():
+    store = filled_store()
+    gevent.sleep(0.5)
+    started = time.time()
+    store.start_expiry_sweeper(interval=0.01, slice_time=0.002)
+    pause = longest_pause(lambda: not store._cache_store)
+    store.stop_expiry_sweeper()
+    stats = store.sweep_stats
+    print '%-16s %8.1f ms longest pause, %d slices, %.0f keys/s' % (
+        'sweeper', pause * 1000, stats['slices'],
+        stats['reclaimed'] / (time.time() - started))
+
+
+if __name__ == '__main__':
+    run_blocking()
+    run_sweeper()
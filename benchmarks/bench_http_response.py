@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""Measures responses per second rendered by `http_response` for small JSON
+bodies, against the dict interpolation Brubeck used to render with. The two
+take turns for several rounds and each keeps its best round, which keeps a
+noisy machine from favouring either one.
+
+    $ python benchmarks/bench_http_response.py
+"""
+
+import timeit
+
+import ujson as json
+
+from brubeck.request_handling import http_response, HTTP_FORMAT, to_bytes
+
+
+RESPONSES = 50000
+ROUNDS = 15
+
+BODY = json.dumps({'status_code': 200, 'status_msg': 'OK',
+                   'timestamp': 1320456118809,
+                   'data': {'id': 'abc123', 'name': 'brubeck', 'count': 5}})
+
+
+def interpolated_response(body, code, status, headers):
+    """The renderer Brubeck used before bodies were encoded once.
+    """
+    payload = {'code': code, 'status': status, 'body': body}
+    content_length = 0
+    if body is not None:
+        content_length = len(to_bytes(body))
+
+    headers['Content-Length'] = content_length
+    payload['headers'] = "\r\n".join('%s: %s' % (k, v)
+                                     for k, v in headers.items())
+
+    return HTTP_FORMAT % payload
+
+
+def best_rate(renderer):
+    def render():
+        for i in xrange(RESPONSES):
+            renderer(BODY, 200, 'OK', {'Content-Type': 'application/json'})
+    return RESPONSES / timeit.timeit(render, number=1)
+
+
+if __name__ == '__main__':
+    renderers = (('interpolated', interpolated_response),
+                 ('http_response', http_response))
+    best = dict((label, 0.0) for (label, renderer) in renderers)
+    for i in xrange(ROUNDS):
+        for (label, renderer) in renderers:
+            best[label] = max(best[label], best_rate(renderer))
+    for (label, renderer) in renderers:
+        print '%-14s %10.0f responses/s' % (label, best[label])
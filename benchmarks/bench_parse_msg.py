@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""Compares the split-based Mongrel2 message parsing Brubeck used to do with
+the offset-based `Request.parse_msg`, for bodies of 1 KB, 1 MB and 50 MB.
+
+Only parsing is measured. The body is never read, which is the case for
+handlers that don't look at it, or that read it through `Request.body_view`.
+
+    $ python benchmarks/bench_parse_msg.py
+"""
+
+import json
+import timeit
+
+from brubeck.request import Request, parse_netstring
+
+
+HEADERS = json.dumps({
+    'PATH': '/upload', 'METHOD': 'POST', 'VERSION': 'HTTP/1.1',
+    'host': '127.0.0.1:6767', 'x-forwarded-for': '127.0.0.1',
+    'content-type': 'application/octet-stream', 'URI': '/upload',
+})
+
+
+def build_msg(body_size):
+    body = 'x' * body_size
+    return '34f9ceee-cd52-4b7f-b197-88bf2f0ec378 5 /upload %d:%s,%d:%s,' % (
+        len(HEADERS), HEADERS, len(body), body)
+
+
+def split_parse(msg):
+    """The parser Brubeck used before parsing by offset.
+    """
+    sender, conn_id, path, rest = msg.split(' ', 3)
+    headers, rest = parse_netstring(rest)
+    body, _ = parse_netstring(rest)
+    headers = json.loads(headers)
+    return sender, conn_id, headers, body
+
+
+def run(label, body_size, number):
+    msg = build_msg(body_size)
+    split_time = min(timeit.repeat(lambda: split_parse(msg),
+                                   number=number, repeat=3))
+    view_time = min(timeit.repeat(lambda: Request.parse_msg(msg),
+                                  number=number, repeat=3))
+    print '%6s body  split: %10.1f us/msg  offsets: %8.1f us/msg' % (
+        label, split_time / number * 1e6, view_time / number * 1e6)
+
+
+if __name__ == '__main__':
+    run('1 KB', 1024, 2000)
+    run('1 MB', 1024 * 1024, 200)
+    run('50 MB', 50 * 1024 * 1024, 5)
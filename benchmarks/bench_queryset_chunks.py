@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""Measures RedisQueryset batch throughput and peak memory across batch
+sizes for a few pipeline chunk sizes. Needs a Redis server on
+localhost:6379 and uses database 15, which it flushes.
+
+    $ python benchmarks/bench_queryset_chunks.py
+"""
+
+import time
+import resource
+
+from dictshield.document import Document
+from dictshield.fields import StringField
+
+from brubeck.queryset import RedisQueryset
+
+
+BATCH_SIZES = (1000, 10000, 100000)
+CHUNK_SIZES = (100, 1000, 1000000)
+
+
+class Item(Document):
+    data = StringField()
+
+    class Meta:
+        id_field = StringField
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(connection, batch_size, chunk_size):
+    queryset = RedisQueryset(db_conn=connection, chunk_size=chunk_size)
+    items = (Item(id=str(i), data='x' * 100) for i in xrange(batch_size))
+
+    started = time.time()
+    for result in queryset.iter_create_many(items):
+        pass
+    for result in queryset.iter_destroy_many(str(i)
+                                             for i in xrange(batch_size)):
+        pass
+    elapsed = time.time() - started
+
+    print '%8d items  chunk %8d  %10.0f items/s  peak rss %7.1f MB' % (
+        batch_size, chunk_size, 2 * batch_size / elapsed, peak_rss_mb())
+
+
+def redis_connection():
+    try:
+        import redis
+        connection = redis.StrictRedis(host='localhost', port=6379, db=15)
+        connection.ping()
+    except Exception:
+        return None
+    return connection
+
+
+if __name__ == '__main__':
+    connection = redis_connection()
+    if connection is None:
+        print 'redis not reachable on localhost:6379, skipping'
+    else:
+        connection.flushdb()
+        ### Peak RSS only grows, so the biggest chunks run last
+        for chunk_size in CHUNK_SIZES:
+            for batch_size in BATCH_SIZES:
+                run(connection, batch_size, chunk_size)
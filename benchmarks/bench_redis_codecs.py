@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""Compares RedisQueryset value codecs: stored size and decode throughput
+for each codec, including the double zlib decompression `_readvalue` used
+to do, then `read_many` throughput against a Redis server on
+localhost:6379 if one is reachable. Uses database 15, which it flushes.
+
+    $ python benchmarks/bench_redis_codecs.py
+"""
+
+import time
+import zlib
+
+import ujson as json
+
+from dictshield.document import Document
+from dictshield.fields import StringField, IntField
+
+from brubeck.queryset import RedisQueryset
+
+
+ITEMS = 20000
+READ_BATCH = 1000
+
+
+class Item(Document):
+    owner = StringField()
+    text = StringField()
+    count = IntField()
+
+    class Meta:
+        id_field = StringField
+
+
+def items():
+    return [Item(id=str(i), owner='owner:%d' % (i % 100), count=i,
+                 text=' '.join(['word%d' % (i % 37)] * 60))
+            for i in xrange(ITEMS)]
+
+
+def configurations():
+    yield ('json', RedisQueryset)
+    for codec in sorted(RedisQueryset.CODECS):
+        yield (codec, lambda codec=codec, **kw: RedisQueryset(
+            compress=True, codec=codec, **kw))
+
+
+def double_zlib_readvalue(value):
+    """How `_readvalue` decoded compressed values before codecs.
+    """
+    compressed_value = zlib.decompress(value)
+    return json.loads(zlib.decompress(value))
+
+
+def run_decode(shields):
+    print 'Decoding %d values' % ITEMS
+    for (label, make) in configurations():
+        queryset = make()
+        values = [queryset._setvalue(shield) for shield in shields]
+        size = sum(len(value) for value in values) / float(ITEMS)
+
+        started = time.time()
+        for value in values:
+            queryset._readvalue(value)
+        elapsed = time.time() - started
+        print '  %-12s %7.0f bytes/value  %9.0f values/s' % (
+            label, size, ITEMS / elapsed)
+
+    values = [zlib.compress(shield.to_json(), 1) for shield in shields]
+    started = time.time()
+    for value in values:
+        double_zlib_readvalue(value)
+    print '  %-12s %7s                %9.0f values/s' % (
+        'zlib, twice', '', ITEMS / (time.time() - started))
+
+
+def run_read_many(connection, shields):
+    print 'read_many in batches of %d' % READ_BATCH
+    ids = [str(i) for i in xrange(ITEMS)]
+    for (label, make) in configurations():
+        connection.flushdb()
+        queryset = make(db_conn=connection)
+        queryset.create_many(shields)
+
+        started = time.time()
+        for start in xrange(0, ITEMS, READ_BATCH):
+            queryset.read_many(ids[start:start + READ_BATCH])
+        elapsed = time.time() - started
+        used = connection.info('memory')['used_memory'] / 1048576.0
+        print '  %-12s %9.0f items/s  redis memory %6.1f MB' % (
+            label, ITEMS / elapsed, used)
+    connection.flushdb()
+
+
+def redis_connection():
+    try:
+        import redis
+        connection = redis.StrictRedis(host='localhost', port=6379, db=15)
+        connection.ping()
+    except Exception:
+        return None
+    return connection
+
+
+if __name__ == '__main__':
+    shields = items()
+    run_decode(shields)
+
+    connection = redis_connection()
+    if connection is None:
+        print 'redis not reachable on localhost:6379, skipping read_many'
+    else:
+        run_read_many(connection, shields)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""Compares the linear regex scan Brubeck used for routing against the route
+trie, for routing tables of 10, 100 and 1000 routes.
+
+Each table looks like a typical API: `/resource<N>/<id>` routes followed by a
+catch-all. Paths are drawn from the whole table so late routes are measured
+as often as early ones.
+
+    $ python benchmarks/bench_routing.py
+"""
+
+import re
+import random
+import timeit
+
+from brubeck.routing import RouteTrie
+
+
+LOOKUPS = 10000
+
+
+def build_routes(count):
+    patterns = [r'^/resource%d/(?P<ids>[-\w\d,]+)$' % i for i in range(count)]
+    patterns.append(r'^/(?P<path>.*)$')
+    return [re.compile(p, re.UNICODE) for p in patterns]
+
+
+def list_scan(routes, path):
+    for regex in routes:
+        url_check = regex.match(path)
+        if url_check:
+            return url_check
+
+
+def trie_scan(routes, trie, path):
+    for index in trie.candidates(path):
+        url_check = routes[index].match(path)
+        if url_check:
+            return url_check
+
+
+def run(count):
+    routes = build_routes(count)
+    trie = RouteTrie()
+    for index, regex in enumerate(routes):
+        trie.add(index, regex)
+
+    paths = ['/resource%d/%d' % (random.randrange(count), i)
+             for i in range(LOOKUPS)]
+
+    def scan():
+        for path in paths:
+            list_scan(routes, path)
+
+    def lookup():
+        for path in paths:
+            trie_scan(routes, trie, path)
+
+    scan_time = min(timeit.repeat(scan, number=1, repeat=3))
+    trie_time = min(timeit.repeat(lookup, number=1, repeat=3))
+    print '%5d routes  list scan: %8.1f us/lookup  trie: %6.1f us/lookup' % (
+        count, scan_time / LOOKUPS * 1e6, trie_time / LOOKUPS * 1e6)
+
+
+if __name__ == '__main__':
+    for count in (10, 100, 1000):
+        run(count)
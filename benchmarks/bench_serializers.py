@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""Measures the size of a few typical cache values under each serializer
+backend, with and without compression, and the time taken to encode and
+decode them.
+
+    $ python benchmarks/bench_serializers.py
+"""
+
+import timeit
+
+from brubeck.caching import Serializer
+
+
+ROUNDS = 2000
+
+SESSION = {
+    'user_id': 'a3f1c2d4e5b6',
+    'username': 'brubeck',
+    'roles': ['admin', 'editor'],
+    'last_seen': 1320456118809,
+    'flash': None,
+}
+
+LISTING = [{'id': i, 'name': 'item %d' % i, 'price': i * 1.5,
+            'tags': ['new', 'sale'], 'description': 'An ordinary item ' * 4}
+           for i in xrange(50)]
+
+
+def run(label, value, serializer):
+    data = serializer.dumps(value)
+    encode = min(timeit.repeat(lambda: serializer.dumps(value),
+                               number=ROUNDS, repeat=3))
+    decode = min(timeit.repeat(lambda: serializer.loads(data),
+                               number=ROUNDS, repeat=3))
+    print '%-8s %-22s %8d bytes %9.1f us/encode %9.1f us/decode' % (
+        label, name(serializer), len(data),
+        encode / ROUNDS * 1e6, decode / ROUNDS * 1e6)
+
+
+def name(serializer):
+    if serializer.compress_threshold is None:
+        return serializer.backend
+    return '%s+%s' % (serializer.backend, serializer.compression)
+
+
+if __name__ == '__main__':
+    serializers = list()
+    for backend in sorted(Serializer.BACKENDS):
+        serializers.append(Serializer(backend))
+        for compression in sorted(Serializer.COMPRESSORS):
+            serializers.append(Serializer(backend, compress_threshold=512,
+                                          compression=compression))
+
+    for (label, value) in (('session', SESSION), ('listing', LISTING)):
+        for serializer in serializers:
+            run(label, value, serializer)
+        print
@@ -10,7 +10,10 @@ __all__ = ['auth',
            'datamosh',
            'models',
            'mongrel2',
+           'multipart',
            'queryset',
            'request_handling',
+           'routing',
            'templating',
-           'timekeeping']
+           'timekeeping',
+           'workers']
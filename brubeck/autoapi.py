@@ -1,10 +1,11 @@
 from request_handling import JSONMessageHandler, FourOhFourException
+from datamosh import StreamedHandlerMixin
 from schematics.serialize import to_json, make_safe_json
 
 import ujson as json
 
 
-class AutoAPIBase(JSONMessageHandler):
+class AutoAPIBase(JSONMessageHandler, StreamedHandlerMixin):
     """AutoAPIBase generates a JSON REST API for you. *high five!*
     I also read this link for help in propertly defining the behavior of HTTP
     PUT and POST: http://stackoverflow.com/questions/630453/put-vs-post-in-rest
@@ -13,7 +14,14 @@ class AutoAPIBase(JSONMessageHandler):
     model = None
     queries = None
 
+    # Polling clients get an ETag and a 304 while the data is unchanged
+    auto_etag = True
+
     _PAYLOAD_DATA = 'data'
+    _PAYLOAD_CURSOR = 'next_cursor'
+
+    _PAGE_COUNT = 25
+    _MAX_PAGE_COUNT = 100
 
     ###
     ### Input Handling
@@ -196,6 +204,22 @@ class AutoAPIBase(JSONMessageHandler):
             ### Return full HTTP response
             return self.render(status_code=http_status_code)
 
+    def _get_page(self):
+        """Reads a page of items from the queryset, as described by the
+        paging arguments, and renders it with the cursor for the next page.
+        A cursor the queryset can't read is a 400.
+        """
+        (page, count, skip) = self.get_paging_arguments(
+            default_count=self._PAGE_COUNT, max_count=self._MAX_PAGE_COUNT)
+        count = max(count, 1)
+        cursor = self.get_argument('cursor', None)
+        try:
+            (next_cursor, items) = self.queries.read_page(cursor, count)
+        except ValueError:
+            return self.render(status_code=self._FAILED_CODE)
+        self.add_to_payload(self._PAYLOAD_CURSOR, next_cursor)
+        return self._generate_response(items)
+
     ###
     ### Validation
     ###
@@ -234,8 +258,9 @@ class AutoAPIBase(JSONMessageHandler):
         """HTTP GET implementation.
 
         IDs:
-          * 0 IDs: produces a list of items presented. Paging will be available
-            soon.
+          * 0 IDs: produces a page of the items presented. The `count`
+            argument sets the page size and `cursor` continues from the
+            `next_cursor` of the previous page, which is null on the last one.
           * 1 ID: This produces the corresponding document.
           * N IDs: This produces a list of corresponding documents.
 
@@ -244,6 +269,9 @@ class AutoAPIBase(JSONMessageHandler):
         
         try:
             ### Setup environment
+            if not ids:
+                return self._get_page()
+
             is_list = isinstance(ids, list)
             
             # Convert arguments
@@ -1,7 +1,35 @@
 import os
+import sys
 import time
+import zlib
+import heapq
+import marshal
+import inspect
+import logging
+import urllib
+import urlparse
+import functools
+import cPickle as pickle
+from collections import OrderedDict
 from exceptions import NotImplementedError
 
+import ujson as json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 ###
 ### Sessions are basically caches
@@ -13,6 +41,116 @@ def generate_session_id():
     return os.urandom(32).encode('hex')
 
 
+###
+### Compression
+###
+
+### Compressed values start with one of these bytes, naming their codec
+ZLIB = '\x01'
+LZ4 = '\x02'
+ZSTD = '\x03'
+
+
+def _lz4_compress(data, level):
+    return lz4_block.compress(data)
+
+
+def _zstd_compress(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+### name => (tag, compress(data, level), decompress(data)). lz4 and zstd are
+### only available if their packages are installed.
+CODECS = {
+    'zlib': (ZLIB, zlib.compress, zlib.decompress),
+}
+if lz4_block is not None:
+    CODECS['lz4'] = (LZ4, _lz4_compress, lz4_block.decompress)
+if zstandard is not None:
+    CODECS['zstd'] = (ZSTD, _zstd_compress, _zstd_decompress)
+
+
+###
+### Serialization
+###
+
+def _msgpack_dumps(value):
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+class Serializer(object):
+    """Turns cache values into strings for a store and back again.
+
+    `backend` is one of 'pickle', 'marshal', 'ujson' or 'msgpack', the last
+    only if msgpack is installed. Serialized values of `compress_threshold`
+    bytes or more are compressed with `compression` at `compress_level`,
+    using one of the `CODECS`: 'zlib', or 'lz4' or 'zstd' if those packages
+    are installed.
+
+    Every string starts with a byte naming its compression, so values stored
+    under a different threshold or compression can still be loaded.
+    """
+    RAW = '\x00'
+    ZLIB = ZLIB
+    LZ4 = LZ4
+    ZSTD = ZSTD
+
+    BACKENDS = {
+        'pickle': (lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                   pickle.loads),
+        'marshal': (marshal.dumps, marshal.loads),
+        'ujson': (json.dumps, json.loads),
+    }
+    if msgpack is not None:
+        BACKENDS['msgpack'] = (_msgpack_dumps, _msgpack_loads)
+
+    COMPRESSORS = CODECS
+
+    def __init__(self, backend='pickle', compress_threshold=None,
+                 compression='zlib', compress_level=6):
+        if backend not in self.BACKENDS:
+            raise ValueError('Unavailable serializer backend: %s' % backend)
+        if compress_threshold is not None and (
+                compression not in self.COMPRESSORS):
+            raise ValueError('Unavailable compression: %s' % compression)
+
+        self.backend = backend
+        (self._dumps, self._loads) = self.BACKENDS[backend]
+        self.compress_threshold = compress_threshold
+        self.compression = compression
+        self.compress_level = compress_level
+        self._decompressors = dict((tag, decompress) for (tag, _, decompress)
+                                   in self.COMPRESSORS.values())
+
+    def dumps(self, value):
+        data = self._dumps(value)
+        threshold = self.compress_threshold
+        if threshold is not None and len(data) >= threshold:
+            (tag, compress, _) = self.COMPRESSORS[self.compression]
+            compressed = compress(data, self.compress_level)
+            ### Incompressible data is kept as it is
+            if len(compressed) < len(data):
+                return tag + compressed
+        return self.RAW + data
+
+    def loads(self, data):
+        tag = data[:1]
+        if tag == self.RAW:
+            return self._loads(data[1:])
+        decompress = self._decompressors.get(tag)
+        if decompress is None:
+            raise ValueError('Unknown serialization header: %r' % tag)
+        return self._loads(decompress(buffer(data, 1)))
+
+
 ###
 ### Cache storage
 ###
@@ -20,10 +158,40 @@ def generate_session_id():
 class BaseCacheStore(object):
     """Ram based cache storage. Essentially uses a dictionary stored in
     the app to store cache id => serialized cache data
+
+    Values are stored as given unless a `Serializer` is passed as
+    `serializer`, which every store subclass accepts too.
+
+    Expiration times are kept in a heap, so expired items can be found
+    without scanning the whole cache. Entries left behind by keys that were
+    saved again or deleted are cleared out a step at a time once they
+    outnumber the items. `expirations` counts items deleted because they
+    expired.
     """
-    def __init__(self, **kwargs):
+    SWEEP_CHECK_EVERY = 32  # heap pops between clock checks while sweeping
+    COMPACT_STEP = 1024  # heap entries compacted per call without a deadline
+
+    def __init__(self, serializer=None, **kwargs):
         super(BaseCacheStore, self).__init__(**kwargs)
         self._cache_store = dict()
+        self._expiry_heap = list()
+        self._compact_source = None  # heap being compacted into _expiry_heap
+        self._compact_position = 0
+        self.serializer = serializer
+        self.expirations = 0
+        self._sweeping = False
+
+    def _encode(self, data):
+        """Serializes `data` if the store has a `serializer`.
+        """
+        if self.serializer is None:
+            return data
+        return self.serializer.dumps(data)
+
+    def _decode(self, data):
+        if self.serializer is None or data is None:
+            return data
+        return self.serializer.loads(data)
 
     def save(self, key, data, expire=None):
         """Save the cache data and metadata to the backend storage
@@ -31,10 +199,11 @@ class BaseCacheStore(object):
         save set dirty to False.
         """
         cache_item = {
-            'data': data,
+            'data': self._encode(data),
             'expire': expire,
         }
         self._cache_store[key] = cache_item
+        self._schedule_expiry(key, expire)
 
     def load(self, key):
         """Load the stored data from storage backend or return None if the
@@ -46,7 +215,7 @@ class BaseCacheStore(object):
 
                 # It's an in memory cache, so we must manage
                 if not data.get('expire', None) or data['expire'] > time.time():
-                    return data['data']
+                    return self._decode(data['data'])
             return None
         except:
             return None
@@ -58,13 +227,300 @@ class BaseCacheStore(object):
             del self._cache_store[key]
 
     def delete_expired(self):
-        """Deletes sessions with timestamps in the past from storage.
+        """Deletes sessions with timestamps in the past from storage. Only
+        items due to expire are looked at.
+        """
+        self._expire_due(time.time())
+
+    def _schedule_expiry(self, key, expire):
+        if expire:
+            heapq.heappush(self._expiry_heap, (expire, key))
+
+    def _expire_due(self, now, deadline=None):
+        """Deletes items that expired by `now`, stopping early if the clock
+        passes `deadline`. Returns the number of items deleted and whether
+        any expired items are left.
+        """
+        heap = self._expiry_heap
+        deleted = 0
+        popped = 0
+        while heap and heap[0][0] <= now:
+            popped += 1
+            if (deadline is not None and
+                    popped % self.SWEEP_CHECK_EVERY == 0 and
+                    time.time() > deadline):
+                break
+            (expire, key) = heapq.heappop(heap)
+            item = self._cache_store.get(key)
+            ### Entries for keys that were deleted or saved again are stale
+            if item is not None and item['expire'] == expire:
+                self.delete(key)
+                deleted += 1
+        self.expirations += deleted
+
+        ### Keep stale entries from piling up in the heap
+        if (self._compact_source is None and
+                len(heap) > 2 * len(self._cache_store) + 64):
+            self._compact_source = heap
+            self._compact_position = 0
+            self._expiry_heap = list()
+        if self._compact_source is not None:
+            self._compact_expiry_heap(deadline)
+
+        heap = self._expiry_heap
+        remaining = (self._compact_source is not None or
+                     (bool(heap) and heap[0][0] <= now))
+        return (deleted, remaining)
+
+    def _compact_expiry_heap(self, deadline=None):
+        """Moves the live entries of `_compact_source` into the new heap,
+        until the clock passes `deadline` or, without one, `COMPACT_STEP`
+        entries have been looked at. Items in the part not yet moved expire
+        once it is, and are treated as missing by loads until then.
+        """
+        source = self._compact_source
+        heap = self._expiry_heap
+        position = self._compact_position
+        end = len(source)
+        if deadline is None:
+            end = min(end, position + self.COMPACT_STEP)
+        while position < end:
+            if (deadline is not None and
+                    position % self.SWEEP_CHECK_EVERY == 0 and
+                    time.time() > deadline):
+                break
+            entry = source[position]
+            ### Stale entries are freed as we go rather than all at the end
+            source[position] = None
+            position += 1
+            item = self._cache_store.get(entry[1])
+            if item is not None and item['expire'] == entry[0]:
+                heapq.heappush(heap, entry)
+
+        if position >= len(source):
+            self._compact_source = None
+            self._compact_position = 0
+        else:
+            self._compact_position = position
+
+    ###
+    ### Background expiry
+    ###
+
+    def start_expiry_sweeper(self, interval=1.0, slice_time=0.002):
+        """Deletes expired items from a coroutine every `interval` seconds.
+
+        Each sweep works in slices of about `slice_time` seconds and yields
+        to other coroutines between slices, so a large number of items
+        expiring together never blocks the process for long. Progress is
+        reported in `sweep_stats`.
         """
-        del_keys = list()
-        for key, data in self._cache_store.items():
-            if data.get('expire', None) and data['expire'] < time.time():
-                del_keys.append(key)
-        map(self.delete, del_keys)
+        from request_handling import coro_spawn_later
+
+        self._sweeping = True
+        self._sweep_started = time.time()
+        self._sweep_counters = {
+            'sweeps': 0,
+            'slices': 0,
+            'reclaimed': 0,
+            'last_sweep_duration': 0.0,
+            'last_sweep_reclaimed': 0,
+        }
+
+        def sweep(started, reclaimed):
+            if not self._sweeping:
+                return
+            now = time.time()
+            (deleted, remaining) = self._expire_due(now, now + slice_time)
+            counters = self._sweep_counters
+            counters['slices'] += 1
+            counters['reclaimed'] += deleted
+            reclaimed += deleted
+            if remaining:
+                coro_spawn_later(0, sweep, started, reclaimed)
+                return
+            counters['sweeps'] += 1
+            counters['last_sweep_duration'] = time.time() - started
+            counters['last_sweep_reclaimed'] = reclaimed
+            coro_spawn_later(interval, start_sweep)
+
+        def start_sweep():
+            sweep(time.time(), 0)
+
+        return coro_spawn_later(interval, start_sweep)
+
+    def stop_expiry_sweeper(self):
+        """Stops the sweeper after its current slice.
+        """
+        self._sweeping = False
+
+    @property
+    def sweep_stats(self):
+        """Counters for the expiry sweeper, including how long the last
+        sweep took from first to last slice and the keys reclaimed per
+        second since the sweeper started.
+        """
+        if not hasattr(self, '_sweep_counters'):
+            return None
+        stats = dict(self._sweep_counters)
+        elapsed = time.time() - self._sweep_started
+        stats['keys_per_second'] = 0.0
+        if elapsed > 0:
+            stats['keys_per_second'] = stats['reclaimed'] / elapsed
+        return stats
+
+    ### Multi-key operations
+
+    def save_many(self, items, expire=None):
+        """Saves every key-value pair in `items`, a dict or a list of
+        two-tuples, with the same expiration time.
+        """
+        if isinstance(items, dict):
+            items = items.iteritems()
+        for key, data in items:
+            self._cache_store[key] = {
+                'data': self._encode(data),
+                'expire': expire,
+            }
+            self._schedule_expiry(key, expire)
+
+    def load_many(self, keys):
+        """Returns a list with the data stored for each key in `keys`, in the
+        same order. Missing or expired keys are None.
+        """
+        now = time.time()
+        results = list()
+        for key in keys:
+            item = self._cache_store.get(key)
+            if item is None or (item['expire'] and item['expire'] <= now):
+                results.append(None)
+            else:
+                results.append(self._decode(item['data']))
+        return results
+
+    def delete_many(self, keys):
+        """Removes all data for every key in `keys`.
+        """
+        for key in keys:
+            self._cache_store.pop(key, None)
+
+
+###
+### Bounded memory cache store
+###
+
+class LRUCacheStore(BaseCacheStore):
+    """Ram based cache storage with a bounded size. Once either `max_entries`
+    items or `max_bytes` worth of data are stored, the least recently used
+    items are evicted to make room.
+
+    Expired items are removed as a side effect of `save` and `load`, unless
+    the expiry sweeper is running.
+
+    `hits`, `misses`, `evictions` and `expirations` count cache activity.
+    """
+    def __init__(self, max_entries=10000, max_bytes=None, sizeof=None,
+                 **kwargs):
+        super(LRUCacheStore, self).__init__(**kwargs)
+        self._cache_store = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or self._sizeof
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _sizeof(data):
+        if isinstance(data, basestring):
+            return len(data)
+        return sys.getsizeof(data)
+
+    def save(self, key, data, expire=None):
+        self._expire_inline()
+        self._store(key, data, expire)
+        self._evict()
+
+    def load(self, key):
+        self._expire_inline()
+        return self._fetch(key)
+
+    def delete(self, key):
+        item = self._cache_store.pop(key, None)
+        if item is not None:
+            self.total_bytes -= item['size']
+
+    def save_many(self, items, expire=None):
+        self._expire_inline()
+        if isinstance(items, dict):
+            items = items.iteritems()
+        for key, data in items:
+            self._store(key, data, expire)
+        self._evict()
+
+    def load_many(self, keys):
+        self._expire_inline()
+        return [self._fetch(key) for key in keys]
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def _store(self, key, data, expire):
+        self.delete(key)
+        data = self._encode(data)
+        size = self.sizeof(data)
+        self._cache_store[key] = {
+            'data': data,
+            'expire': expire,
+            'size': size,
+        }
+        self.total_bytes += size
+        self._schedule_expiry(key, expire)
+
+    def _fetch(self, key):
+        try:
+            item = self._cache_store.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        ### Items can outlive their expiration until the sweeper gets to them
+        if item['expire'] and item['expire'] <= time.time():
+            self.total_bytes -= item['size']
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._cache_store[key] = item  # now the most recently used
+        self.hits += 1
+        return self._decode(item['data'])
+
+    def _expire_inline(self):
+        if not self._sweeping:
+            self.delete_expired()
+
+    def _evict(self):
+        while self._cache_store and (
+                (self.max_entries and
+                 len(self._cache_store) > self.max_entries) or
+                (self.max_bytes and self.total_bytes > self.max_bytes)):
+            (key, item) = self._cache_store.popitem(last=False)
+            self.total_bytes -= item['size']
+            self.evictions += 1
+
+    @property
+    def stats(self):
+        return {
+            'entries': len(self._cache_store),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
 
 ###
 ### Redis Cache Store
@@ -99,7 +555,7 @@ class RedisCacheStore(BaseCacheStore):
         a value in seconds."""
 
         pipe = self._cache_store.pipeline()
-        pipe.set(key, data)
+        pipe.set(key, self._encode(data))
         if expire:
             expire_seconds = expire - time.time()
             assert(expire_seconds > 0)
@@ -111,10 +567,506 @@ class RedisCacheStore(BaseCacheStore):
         does not exist or has expired, `hget` will
         return None"""
 
-        return self._cache_store.get(key)
+        return self._decode(self._cache_store.get(key))
     
     def delete(self, key):
         self._cache_store.delete(key)
         
     def delete_expired(self):
         raise NotImplementedError
+
+    def save_many(self, items, expire=None):
+        """Sets every key in one pipeline, with an EXPIRE for each key if
+        `expire` is given.
+        """
+        if isinstance(items, dict):
+            items = items.iteritems()
+        self._set_encoded([(key, self._encode(data)) for key, data in items],
+                          expire)
+
+    def _set_encoded(self, items, expire):
+        if expire:
+            expire_seconds = expire - time.time()
+            assert(expire_seconds > 0)
+
+        pipe = self._cache_store.pipeline()
+        for key, data in items:
+            pipe.set(key, data)
+            if expire:
+                pipe.expire(key, int(expire_seconds))
+        pipe.execute()
+
+    def load_many(self, keys):
+        """Fetches every key with a single MGET.
+        """
+        if not keys:
+            return list()
+        values = self._cache_store.mget(keys)
+        if self.serializer is None:
+            return values
+        return [self._decode(data) for data in values]
+
+    def delete_many(self, keys):
+        if keys:
+            self._cache_store.delete(*keys)
+
+
+###
+### Two-tier cache store
+###
+
+###
+### Cross process invalidation
+###
+
+class InvalidationChannel(object):
+    """Tells other processes which keys this one changed, over a Redis
+    pub/sub `channel`. Messages are '<sender_id> <key>', and once
+    `start_listener()` is running, `on_invalidate(key)` is called for every
+    key published by another process.
+
+    With `channel` set to None nothing is published.
+    """
+    def __init__(self, redis_connection, channel, on_invalidate):
+        if channel:
+            for method in ('publish', 'pipeline', 'pubsub'):
+                if not callable(getattr(redis_connection, method, None)):
+                    raise ValueError('Invalidation channel %s needs a Redis '
+                                     'connection, got %r' % (
+                                         channel, redis_connection))
+        self.redis_connection = redis_connection
+        self.channel = channel
+        self.on_invalidate = on_invalidate
+        self.sender_id = generate_session_id()
+
+    def publish(self, keys):
+        if not self.channel or not keys:
+            return
+        messages = ['%s %s' % (self.sender_id, key) for key in keys]
+        if len(messages) == 1:
+            self.redis_connection.publish(self.channel, messages[0])
+        else:
+            pipe = self.redis_connection.pipeline()
+            for message in messages:
+                pipe.publish(self.channel, message)
+            pipe.execute()
+
+    def receive(self, message):
+        """Applies an invalidation message, unless this process sent it.
+        """
+        (sender_id, _, key) = message.partition(' ')
+        if sender_id != self.sender_id:
+            self.on_invalidate(key)
+
+    def start_listener(self):
+        """Subscribes to the channel in a coroutine that applies
+        invalidations for as long as the process runs.
+        """
+        from request_handling import coro_spawn_later
+
+        pubsub = self.redis_connection.pubsub()
+        pubsub.subscribe(self.channel)
+
+        def listen():
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    self.receive(message['data'])
+
+        return coro_spawn_later(0, listen)
+
+
+class TieredCacheStore(RedisCacheStore):
+    """Redis cache with a small `LRUCacheStore` in front of it, so repeated
+    loads of the same key are served from process memory.
+
+    Items loaded from Redis are kept locally until their Redis TTL runs out,
+    or for `local_ttl` seconds if that is sooner. Set `local_ttl` to bound how
+    stale a local copy can get when other processes write the same keys.
+
+    The local cache holds values as they are stored in Redis, encoded by
+    the store's `serializer`, and decodes them on every load, so changing a
+    loaded or saved object doesn't change the cached value.
+
+    If `invalidation_channel` is set, saves and deletes are published on that
+    Redis channel and `start_invalidation_listener()` drops keys changed by
+    other processes from the local cache.
+    """
+    def __init__(self, redis_connection=None, max_entries=1000,
+                 max_bytes=None, local_ttl=None, invalidation_channel=None,
+                 **kwargs):
+        super(TieredCacheStore, self).__init__(
+            redis_connection=redis_connection, **kwargs)
+        self.near_cache = LRUCacheStore(max_entries=max_entries,
+                                        max_bytes=max_bytes)
+        self.local_ttl = local_ttl
+        self.invalidation_channel = invalidation_channel
+        self._invalidation = InvalidationChannel(
+            self._cache_store, invalidation_channel, self.near_cache.delete)
+        self.sender_id = self._invalidation.sender_id
+
+    def _local_expire(self, expire):
+        if self.local_ttl:
+            local_expire = time.time() + self.local_ttl
+            if not expire or local_expire < expire:
+                return local_expire
+        return expire
+
+    def save(self, key, data, expire=None):
+        self.save_many([(key, data)], expire=expire)
+
+    def load(self, key):
+        data = self.near_cache.load(key)
+        if data is not None:
+            return self._decode(data)
+
+        pipe = self._cache_store.pipeline()
+        pipe.get(key)
+        pipe.ttl(key)
+        (data, ttl) = pipe.execute()
+        self._keep_local(key, data, ttl)
+        return self._decode(data)
+
+    def delete(self, key):
+        super(TieredCacheStore, self).delete(key)
+        self.near_cache.delete(key)
+        self._publish(key)
+
+    def save_many(self, items, expire=None):
+        if isinstance(items, dict):
+            items = items.iteritems()
+        items = [(key, self._encode(data)) for key, data in items]
+        self._set_encoded(items, expire)
+        self.near_cache.save_many(items, expire=self._local_expire(expire))
+        self._publish(*[key for key, data in items])
+
+    def load_many(self, keys):
+        """Loads what it can from the local cache, then fetches the rest,
+        with their TTLs, in a single pipeline.
+        """
+        results = self.near_cache.load_many(keys)
+        missing = [i for i, data in enumerate(results) if data is None]
+
+        if missing:
+            pipe = self._cache_store.pipeline()
+            for i in missing:
+                pipe.get(keys[i])
+                pipe.ttl(keys[i])
+            replies = pipe.execute()
+
+            for n, i in enumerate(missing):
+                (data, ttl) = replies[2 * n], replies[2 * n + 1]
+                self._keep_local(keys[i], data, ttl)
+                results[i] = data
+        return [self._decode(data) for data in results]
+
+    def delete_many(self, keys):
+        super(TieredCacheStore, self).delete_many(keys)
+        self.near_cache.delete_many(keys)
+        self._publish(*keys)
+
+    def _keep_local(self, key, data, ttl):
+        """Stores encoded data fetched from Redis in the local cache,
+        expiring with its Redis TTL.
+        """
+        if data is None:
+            return
+        expire = None
+        if ttl is not None and ttl > 0:
+            expire = time.time() + ttl
+        self.near_cache.save(key, data, expire=self._local_expire(expire))
+
+    ###
+    ### Cross process invalidation
+    ###
+
+    def _publish(self, *keys):
+        self._invalidation.publish(keys)
+
+    def invalidate(self, message):
+        """Drops the key named in an invalidation message from the local
+        cache, unless this store sent the message.
+        """
+        self._invalidation.receive(message)
+
+    def start_invalidation_listener(self):
+        """Applies invalidations published by other processes from a
+        coroutine, for as long as the process runs.
+        """
+        return self._invalidation.start_listener()
+
+    @property
+    def stats(self):
+        return self.near_cache.stats
+
+
+###
+### Memoization
+###
+
+def _normalized_query(request):
+    """Returns the query string of `request` with its arguments sorted.
+    """
+    query = request.headers.get('QUERY') or ''
+    if query:
+        query = urllib.urlencode(sorted(
+            urlparse.parse_qsl(query, keep_blank_values=True)))
+    return query
+
+
+class _Flight(object):
+    """A computation in progress that other callers can wait on.
+    """
+    def __init__(self, event):
+        self.event = event
+        self.value = None
+        self.exc_info = None
+
+
+def cached(store, ttl=60, stale_ttl=0, key=None):
+    """Decorator that keeps a function's return values in `store` for `ttl`
+    seconds.
+
+    Calls that miss the same key while the function is already computing it
+    wait for that computation instead of starting their own. With
+    `stale_ttl`, a value is still served for that many seconds after it
+    expires while a coroutine computes a fresh one in the background.
+
+    The cache key is built from the function's name and arguments. A `key`
+    function can be given instead, and it is called with the same arguments
+    as the decorated function. Methods whose first argument is `self` are
+    cached per class and arguments. For `MessageHandler` methods the key
+    also has the request's path, its sorted query string and its cookies,
+    and stale values are recomputed by the request that finds them rather
+    than in the background, after that request has finished.
+
+    The decorated function gets an `invalidate(*args, **kwargs)` attribute
+    that deletes the value cached for those arguments.
+    """
+    from request_handling import coro_event, coro_spawn_later, MessageHandler
+
+    def decorator(fn):
+        argnames = inspect.getargspec(fn).args
+        is_method = bool(argnames) and argnames[0] == 'self'
+        flights = dict()
+
+        def is_handler(args):
+            return is_method and isinstance(args[0], MessageHandler)
+
+        def make_key(args, kwargs):
+            if key is not None:
+                return key(*args, **kwargs)
+            name = fn.__name__
+            request = ''
+            if is_method:
+                if is_handler(args):
+                    message = args[0].message
+                    request = ':%s?%s:%s' % (
+                        message.path, _normalized_query(message),
+                        message.get_header('cookie', ''))
+                name = '%s.%s' % (type(args[0]).__name__, name)
+                args = args[1:]
+            return 'cached:%s.%s%s:%r:%r' % (fn.__module__, name, request,
+                                             args, sorted(kwargs.items()))
+
+        def run_flight(cache_key, flight, args, kwargs):
+            try:
+                flight.value = fn(*args, **kwargs)
+                fresh_until = time.time() + ttl
+                entry = pickle.dumps((fresh_until, flight.value),
+                                     pickle.HIGHEST_PROTOCOL)
+                store.save(cache_key, entry, expire=fresh_until + stale_ttl)
+            except Exception:
+                flight.exc_info = sys.exc_info()
+            finally:
+                if flights.get(cache_key) is flight:
+                    del flights[cache_key]
+                flight.event.set()
+
+        def refresh(cache_key, flight, args, kwargs):
+            run_flight(cache_key, flight, args, kwargs)
+            if flight.exc_info is not None:
+                logging.error('Refreshing %s failed' % cache_key,
+                              exc_info=flight.exc_info)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            cache_key = make_key(args, kwargs)
+            entry = store.load(cache_key)
+            if entry is not None:
+                (fresh_until, value) = pickle.loads(entry)
+                if fresh_until > time.time():
+                    return value
+                if not is_handler(args):
+                    if cache_key not in flights:
+                        flight = flights[cache_key] = _Flight(coro_event())
+                        coro_spawn_later(0, refresh, cache_key, flight, args,
+                                         kwargs)
+                    return value
+
+            flight = flights.get(cache_key)
+            if flight is None:
+                flight = flights[cache_key] = _Flight(coro_event())
+                run_flight(cache_key, flight, args, kwargs)
+            else:
+                flight.event.wait()
+
+            if flight.exc_info is not None:
+                (exc_type, exc_value, tb) = flight.exc_info
+                raise exc_type, exc_value, tb
+            return flight.value
+
+        def invalidate(*args, **kwargs):
+            store.delete(make_key(args, kwargs))
+
+        wrapper.invalidate = invalidate
+        return wrapper
+
+    return decorator
+
+
+###
+### HTTP response cache
+###
+
+class ResponseCache(object):
+    """Caches complete HTTP responses in a cache store so repeated GET
+    requests are answered without routing them or building a handler.
+
+    Responses are keyed on the path, the query string with its arguments
+    sorted and the request headers named in `vary`. Only handlers that opt
+    in are cached, either with a `cache_ttl` class attribute or by calling
+    `cache_response(ttl, tags)`. Responses setting cookies or with a status
+    other than 200 are never cached.
+
+    A cached response whose ETag or Last-Modified matches the request's
+    If-None-Match or If-Modified-Since is answered with a 304.
+
+    Tags group responses for invalidation. Each tag has a version in the
+    store, and cached responses remember the versions of their tags at the
+    time they were stored. `invalidate(*tags)` changes those versions, so
+    every response carrying one of the tags is treated as missing.
+    """
+    KEY_PREFIX = 'response:'
+    TAG_PREFIX = 'response-tag:'
+
+    def __init__(self, store, vary=('accept', 'accept-encoding')):
+        self.store = store
+        self.vary = tuple(vary)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.not_modified = 0
+
+    def key_for(self, request):
+        """Returns the cache key for `request`.
+        """
+        parts = [self.KEY_PREFIX, request.path, '?', _normalized_query(request)]
+        for name in self.vary:
+            parts.append('\n%s:%s' % (name, request.get_header(name) or ''))
+        return ''.join(parts)
+
+    def load(self, request):
+        """Returns the cached response bytes for `request`, or None.
+        """
+        if request.method != 'GET':
+            return None
+        entry = self.store.load(self.key_for(request))
+        if entry is not None:
+            (tag_versions, response) = pickle.loads(entry)
+            if not tag_versions or tag_versions == self._tag_versions(
+                    tag_versions.keys(), create=False):
+                self.hits += 1
+                return self._conditional(request, response)
+        self.misses += 1
+        return None
+
+    def _conditional(self, request, response):
+        """Returns a 304 for `response` if the request's validators match
+        it, otherwise `response` itself.
+        """
+        if (request.get_header('if-none-match') is None and
+                request.get_header('if-modified-since') is None):
+            return response
+
+        from request_handling import (WebMessageHandler, http_response,
+                                      is_not_modified)
+        (status, headers, body) = self.split_response(response)
+        headers = dict(headers)
+        if not is_not_modified(request, headers):
+            return response
+        self.not_modified += 1
+        kept = WebMessageHandler._NOT_MODIFIED_HEADERS
+        return http_response('', WebMessageHandler._NOT_MODIFIED,
+                             WebMessageHandler._response_codes[304],
+                             dict((name, value) for (name, value)
+                                  in headers.iteritems() if name in kept))
+
+    def save(self, request, response, ttl, tags=()):
+        """Caches `response`, the HTTP response bytes for `request`, for
+        `ttl` seconds under `tags`.
+        """
+        tag_versions = self._tag_versions(tags, create=True)
+        entry = pickle.dumps((tag_versions, response),
+                             pickle.HIGHEST_PROTOCOL)
+        self.store.save(self.key_for(request), entry,
+                        expire=time.time() + ttl)
+        self.stores += 1
+
+    def save_result(self, request, handler, result, http_content):
+        """Caches a response rendered by `handler` if the handler opted in
+        and the response can be shared.
+        """
+        ttl = getattr(handler, 'cache_ttl', None)
+        if (not ttl or request.method != 'GET' or
+                result['status_code'] != 200 or
+                'Set-Cookie' in result['headers']):
+            return
+        if not isinstance(http_content, str):
+            http_content = ''.join(http_content)
+        self.save(request, http_content, ttl,
+                  getattr(handler, 'cache_tags', ()))
+
+    def invalidate(self, *tags):
+        """Drops every cached response stored under any of `tags`.
+        """
+        self.store.save_many([(self.TAG_PREFIX + tag, generate_session_id())
+                              for tag in tags])
+
+    def _tag_versions(self, tags, create):
+        tags = list(tags)
+        if not tags:
+            return dict()
+        versions = self.store.load_many([self.TAG_PREFIX + tag
+                                         for tag in tags])
+        if create:
+            ### A tag without a version gets one, so losing it from the
+            ### store invalidates responses rather than reviving them
+            new_versions = [(tag, generate_session_id())
+                            for tag, version in zip(tags, versions)
+                            if version is None]
+            if new_versions:
+                self.store.save_many([(self.TAG_PREFIX + tag, version)
+                                      for tag, version in new_versions])
+                versions = [version or dict(new_versions)[tag]
+                            for tag, version in zip(tags, versions)]
+        return dict(zip(tags, versions))
+
+    @staticmethod
+    def split_response(response):
+        """Splits HTTP response bytes into a status string, a list of header
+        two-tuples and the body, as WSGI servers expect them.
+        """
+        (head, _, body) = response.partition('\r\n\r\n')
+        lines = head.split('\r\n')
+        status = lines[0].split(' ', 1)[1]
+        headers = [tuple(line.split(': ', 1)) for line in lines[1:]]
+        return (status, headers, body)
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'not_modified': self.not_modified,
+        }
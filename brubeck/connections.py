@@ -6,7 +6,7 @@ import logging
 import Cookie
 
 from request import to_bytes, to_unicode, parse_netstring, Request
-from request_handling import http_response, coro_spawn
+from request_handling import http_response_parts, coro_spawn
 
 
 ###
@@ -86,6 +86,26 @@ class Connection(object):
         self._unsupported('close_bulk')
         self.reply_bulk(uuid, idents, "")
 
+    ###
+    ### Worker processes
+    ###
+
+    def prefork(self):
+        """Called in the master process before worker processes are forked.
+        """
+        pass
+
+    def postfork(self):
+        """Called in each worker process right after it is forked.
+        """
+        pass
+
+    def stop_receiving(self):
+        """Stops taking new messages so `recv_forever_ever` returns once the
+        current message has been dispatched.
+        """
+        pass
+
 
 ###
 ### ZeroMQ
@@ -120,6 +140,15 @@ def load_zmq_ctx():
     return load_zmq_ctx._zmq_ctx
 
 
+def unload_zmq_ctx():
+    """Terminates the module level zeromq context, if there is one, so the
+    next call to `load_zmq_ctx` creates a fresh one.
+    """
+    if hasattr(load_zmq_ctx, '_zmq_ctx'):
+        load_zmq_ctx._zmq_ctx.term()
+        del load_zmq_ctx._zmq_ctx
+
+
 ###
 ### Mongrel2
 ###
@@ -131,6 +160,9 @@ class Mongrel2Connection(Connection):
     """
     MAX_IDENTS = 100
 
+    # Messages at least this many bytes are handed to zmq without copying
+    ZERO_COPY_SIZE = 64 * 1024
+
     def __init__(self, pull_addr, pub_addr):
         """sender_id = uuid.uuid4() or anything unique
         pull_addr = pull socket used for incoming messages
@@ -139,19 +171,42 @@ class Mongrel2Connection(Connection):
         The class encapsulates socket type by referring to it's pull socket
         as in_sock and it's publish socket as out_sock.
         """
+        super(Mongrel2Connection, self).__init__()
+        self.in_addr = pull_addr
+        self.out_addr = pub_addr
+        self._connect()
+
+    def _connect(self):
+        """Creates the pull and publish sockets and connects them to Mongrel2.
+        """
         zmq = load_zmq()
         ctx = load_zmq_ctx()
 
-        in_sock = ctx.socket(zmq.PULL)
-        out_sock = ctx.socket(zmq.PUB)
+        self.in_sock = ctx.socket(zmq.PULL)
+        self.out_sock = ctx.socket(zmq.PUB)
 
-        super(Mongrel2Connection, self).__init__(in_sock, out_sock)
-        self.in_addr = pull_addr
-        self.out_addr = pub_addr
+        self.in_sock.connect(self.in_addr)
+        self.out_sock.setsockopt(zmq.IDENTITY, self.sender_id)
+        self.out_sock.connect(self.out_addr)
 
-        in_sock.connect(pull_addr)
-        out_sock.setsockopt(zmq.IDENTITY, self.sender_id)
-        out_sock.connect(pub_addr)
+    def prefork(self):
+        """zmq sockets and contexts can't cross a fork. The master closes its
+        sockets so Mongrel2 doesn't push messages to a process that never
+        reads them, and each worker connects its own.
+        """
+        self.in_sock.close(linger=0)
+        self.out_sock.close(linger=0)
+        unload_zmq_ctx()
+
+    def postfork(self):
+        """Connects this worker's own sockets. Mongrel2 load balances over
+        every connected pull socket.
+        """
+        self.sender_id = uuid4().hex
+        self._connect()
+
+    def stop_receiving(self):
+        self.in_sock.close(linger=0)
 
     def process_message(self, application, message):
         """This coroutine looks at the message, determines which handler will
@@ -159,17 +214,47 @@ class Mongrel2Connection(Connection):
 
         The application is responsible for handling misconfigured routes.
         """
+        application.in_flight += 1
+        try:
+            request = Request.parse_msg(message)
+            if request.is_disconnect():
+                # Ignore disconnect msgs. Dont have areason to do otherwise
+                return
+            if request.is_upload_start():
+                return  # Handled once Mongrel2 sends the finished upload
+
+            cache = application.response_cache
+            if cache is not None:
+                http_content = cache.load(request)
+                if http_content is not None:
+                    application.msg_conn.reply(request, http_content)
+                    return
+
+            handler = application.route_message(request)
+            result = handler()
+
+            if result:
+                http_content = http_response_parts(result['body'],
+                                                   result['status_code'],
+                                                   result['status_msg'],
+                                                   result['headers'])
+                if cache is not None:
+                    cache.save_result(request, handler, result, http_content)
+
+                application.msg_conn.reply(request, http_content)
+        finally:
+            application.in_flight -= 1
+
+    def shed_message(self, application, message):
+        """Answers a message with a 503 without routing it, for when the
+        application is at capacity.
+        """
         request = Request.parse_msg(message)
-        if request.is_disconnect():
-            return  # Ignore disconnect msgs. Dont have areason to do otherwise
-        handler = application.route_message(request)
-        result = handler()
-
-        if result:
-            http_content = http_response(result['body'], result['status_code'],
-                                         result['status_msg'], result['headers'])
-
-            application.msg_conn.reply(request, http_content)
+        if request.is_disconnect() or request.is_upload_start():
+            return
+        application.shed_count += 1
+        http_content = http_response_parts('', 503, 'Service Unavailable', {})
+        self.reply(request, http_content)
 
     def recv(self):
         """Receives a raw mongrel2.handler.Request object that you from the
@@ -183,18 +268,45 @@ class Mongrel2Connection(Connection):
         for incoming jobs. This function should then call super which runs the
         function in a try-except that can be ctrl-c'd.
         """
+        zmq = load_zmq()
+
         def fun_forever():
             while True:
-                request = self.recv()
-                coro_spawn(self.process_message, application, request)
+                try:
+                    request = self.recv()
+                except zmq.ZMQError:
+                    if self.in_sock.closed:
+                        break  # stop_receiving() was called
+                    raise
+                if application.at_capacity() and application.shed_load:
+                    self.shed_message(application, request)
+                    continue
+                ### Blocks while the pool is full, leaving further messages
+                ### queued in zmq so its high water mark pushes back
+                application.recv_blocked = application.at_capacity()
+                try:
+                    coro_spawn(self.process_message, application, request)
+                finally:
+                    application.recv_blocked = False
         self._recv_forever_ever(fun_forever)
 
     def send(self, uuid, conn_id, msg):
         """Raw send to the given connection ID at the given uuid, mostly used
         internally.
+
+        `msg` can be a string or a list of strings, such as the output of
+        `http_response_parts`. Either way the Mongrel2 header and the message
+        are assembled with a single copy. Large messages are then sent
+        without zmq copying them again.
         """
-        header = "%s %d:%s," % (uuid, len(str(conn_id)), str(conn_id))
-        self.out_sock.send(header + ' ' + to_bytes(msg))
+        header = "%s %d:%s, " % (uuid, len(str(conn_id)), str(conn_id))
+        if isinstance(msg, (list, tuple)):
+            parts = [header]
+            parts.extend(to_bytes(part) for part in msg)
+        else:
+            parts = [header, to_bytes(msg)]
+        payload = ''.join(parts)
+        self.out_sock.send(payload, copy=len(payload) < self.ZERO_COPY_SIZE)
 
     def reply(self, req, msg):
         """Does a reply based on the given Request object and message.
@@ -232,11 +344,50 @@ class WSGIConnection(Connection):
     def __init__(self, port=6767):
         super(WSGIConnection, self).__init__()
         self.port = port
+        self._listener = None
+        self._server = None
+
+    def prefork(self):
+        """Binds the listening socket in the master so every worker inherits
+        it and the kernel spreads connections across them.
+        """
+        import socket
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('', self.port))
+        listener.listen(1024)
+        self._listener = listener
+
+    def stop_receiving(self):
+        if self._server is not None and hasattr(self._server, 'stop'):
+            self._server.stop()
+        elif self._listener is not None:
+            self._listener.close()
 
     def process_message(self, application, environ, callback):
-        request = Request.parse_wsgi_request(environ)
-        handler = application.route_message(request)
-        result = handler()
+        application.in_flight += 1
+        try:
+            request = Request.parse_wsgi_request(environ)
+
+            cache = application.response_cache
+            if cache is not None:
+                http_content = cache.load(request)
+                if http_content is not None:
+                    (wsgi_status, headers, body) = cache.split_response(
+                        http_content)
+                    callback(wsgi_status, headers)
+                    return [body]
+
+            handler = application.route_message(request)
+            result = handler()
+            if cache is not None and result:
+                http_content = http_response_parts(result['body'],
+                                                   result['status_code'],
+                                                   result['status_msg'],
+                                                   dict(result['headers']))
+                cache.save_result(request, handler, result, http_content)
+        finally:
+            application.in_flight -= 1
 
         wsgi_status = ' '.join([str(result['status_code']), result['status_msg']])
         headers = [(k, v) for k,v in result['headers'].items()]
@@ -256,14 +407,27 @@ class WSGIConnection(Connection):
             def proc_msg(environ, callback):
                 return self.process_message(application, environ, callback)
 
+            ### A bounded application pool also bounds the server's requests
             if CORO_LIBRARY == 'gevent':
                 from gevent import wsgi
-                server = wsgi.WSGIServer(('', self.port), proc_msg)
-                server.serve_forever()
+                spawn = 'default'
+                if application.max_in_flight:
+                    spawn = application.pool
+                listener = self._listener or ('', self.port)
+                self._server = wsgi.WSGIServer(listener, proc_msg,
+                                               spawn=spawn)
+                self._server.serve_forever()
 
             elif CORO_LIBRARY == 'eventlet':
                 import eventlet.wsgi
-                server = eventlet.wsgi.server(eventlet.listen(('', self.port)),
-                                              proc_msg)
+                custom_pool = None
+                if application.max_in_flight:
+                    custom_pool = application.pool
+                listener = self._listener
+                if listener is None:
+                    listener = eventlet.listen(('', self.port))
+                self._listener = listener
+                server = eventlet.wsgi.server(listener, proc_msg,
+                                              custom_pool=custom_pool)
 
         self._recv_forever_ever(fun_forever)
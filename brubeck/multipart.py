@@ -0,0 +1,163 @@
+"""Incremental parsing of multipart/form-data bodies.
+
+The parser is fed the body a chunk at a time and reports each part to a
+handler as soon as it is found, so a body never has to be held in memory as a
+whole. File parts end up in `UploadedFile` instances, which keep small files
+in memory and spill large ones to a temporary file.
+"""
+
+import logging
+import tempfile
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+###
+### Uploaded files
+###
+
+class UploadedFile(object):
+    """A file uploaded as part of a multipart/form-data body. It behaves as
+    a read-only file positioned at the start of the upload.
+
+    Item access to `filename`, `content_type` and `body` is kept for handlers
+    written when uploads were stored as dictionaries. Reading `body` loads the
+    whole file into memory.
+    """
+    _ITEMS = ('filename', 'content_type', 'body')
+
+    def __init__(self, filename, content_type, fileobj, size):
+        self.filename = filename
+        self.content_type = content_type
+        self.file = fileobj
+        self.size = size
+
+    def read(self, *args):
+        return self.file.read(*args)
+
+    def readline(self, *args):
+        return self.file.readline(*args)
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+    def __iter__(self):
+        return iter(self.file)
+
+    @property
+    def body(self):
+        position = self.file.tell()
+        self.file.seek(0)
+        body = self.file.read()
+        self.file.seek(position)
+        return body
+
+    def __getitem__(self, key):
+        if key not in self._ITEMS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+
+def spooled_file(max_size):
+    """Returns a file that stays in memory until `max_size` bytes have been
+    written to it, after which it is moved to a temporary file on disk.
+    """
+    return tempfile.SpooledTemporaryFile(max_size=max_size)
+
+
+###
+### Parser
+###
+
+class MultipartParser(object):
+    """A boundary scanning state machine for multipart bodies.
+
+    `handler` receives three calls per part: `part_begin(header_string)` once
+    the part's headers are read, `part_data(data)` for each piece of the
+    part's body and `part_end()` once the part's closing boundary is found.
+    Parts cut short by the end of the body are never ended.
+    """
+    PREAMBLE, BOUNDARY, HEADERS, BODY, DONE = range(5)
+
+    def __init__(self, boundary, handler):
+        self.handler = handler
+        self._delimiter = '\r\n--' + boundary
+        # The first boundary isn't preceded by a line break, so add one
+        self._buffer = '\r\n'
+        self._state = self.PREAMBLE
+
+    def feed(self, data):
+        """Parses as much of the body as possible with `data` added to it.
+        """
+        self._buffer += data
+        while self._state != self.DONE and self._step():
+            pass
+
+    def close(self):
+        """Signals that the whole body has been fed to the parser.
+        """
+        if self._state != self.DONE:
+            logging.warning('multipart/form-data missing closing boundary')
+        self._buffer = ''
+
+    def _step(self):
+        """Runs one state transition. Returns False if more data is needed.
+        """
+        delimiter = self._delimiter
+        buf = self._buffer
+
+        if self._state == self.PREAMBLE:
+            index = buf.find(delimiter)
+            if index == -1:
+                self._buffer = buf[-len(delimiter):]
+                return False
+            self._buffer = buf[index + len(delimiter):]
+            self._state = self.BOUNDARY
+
+        elif self._state == self.BOUNDARY:
+            ### After a delimiter comes `--` for the last one or a line break
+            if buf.startswith('--'):
+                self._buffer = ''
+                self._state = self.DONE
+                return False
+            index = buf.find('\r\n')
+            if index == -1:
+                return False
+            self._buffer = buf[index + 2:]
+            self._state = self.HEADERS
+
+        elif self._state == self.HEADERS:
+            if buf.startswith('\r\n'):
+                header_string, body_start = '', 2
+            else:
+                index = buf.find('\r\n\r\n')
+                if index == -1:
+                    return False
+                header_string, body_start = buf[:index], index + 4
+            self._buffer = buf[body_start:]
+            self.handler.part_begin(header_string)
+            self._state = self.BODY
+
+        elif self._state == self.BODY:
+            index = buf.find(delimiter)
+            if index == -1:
+                ### Hold back enough to catch a delimiter split across chunks
+                safe = len(buf) - len(delimiter) + 1
+                if safe > 0:
+                    self.handler.part_data(buf[:safe])
+                    self._buffer = buf[safe:]
+                return False
+            if index:
+                self.handler.part_data(buf[:index])
+            self.handler.part_end()
+            self._buffer = buf[index + len(delimiter):]
+            self._state = self.BOUNDARY
+
+        return True
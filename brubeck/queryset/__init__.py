@@ -2,3 +2,5 @@ from brubeck.queryset.base import AbstractQueryset
 from brubeck.queryset.dict import DictQueryset
 from brubeck.queryset.redis import RedisQueryset
 
+from brubeck.queryset.writebehind import WriteBehindQueryset
+from brubeck.queryset.cached import CachedQueryset
@@ -18,6 +18,11 @@ class AbstractQueryset(object):
     `create_one`, `create_many`, ..., for all the CRUD operations. MySQL,
     Mongo, Redis, etc should be easy to implement while providing everything
     necessary for a proper REST API.
+
+    Fields other than the id can be looked up through secondary indexes,
+    declared with `indexes`, a dict mapping field names to `INDEX_HASH` for
+    lookups by value with `read_by` or `INDEX_RANGE` for numeric fields read
+    in order with `read_range`.
     """
 
     MSG_OK = 'OK'
@@ -26,16 +31,31 @@ class AbstractQueryset(object):
     MSG_NOTFOUND = 'Not Found'
     MSG_FAILED = 'Failed'
 
-    def __init__(self, db_conn=None, api_id='id'):
+    INDEX_HASH = 'hash'
+    INDEX_RANGE = 'range'
+
+    def __init__(self, db_conn=None, api_id='id', indexes=None):
         self.db_conn = db_conn
         self.api_id = api_id
+        self.indexes = dict(indexes or {})
+        for (field, kind) in self.indexes.items():
+            if kind not in (self.INDEX_HASH, self.INDEX_RANGE):
+                raise ValueError('Unknown index type for %s: %s' % (field,
+                                                                    kind))
+
+    def _check_index(self, field, kind):
+        if self.indexes.get(field) != kind:
+            raise ValueError('No %s index on %s' % (kind, field))
+
+    def _check_page_count(self, count):
+        if count < 1:
+            raise ValueError('Page count must be at least 1: %s' % count)
 
     ###
     ### CRUD Operations
     ###
 
     ### Section TODO:
-    ### * Pagination
     ### * Hook in authentication
     ### * Key filtering (owner / public)
     ### * Make model instantiation an option
@@ -101,6 +121,51 @@ class AbstractQueryset(object):
         """
         raise NotImplementedError
 
+    def read_page(self, cursor=None, count=25):
+        """Returns a two-tuple of the cursor for the next page and a list of
+        about `count` items from the db, starting at `cursor`. Scans start
+        with a cursor of None, and None is returned once there are no more
+        pages. A `count` below 1 or a cursor the queryset didn't hand out
+        raises ValueError.
+
+        This implementation slices `read_all`, using an offset as the
+        cursor. Querysets that can scan their storage should override it.
+        """
+        self._check_page_count(count)
+        offset = int(cursor or 0)
+        if offset < 0:
+            raise ValueError('Invalid cursor: %s' % cursor)
+        items = self.read_all()
+        page = items[offset:offset + count]
+        next_cursor = offset + count
+        if next_cursor >= len(items):
+            next_cursor = None
+        return (next_cursor, page)
+
+    def iter_all(self, count=1000):
+        """Yields every item in the db, reading `count` at a time with
+        `read_page`.
+        """
+        cursor = None
+        while True:
+            (cursor, page) = self.read_page(cursor, count)
+            for item in page:
+                yield item
+            if cursor is None:
+                break
+
+    def read_by(self, field, value):
+        """Returns a list of the objects whose `field` equals `value`,
+        using a hash index on `field`.
+        """
+        raise NotImplementedError
+
+    def read_range(self, field, low, high):
+        """Returns a list of the objects whose `field` is between `low` and
+        `high`, inclusive, ordered by `field`. Uses a range index on `field`.
+        """
+        raise NotImplementedError
+
     ### Update Functions
 
     def update_one(self, shield):
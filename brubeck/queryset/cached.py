@@ -0,0 +1,161 @@
+import time
+
+from brubeck.caching import LRUCacheStore, InvalidationChannel
+from brubeck.queryset.base import AbstractQueryset
+
+
+class CachedQueryset(AbstractQueryset):
+    """Wraps another queryset and keeps the documents it reads, as decoded
+    by that queryset, in an `LRUCacheStore` of `max_entries` documents.
+    Documents are kept until a write to their id, or for `ttl` seconds if
+    it is set. The cached documents are shared between callers, so they
+    should not be modified.
+
+    `read_one` and `read_many` are answered from the cache, reading only
+    missing ids from the wrapped queryset. Reads that scan the queryset go
+    straight to it.
+
+    If `invalidation_channel` is set, the ids of written documents are
+    published on that Redis channel and `start_invalidation_listener()`
+    drops ids written by other processes. `redis_connection` defaults to
+    the wrapped queryset's `db_conn`, which must then be a Redis connection.
+    """
+    def __init__(self, queryset, max_entries=10000, ttl=None,
+                 invalidation_channel=None, redis_connection=None):
+        super(CachedQueryset, self).__init__(db_conn=queryset.db_conn,
+                                             api_id=queryset.api_id,
+                                             indexes=queryset.indexes)
+        self.queryset = queryset
+        self.cache = LRUCacheStore(max_entries=max_entries)
+        self.ttl = ttl
+        self.invalidation_channel = invalidation_channel
+        self.redis_connection = redis_connection or queryset.db_conn
+        self._invalidation = InvalidationChannel(
+            self.redis_connection, invalidation_channel,
+            lambda iid: self._forget([iid], publish=False))
+        self.sender_id = self._invalidation.sender_id
+        self.invalidations = 0
+
+        ### Bumped by every invalidation. Documents read while it changes
+        ### might predate the write, so they aren't cached.
+        self._generation = 0
+
+    def _keep(self, ids, results, generation):
+        if generation != self._generation:
+            return
+        expire = None
+        if self.ttl:
+            expire = time.time() + self.ttl
+        items = [(iid, datum) for (iid, (status, datum)) in zip(ids, results)
+                 if status == self.MSG_OK]
+        self.cache.save_many(items, expire=expire)
+
+    def _forget(self, ids, publish=True):
+        ids = [str(iid) for iid in ids]
+        self._generation += 1
+        self.invalidations += len(ids)
+        self.cache.delete_many(ids)
+        if publish:
+            self._invalidation.publish(ids)
+
+    ###
+    ### Cross process invalidation
+    ###
+
+    def invalidate(self, message):
+        """Drops the id named in an invalidation message from the cache,
+        unless this queryset sent the message.
+        """
+        self._invalidation.receive(message)
+
+    def start_invalidation_listener(self):
+        """Applies invalidations published by other processes from a
+        coroutine, for as long as the process runs.
+        """
+        return self._invalidation.start_listener()
+
+    @property
+    def stats(self):
+        stats = self.cache.stats
+        stats['invalidations'] = self.invalidations
+        return stats
+
+    ###
+    ### CRUD Implementations
+    ###
+
+    ### Create Functions
+
+    def create_one(self, shield):
+        status = self.queryset.create_one(shield)
+        self._forget([getattr(shield, self.api_id)])
+        return status
+
+    def create_many(self, shields):
+        statuses = self.queryset.create_many(shields)
+        self._forget([getattr(shield, self.api_id) for shield in shields])
+        return statuses
+
+    ### Read Functions
+
+    def read_all(self):
+        return self.queryset.read_all()
+
+    def read_one(self, iid):
+        datum = self.cache.load(str(iid))
+        if datum is not None:
+            return (self.MSG_OK, datum)
+        generation = self._generation
+        result = self.queryset.read_one(iid)
+        self._keep([str(iid)], [result], generation)
+        return result
+
+    def read_many(self, ids):
+        ids = [str(iid) for iid in ids]
+        cached = self.cache.load_many(ids)
+        missing = [iid for (iid, datum) in zip(ids, cached) if datum is None]
+
+        fetched = dict()
+        if missing:
+            generation = self._generation
+            results = self.queryset.read_many(missing)
+            self._keep(missing, results, generation)
+            fetched = dict(zip(missing, results))
+
+        return [(self.MSG_OK, datum) if datum is not None else fetched[iid]
+                for (iid, datum) in zip(ids, cached)]
+
+    def read_page(self, cursor=None, count=25):
+        return self.queryset.read_page(cursor, count)
+
+    def read_by(self, field, value):
+        return self.queryset.read_by(field, value)
+
+    def read_range(self, field, low, high):
+        return self.queryset.read_range(field, low, high)
+
+    ### Update Functions
+
+    def update_one(self, shield):
+        status = self.queryset.update_one(shield)
+        self._forget([getattr(shield, self.api_id)])
+        return status
+
+    def update_many(self, shields):
+        statuses = self.queryset.update_many(shields)
+        self._forget([getattr(shield, self.api_id) for shield in shields])
+        return statuses
+
+    ### Destroy Functions
+
+    def destroy_one(self, iid):
+        try:
+            return self.queryset.destroy_one(iid)
+        finally:
+            self._forget([iid])
+
+    def destroy_many(self, ids):
+        try:
+            return self.queryset.destroy_many(ids)
+        finally:
+            self._forget(ids)
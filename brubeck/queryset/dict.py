@@ -1,16 +1,198 @@
+import bisect
+from array import array
+
 from brubeck.queryset.base import AbstractQueryset
 from schematics.serialize import to_python
 
+
+###
+### Compact storage
+###
+
+_MISSING = object()
+
+
+class ColumnStore(object):
+    """Stores dictionaries as rows of a table, one column per key, and
+    rebuilds a dictionary each time a row is read. It answers the parts of
+    the dictionary interface `DictQueryset` uses.
+
+    Keys are interned and stored once per column instead of once per item.
+    Columns holding only ints or only floats are kept in arrays of machine
+    numbers. A column becomes a plain list the first time it gets any other
+    value or a row lacks it.
+    """
+    _ARRAY_TYPES = ((int, 'l'), (float, 'd'))
+
+    def __init__(self):
+        self._columns = dict()
+        self._rows = dict()  # item id => row number
+        self._free_rows = list()
+        self._row_count = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __getitem__(self, key):
+        row = self._rows[key]
+        datum = dict()
+        for (field, column) in self._columns.iteritems():
+            value = column[row]
+            if value is not _MISSING:
+                datum[field] = value
+        return datum
+
+    def get(self, key, default=None):
+        if key not in self._rows:
+            return default
+        return self[key]
+
+    def __setitem__(self, key, datum):
+        row = self._rows.get(key)
+        if row is None:
+            row = self._allocate_row()
+            self._rows[key] = row
+
+        for (field, column) in self._columns.items():
+            if field not in datum:
+                self._set(field, column, row, _MISSING)
+        for (field, value) in datum.iteritems():
+            column = self._columns.get(field)
+            if column is None:
+                column = self._new_column(field, value)
+            self._set(field, column, row, value)
+
+    def pop(self, key):
+        datum = self[key]
+        row = self._rows.pop(key)
+        for (field, column) in self._columns.items():
+            if not isinstance(column, array):
+                column[row] = _MISSING  # let go of the value
+        self._free_rows.append(row)
+        return datum
+
+    def keys(self):
+        return self._rows.keys()
+
+    def values(self):
+        return [self[key] for key in self._rows]
+
+    def items(self):
+        return [(key, self[key]) for key in self._rows]
+
+    def _allocate_row(self):
+        if self._free_rows:
+            return self._free_rows.pop()
+        row = self._row_count
+        self._row_count += 1
+        for (field, column) in self._columns.iteritems():
+            if isinstance(column, array):
+                column.append(0)
+            else:
+                column.append(_MISSING)
+        return row
+
+    def _new_column(self, field, value):
+        field = intern(field) if isinstance(field, str) else field
+        column = None
+        ### Only a column every existing row can fill starts as an array
+        if len(self._rows) == 1:
+            for (kind, typecode) in self._ARRAY_TYPES:
+                if type(value) is kind:
+                    column = array(typecode, [0] * self._row_count)
+        if column is None:
+            column = [_MISSING] * self._row_count
+        self._columns[field] = column
+        return column
+
+    def _set(self, field, column, row, value):
+        if isinstance(column, array):
+            if type(value) is {'l': int, 'd': float}[column.typecode]:
+                try:
+                    column[row] = value
+                    return
+                except OverflowError:
+                    pass
+            column = self._columns[field] = list(column)
+        column[row] = value
+
+
+###
+### Queryset
+###
+
 class DictQueryset(AbstractQueryset):
     """This class exists as an example of how one could implement a Queryset.
     This model is an in-memory dictionary and uses the model's id as the key.
 
     The data stored is the result of calling `to_python()` on the model.
+
+    `read_page` sorts the ids the first time it is called after an item is
+    added or removed, so writes stay O(1), and resumes from the last id it
+    returned. Hash indexes map values to sets of ids. Range indexes map ids
+    to values and are sorted into (value, id) pairs by the first
+    `read_range` after a write.
+
+    With `compact=True` items are kept in a `ColumnStore`, which takes a
+    fraction of the memory of a dictionary per item at the cost of
+    rebuilding a dictionary on every read.
     """
-    def __init__(self, **kw):
+    def __init__(self, compact=False, **kw):
         """Set the db_conn to a dictionary.
         """
-        super(DictQueryset, self).__init__(db_conn=dict(), **kw)
+        db_conn = ColumnStore() if compact else dict()
+        super(DictQueryset, self).__init__(db_conn=db_conn, **kw)
+        self._sorted_ids = None  # built by read_page, dropped by writes
+        self._hash_indexes = dict()
+        self._range_indexes = dict()
+        self._sorted_ranges = dict()  # field => sorted (value, id) pairs
+        for (field, kind) in self.indexes.items():
+            if kind == self.INDEX_HASH:
+                self._hash_indexes[field] = dict()
+            else:
+                self._range_indexes[field] = dict()
+
+    def _store(self, shield_key, datum):
+        if shield_key not in self.db_conn:
+            self._sorted_ids = None
+        elif self._hash_indexes or self._range_indexes:
+            self._unindex(shield_key, self.db_conn[shield_key])
+        self.db_conn[shield_key] = datum
+        self._index(shield_key, datum)
+
+    def _remove(self, shield_key):
+        datum = self.db_conn.pop(shield_key)
+        self._sorted_ids = None
+        self._unindex(shield_key, datum)
+        return datum
+
+    def _index(self, shield_key, datum):
+        for (field, index) in self._hash_indexes.items():
+            value = datum.get(field)
+            if value is not None:
+                index.setdefault(value, set()).add(shield_key)
+        for (field, index) in self._range_indexes.items():
+            value = datum.get(field)
+            if value is not None:
+                index[shield_key] = value
+                self._sorted_ranges.pop(field, None)
+
+    def _unindex(self, shield_key, datum):
+        for (field, index) in self._hash_indexes.items():
+            ids = index.get(datum.get(field))
+            if ids is not None:
+                ids.discard(shield_key)
+                if not ids:
+                    del index[datum.get(field)]
+        for (field, index) in self._range_indexes.items():
+            if index.pop(shield_key, None) is not None:
+                self._sorted_ranges.pop(field, None)
 
     ### Create Functions
 
@@ -21,7 +203,7 @@ class DictQueryset(AbstractQueryset):
             status = self.MSG_CREATED
 
         shield_key = str(getattr(shield, self.api_id))
-        self.db_conn[shield_key] = to_python(shield)
+        self._store(shield_key, to_python(shield))
         return (status, shield)
 
     def create_many(self, shields):
@@ -33,6 +215,24 @@ class DictQueryset(AbstractQueryset):
     def read_all(self):
         return [(self.MSG_OK, datum) for datum in self.db_conn.values()]
 
+    def read_page(self, cursor=None, count=25):
+        """Reads up to `count` items in id order. The cursor is the last id
+        of the previous page, so pages stay consistent while items are added
+        or removed.
+        """
+        self._check_page_count(count)
+        if self._sorted_ids is None:
+            self._sorted_ids = sorted(self.db_conn.keys())
+        ids = self._sorted_ids
+        start = 0
+        if cursor is not None:
+            start = bisect.bisect_right(ids, str(cursor))
+        page_ids = ids[start:start + count]
+        page = [(self.MSG_OK, self.db_conn[iid]) for iid in page_ids]
+        next_cursor = None
+        if start + count < len(ids):
+            next_cursor = page_ids[-1]
+        return (next_cursor, page)
 
     def read_one(self, iid):
         iid = str(iid)  # TODO Should be cleaner
@@ -44,10 +244,30 @@ class DictQueryset(AbstractQueryset):
     def read_many(self, ids):
         return [self.read_one(iid) for iid in ids]
 
+    def read_by(self, field, value):
+        self._check_index(field, self.INDEX_HASH)
+        ids = sorted(self._hash_indexes[field].get(value, ()))
+        return [(self.MSG_OK, self.db_conn[iid]) for iid in ids]
+
+    def read_range(self, field, low, high):
+        self._check_index(field, self.INDEX_RANGE)
+        index = self._sorted_ranges.get(field)
+        if index is None:
+            index = sorted((value, iid) for (iid, value)
+                           in self._range_indexes[field].iteritems())
+            self._sorted_ranges[field] = index
+        results = list()
+        for position in xrange(bisect.bisect_left(index, (low,)), len(index)):
+            (value, iid) = index[position]
+            if value > high:
+                break
+            results.append((self.MSG_OK, self.db_conn[iid]))
+        return results
+
     ### Update Functions
     def update_one(self, shield):
         shield_key = str(getattr(shield, self.api_id))
-        self.db_conn[shield_key] = to_python(shield)
+        self._store(shield_key, to_python(shield))
         return (self.MSG_UPDATED, shield)
 
     def update_many(self, shields):
@@ -58,8 +278,7 @@ class DictQueryset(AbstractQueryset):
 
     def destroy_one(self, item_id):
         try:
-            datum = self.db_conn[item_id]
-            del self.db_conn[item_id]
+            datum = self._remove(item_id)
         except KeyError:
             raise FourOhFourException
         return (self.MSG_UPDATED, datum)
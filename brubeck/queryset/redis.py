@@ -1,12 +1,17 @@
+from __future__ import absolute_import
+
+from brubeck.caching import CODECS, ZLIB, LZ4, ZSTD
 from brubeck.queryset.base import AbstractQueryset
-from itertools import imap
+from itertools import izip
 import ujson as json
+import time
 import zlib
 try:
     import redis
 except ImportError:
     pass
 
+
 class RedisQueryset(AbstractQueryset):
     """This class uses redis to store the DictShield after 
     calling it's `to_json()` method. Upon reading from the Redis
@@ -14,35 +19,77 @@ class RedisQueryset(AbstractQueryset):
 
     Redis connection uses the redis-py api located here:
     https://github.com/andymccurdy/redis-py
+
+    Batch operations are pipelined `chunk_size` items at a time. The
+    `iter_*_many` variants yield results as each chunk completes, so a batch
+    of any size is handled with a bounded command buffer and reply list.
+
+    Hash indexes are Redis sets of ids per value and range indexes are sorted
+    sets scored by the field's value. Each id's indexed values are kept in
+    one more hash, so writes can drop stale index entries. That hash is
+    WATCHed while the previous values are read, and the index changes are
+    queued in the same MULTI/EXEC transaction as the HSET or HDEL they belong
+    to, so a chunk that races another client's write is retried.
+
+    With `compress=True`, values of `compress_threshold` bytes or more are
+    compressed with `codec`: 'zlib', or 'lz4' or 'zstd' if those packages
+    are installed. `compress_level` is passed to zlib and zstd. Compressed
+    values start with a byte naming their codec. Smaller values, and values
+    that don't shrink, are stored as plain JSON. Values written with any
+    codec or threshold can be read back, as can values compressed with zlib
+    before codecs had tags.
     """
     # TODO: - catch connection exceptions?
     #       - set Redis EXPIRE and self.expires
     #       - confirm that the correct status is being returned in 
     #         each circumstance
-    def __init__(self, compress=False, compress_level=1, **kw):
+    ZLIB = ZLIB
+    LZ4 = LZ4
+    ZSTD = ZSTD
+
+    CODECS = CODECS
+
+    COMPRESS_THRESHOLD = 256  # bytes of JSON worth compressing
+
+    WATCH_RETRIES = 8  # attempts at an indexed chunk before giving up
+    WATCH_RETRY_DELAY = 0.001  # seconds, doubled after each attempt
+
+    def __init__(self, compress=False, compress_level=1, chunk_size=1000,
+                 codec='zlib', compress_threshold=COMPRESS_THRESHOLD, **kw):
         """The Redis connection wiil be passed in **kw and is used below
         as self.db_conn.
         """
         super(RedisQueryset, self).__init__(**kw)
+        if compress and codec not in self.CODECS:
+            raise ValueError('Unavailable codec: %s' % codec)
         self.compress = compress
         self.compress_level = compress_level
-        
+        self.codec = codec
+        self.compress_threshold = compress_threshold
+        self.chunk_size = chunk_size
+        self._decompressors = dict((tag, decompress) for (tag, _, decompress)
+                                   in self.CODECS.values())
+
     def _setvalue(self, shield):
-        if self.compress:
-            return zlib.compress(shield.to_json(), self.compress_level)
-        return shield.to_json()
+        value = shield.to_json()
+        if self.compress and len(value) >= self.compress_threshold:
+            (tag, compress, _) = self.CODECS[self.codec]
+            compressed = compress(value, self.compress_level)
+            if len(compressed) + 1 < len(value):
+                return tag + compressed
+        return value
 
     def _readvalue(self, value):
-        if self.compress:
-            try:
-                compressed_value = zlib.decompress(value)
-                return json.loads(zlib.decompress(value))
-            except Exception as e:
-                # value is 0 or None from a Redis return value
-                return value
-        if value:
-            return json.loads(value)
-        return None
+        if not value:
+            # value is 0 or None from a Redis return value
+            return None
+        decompress = self._decompressors.get(value[:1])
+        if decompress is not None:
+            value = decompress(buffer(value, 1))
+        elif value[:1] not in '{[':
+            ### Compressed with zlib before codecs were tagged
+            value = zlib.decompress(value)
+        return json.loads(value)
 
     def _message_factory(self, fail_status, success_status):
         """A Redis command often returns some value or 0 after the
@@ -50,9 +97,136 @@ class RedisQueryset(AbstractQueryset):
         """
         return lambda x: success_status if x else fail_status
 
+    def _chunks(self, items):
+        """Splits any iterable into lists of at most `chunk_size` items.
+        """
+        chunk = list()
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = list()
+        if chunk:
+            yield chunk
+
+    def _pipelined(self, items, queue_commands, commands_per_item=1,
+                   index_entry=None):
+        """Calls `queue_commands(pipe, item)` for each item and executes the
+        pipeline once per chunk. Yields each item with its reply, or a list
+        of its replies if it queued more than one command.
+
+        If the queryset has indexes, `index_entry(item)` returns the item's
+        id and its indexed values, or None if it is being removed, and the
+        index updates are queued after the items' commands.
+        """
+        pipe = self.db_conn.pipeline()
+        for chunk in self._chunks(items):
+            if self.indexes and index_entry is not None:
+                replies = self._execute_indexed(pipe, chunk, queue_commands,
+                                                map(index_entry, chunk))
+            else:
+                for item in chunk:
+                    queue_commands(pipe, item)
+                replies = pipe.execute()
+            pipe.reset()
+            if commands_per_item == 1:
+                for pair in izip(chunk, replies):
+                    yield pair
+            else:
+                for (i, item) in enumerate(chunk):
+                    start = i * commands_per_item
+                    yield (item, replies[start:start + commands_per_item])
+
+    def _queue_hset(self, pipe, shield):
+        pipe.hset(self.api_id, str(getattr(shield, self.api_id)),
+                  self._setvalue(shield))
+
+    ### Secondary indexes
+
+    def _indexed_values_key(self):
+        return '%s:indexed' % self.api_id
+
+    def _hash_index_key(self, field, value):
+        return '%s:index:%s:%s' % (self.api_id, field, value)
+
+    def _range_index_key(self, field):
+        return '%s:range:%s' % (self.api_id, field)
+
+    def _index_entry(self, shield):
+        values = dict((field, getattr(shield, field, None))
+                      for field in self.indexes)
+        return (str(getattr(shield, self.api_id)), values)
+
+    def _unindex_entry(self, shield_id):
+        return (str(shield_id), None)
+
+    def _execute_indexed(self, pipe, chunk, queue_commands, entries):
+        """Executes a chunk's commands along with its index updates. The
+        values previously indexed for the chunk's ids are read in one HMGET
+        under WATCH, so if another client changes them before EXEC the
+        transaction is dropped and the chunk is tried again, after a delay
+        that doubles each time. The WatchError is raised after
+        `WATCH_RETRIES` attempts.
+        """
+        indexed_key = self._indexed_values_key()
+        ids = [shield_id for (shield_id, values) in entries]
+        delay = self.WATCH_RETRY_DELAY
+        for attempt in xrange(self.WATCH_RETRIES):
+            try:
+                pipe.watch(indexed_key)
+                previous = pipe.hmget(indexed_key, ids)
+                pipe.multi()
+                for item in chunk:
+                    queue_commands(pipe, item)
+                self._queue_index_updates(pipe, entries, previous)
+                return pipe.execute()
+            except redis.WatchError:
+                pipe.reset()
+                if attempt == self.WATCH_RETRIES - 1:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+
+    def _queue_index_updates(self, pipe, entries, previous):
+        """Queues the index changes for `entries`, a list of (id, values)
+        pairs where values is None for removed items, given the values
+        `previous`ly indexed for those ids.
+        """
+        for ((shield_id, values), old_values) in izip(entries, previous):
+            old_values = json.loads(old_values) if old_values else {}
+            for (field, kind) in self.indexes.items():
+                old_value = old_values.get(field)
+                new_value = None
+                if values is not None:
+                    new_value = values.get(field)
+                if old_value == new_value:
+                    continue
+                if old_value is not None:
+                    if kind == self.INDEX_HASH:
+                        pipe.srem(self._hash_index_key(field, old_value),
+                                  shield_id)
+                    else:
+                        pipe.zrem(self._range_index_key(field), shield_id)
+                if new_value is not None:
+                    if kind == self.INDEX_HASH:
+                        pipe.sadd(self._hash_index_key(field, new_value),
+                                  shield_id)
+                    else:
+                        ### ZADD's signature differs across redis-py versions
+                        pipe.execute_command('ZADD',
+                                             self._range_index_key(field),
+                                             new_value, shield_id)
+            if values is None:
+                pipe.hdel(self._indexed_values_key(), shield_id)
+            else:
+                pipe.hset(self._indexed_values_key(), shield_id,
+                          json.dumps(values))
+
     ### Create Functions
 
     def create_one(self, shield):
+        if self.indexes:
+            return self.create_many([shield])[0]
         shield_value = self._setvalue(shield)
         shield_key = str(getattr(shield, self.api_id))        
         result = self.db_conn.hset(self.api_id, shield_key, shield_value)
@@ -61,19 +235,33 @@ class RedisQueryset(AbstractQueryset):
         return (self.MSG_UPDATED, shield)
 
     def create_many(self, shields):
+        return list(self.iter_create_many(shields))
+
+    def iter_create_many(self, shields):
         message_handler = self._message_factory(self.MSG_UPDATED, self.MSG_CREATED)
-        pipe = self.db_conn.pipeline()
-        for shield in shields:
-            pipe.hset(self.api_id, str(getattr(shield, self.api_id)), self._setvalue(shield))
-        results = zip(imap(message_handler, pipe.execute()), shields)
-        pipe.reset()
-        return results
+        for (shield, result) in self._pipelined(shields, self._queue_hset,
+                                                index_entry=self._index_entry):
+            yield (message_handler(result), shield)
         
     ### Read Functions
 
     def read_all(self):
         return [(self.MSG_OK, self._readvalue(datum)) for datum in self.db_conn.hvals(self.api_id)]
 
+    def read_page(self, cursor=None, count=25):
+        """Reads a page of items with HSCAN. Redis treats `count` as a hint,
+        so pages can be somewhat larger or smaller.
+        """
+        self._check_page_count(count)
+        cursor = int(cursor or 0)
+        if cursor < 0:
+            raise ValueError('Invalid cursor: %s' % cursor)
+        (cursor, values) = self.db_conn.hscan(self.api_id, cursor,
+                                              count=count)
+        page = [(self.MSG_OK, self._readvalue(value))
+                for value in values.itervalues()]
+        return (int(cursor) or None, page)
+
     def read_one(self, shield_id):
         result = self.db_conn.hget(self.api_id, shield_id)
         if result:
@@ -81,34 +269,53 @@ class RedisQueryset(AbstractQueryset):
         return (self.MSG_FAILED, shield_id)
 
     def read_many(self, shield_ids):
+        return list(self.iter_read_many(shield_ids))
+
+    def iter_read_many(self, shield_ids):
         message_handler = self._message_factory(self.MSG_FAILED, self.MSG_OK)
-        pipe = self.db_conn.pipeline()
-        for shield_id in shield_ids:
-            pipe.hget(self.api_id, str(shield_id))
-        results = pipe.execute()
-        pipe.reset()
-        return zip(imap(message_handler, results), map(self._readvalue, results))
+        queue_hget = lambda pipe, shield_id: pipe.hget(self.api_id,
+                                                        str(shield_id))
+        for (shield_id, result) in self._pipelined(shield_ids, queue_hget):
+            yield (message_handler(result), self._readvalue(result))
+
+    def read_by(self, field, value):
+        self._check_index(field, self.INDEX_HASH)
+        ids = sorted(self.db_conn.smembers(self._hash_index_key(field, value)))
+        return self.read_many(ids)
+
+    def read_range(self, field, low, high):
+        self._check_index(field, self.INDEX_RANGE)
+        ids = self.db_conn.zrangebyscore(self._range_index_key(field),
+                                         low, high)
+        return self.read_many(ids)
 
     ### Update Functions
 
     def update_one(self, shield):
+        if self.indexes:
+            return self.update_many([shield])[0]
         shield_key = str(getattr(shield, self.api_id))
         message_handler = self._message_factory(self.MSG_UPDATED, self.MSG_CREATED)
         status = message_handler(self.db_conn.hset(self.api_id, shield_key, self._setvalue(shield)))
         return (status, shield)
 
     def update_many(self, shields):
+        return list(self.iter_update_many(shields))
+
+    def iter_update_many(self, shields):
         message_handler = self._message_factory(self.MSG_UPDATED, self.MSG_CREATED)
-        pipe = self.db_conn.pipeline()
-        for shield in shields:
-            pipe.hset(self.api_id, str(getattr(shield, self.api_id)), self._setvalue(shield))
-        results = pipe.execute()
-        pipe.reset()
-        return zip(imap(message_handler, results), shields)
+        for (shield, result) in self._pipelined(shields, self._queue_hset,
+                                                index_entry=self._index_entry):
+            yield (message_handler(result), shield)
 
     ### Destroy Functions
 
     def destroy_one(self, shield_id):
+        if self.indexes:
+            (status, datum) = self.destroy_many([shield_id])[0]
+            if status == self.MSG_FAILED:
+                return self.MSG_NOTFOUND
+            return (status, datum)
         pipe = self.db_conn.pipeline()
         pipe.hget(self.api_id, shield_id)
         pipe.hdel(self.api_id, shield_id)
@@ -119,15 +326,19 @@ class RedisQueryset(AbstractQueryset):
         return self.MSG_NOTFOUND
 
     def destroy_many(self, ids):
+        return list(self.iter_destroy_many(ids))
+
+    def iter_destroy_many(self, ids):
         # TODO: how to handle missing fields, currently returning self.MSG_FAILED
         message_handler = self._message_factory(self.MSG_FAILED, self.MSG_UPDATED)
-        pipe = self.db_conn.pipeline()
-        for _id in ids:
+
+        def queue_hget_hdel(pipe, _id):
+            ### Each value is read and deleted in the same round trip
             pipe.hget(self.api_id, _id)
-        values_results = pipe.execute()
-        for _id in ids:
             pipe.hdel(self.api_id, _id)
-        delete_results = pipe.execute()
-        pipe.reset()
-        return zip(imap(message_handler, delete_results), map(self._readvalue, values_results))
+
+        for (_id, (value, deleted)) in self._pipelined(
+                ids, queue_hget_hdel, commands_per_item=2,
+                index_entry=self._unindex_entry):
+            yield (message_handler(deleted), self._readvalue(value))
 
@@ -0,0 +1,229 @@
+import logging
+import time
+from collections import OrderedDict
+
+from brubeck.queryset.base import AbstractQueryset
+from brubeck.request_handling import coro_spawn_later, coro_event
+
+
+class WriteBehindQueryset(AbstractQueryset):
+    """Wraps another queryset and answers writes before they reach it.
+
+    Creates, updates and destroys are buffered by id and written to the
+    wrapped queryset with `create_many`, `update_many` and `destroy_many`
+    from a coroutine. A write replaces any write still buffered for the
+    same id, so an item written many times between flushes is written once.
+    An update to an item whose create is still buffered stays a create, and
+    destroying it just drops the buffered create.
+
+    Buffered writes are flushed `flush_interval` seconds after the first of
+    them arrives, or as soon as `flush_size` are buffered, in batches of at
+    most `flush_size`. Writes that fail are logged and dropped, which suits
+    data that can tolerate losing a batch.
+
+    Reads of buffered ids, and reads that scan the queryset, flush first so
+    they see every write made before them.
+
+    Call `close` before exiting to write what is left, or register it with
+    `Brubeck.add_shutdown_hook`. Queue depth and flush counters are
+    available as `stats`.
+    """
+
+    OP_CREATE = 'create'
+    OP_UPDATE = 'update'
+    OP_DESTROY = 'destroy'
+
+    def __init__(self, queryset, flush_size=500, flush_interval=1.0):
+        super(WriteBehindQueryset, self).__init__(db_conn=queryset.db_conn,
+                                                  api_id=queryset.api_id,
+                                                  indexes=queryset.indexes)
+        self.queryset = queryset
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        self._pending = OrderedDict()  # id => (op, shield or id)
+        self._batch = dict()
+        self._timer = None
+        self._flushing = False
+        self._flush_queued = False
+        self._flush_done = None
+        self._counters = {
+            'writes': 0,
+            'coalesced': 0,
+            'max_pending': 0,
+            'flushes': 0,
+            'flushed': 0,
+            'failed': 0,
+            'last_flush_duration': 0.0,
+        }
+
+    ###
+    ### Buffering
+    ###
+
+    def _queue(self, iid, op, item):
+        iid = str(iid)
+        counters = self._counters
+        counters['writes'] += 1
+        previous = self._pending.get(iid)
+        if previous is not None:
+            counters['coalesced'] += 1
+            if previous[0] == self.OP_CREATE:
+                if op == self.OP_DESTROY:
+                    del self._pending[iid]
+                    return
+                if op == self.OP_UPDATE:
+                    op = self.OP_CREATE
+        self._pending[iid] = (op, item)
+
+        counters['max_pending'] = max(counters['max_pending'],
+                                      len(self._pending))
+
+        if len(self._pending) >= self.flush_size:
+            if not (self._flushing or self._flush_queued):
+                self._flush_queued = True
+                coro_spawn_later(0, self.flush)
+        elif self._timer is None:
+            self._timer = coro_spawn_later(self.flush_interval,
+                                           self._timed_flush)
+
+    def _timed_flush(self):
+        self._timer = None
+        self.flush()
+
+    def _is_pending(self, ids):
+        for iid in ids:
+            iid = str(iid)
+            if iid in self._pending or iid in self._batch:
+                return True
+        return False
+
+    ###
+    ### Flushing
+    ###
+
+    def flush(self):
+        """Writes every buffered item to the wrapped queryset, returning once
+        they are written. A flush already running in another coroutine is
+        waited for instead, as it keeps going until the buffer is empty.
+        """
+        if self._flushing:
+            self._flush_done.wait()
+            return
+
+        self._flushing = True
+        self._flush_queued = False
+        self._flush_done = coro_event()
+        try:
+            while self._pending:
+                batch = OrderedDict()
+                while self._pending and len(batch) < self.flush_size:
+                    (iid, entry) = self._pending.popitem(last=False)
+                    batch[iid] = entry
+                self._batch = batch
+                self._write(batch)
+        finally:
+            self._batch = dict()
+            self._flushing = False
+            self._flush_done.set()
+
+    def _write(self, batch):
+        started = time.time()
+        writes = {self.OP_CREATE: [], self.OP_UPDATE: [], self.OP_DESTROY: []}
+        for (op, item) in batch.itervalues():
+            writes[op].append(item)
+
+        counters = self._counters
+        for (op, write) in ((self.OP_CREATE, self.queryset.create_many),
+                            (self.OP_UPDATE, self.queryset.update_many),
+                            (self.OP_DESTROY, self.queryset.destroy_many)):
+            items = writes[op]
+            if not items:
+                continue
+            try:
+                write(items)
+                counters['flushed'] += len(items)
+            except Exception:
+                counters['failed'] += len(items)
+                logging.error('Write behind %s of %s items failed' % (
+                    op, len(items)), exc_info=True)
+
+        counters['flushes'] += 1
+        counters['last_flush_duration'] = time.time() - started
+
+    def close(self):
+        """Writes everything still buffered. Meant to be called on shutdown.
+        """
+        if self._timer is not None:
+            self._timer.kill()
+            self._timer = None
+        while self._pending or self._flushing:
+            self.flush()
+
+    @property
+    def stats(self):
+        """Counters for the write buffer. `pending` is the current queue
+        depth and `max_pending` the deepest it has been.
+        """
+        stats = dict(self._counters)
+        stats['pending'] = len(self._pending) + len(self._batch)
+        return stats
+
+    ###
+    ### CRUD Implementations
+    ###
+
+    ### Create Functions
+
+    def create_one(self, shield):
+        self._queue(getattr(shield, self.api_id), self.OP_CREATE, shield)
+        return (self.MSG_CREATED, shield)
+
+    def create_many(self, shields):
+        return [self.create_one(shield) for shield in shields]
+
+    ### Read Functions
+
+    def read_all(self):
+        self.flush()
+        return self.queryset.read_all()
+
+    def read_one(self, iid):
+        if self._is_pending([iid]):
+            self.flush()
+        return self.queryset.read_one(iid)
+
+    def read_many(self, ids):
+        if self._is_pending(ids):
+            self.flush()
+        return self.queryset.read_many(ids)
+
+    def read_page(self, cursor=None, count=25):
+        self.flush()
+        return self.queryset.read_page(cursor, count)
+
+    def read_by(self, field, value):
+        self.flush()
+        return self.queryset.read_by(field, value)
+
+    def read_range(self, field, low, high):
+        self.flush()
+        return self.queryset.read_range(field, low, high)
+
+    ### Update Functions
+
+    def update_one(self, shield):
+        self._queue(getattr(shield, self.api_id), self.OP_UPDATE, shield)
+        return (self.MSG_UPDATED, shield)
+
+    def update_many(self, shields):
+        return [self.update_one(shield) for shield in shields]
+
+    ### Destroy Functions
+
+    def destroy_one(self, iid):
+        self._queue(iid, self.OP_DESTROY, iid)
+        return (self.MSG_UPDATED, iid)
+
+    def destroy_many(self, ids):
+        return [self.destroy_one(iid) for iid in ids]
@@ -1,9 +1,13 @@
+import os
 import cgi
 import json
 import Cookie
 import logging
 import urlparse
 import re
+from cStringIO import StringIO
+
+from multipart import MultipartParser, UploadedFile, spooled_file, CHUNK_SIZE
 
 def parse_netstring(ns):
     length, rest = ns.split(':', 1)
@@ -11,6 +15,17 @@ def parse_netstring(ns):
     assert rest[length] == ',', "Netstring did not end in ','"
     return rest[:length], rest[length + 1:]
 
+def netstring_bounds(data, offset=0):
+    """Locates the netstring starting at `offset` in `data` without copying
+    any of it. Returns the start and end offsets of the netstring's payload
+    and the offset just past the trailing comma.
+    """
+    colon = data.index(':', offset)
+    start = colon + 1
+    end = start + int(data[offset:colon])
+    assert data[end] == ',', "Netstring did not end in ','"
+    return start, end, end + 1
+
 def to_bytes(data, enc='utf8'):
     """Convert anything to bytes
     """
@@ -26,28 +41,68 @@ def to_unicode(s, enc='utf8'):
 class Request(object):
     """Word.
     """
+    # Uploaded files bigger than this many bytes are spooled to disk
+    MULTIPART_SPOOL_SIZE = 1024 * 1024
+
+    # Where Mongrel2's chroot is on this host. Bodies Mongrel2 streams to
+    # disk are only read from files under it, and not at all if it is unset.
+    UPLOAD_DIR = None
+
     def __init__(self, sender, conn_id, path, headers, body, url, *args, **kwargs):
         self.sender = sender
         self.path = path
         self.conn_id = conn_id
         self.headers = headers
-        self.body = body
+        self._body = body
         self.url_parts = urlparse.urlsplit(url) if isinstance(url, basestring) else url
 
-        if self.method == 'JSON':
-            self.data = json.loads(body)
-        else:
-            self.data = {}
+    ###
+    ### Lazily parsed request data
+    ###
+
+    @property
+    def data(self):
+        """The decoded body of a JSON message from Mongrel2, parsed on first
+        access.
+        """
+        if not hasattr(self, '_data'):
+            if self.method == 'JSON':
+                self._data = json.loads(self.body)
+            else:
+                self._data = {}
+        return self._data
+
+    @property
+    def arguments(self):
+        """Query string and form arguments, parsed on first access.
+        """
+        if not hasattr(self, '_arguments'):
+            self._parse_arguments()
+        return self._arguments
+
+    @property
+    def files(self):
+        """Files uploaded as multipart/form-data, parsed on first access.
+        """
+        if not hasattr(self, '_files'):
+            self._parse_arguments()
+        return self._files
+
+    def _parse_arguments(self):
+        """Populates arguments from the QUERY string and the body, which
+        might be form encoded or multipart.
+        """
+        self._arguments = {}
+        self._files = {}
 
         ### populate arguments with QUERY string
-        self.arguments = {}
         if 'QUERY' in self.headers:
             query = self.headers['QUERY']
             arguments = cgi.parse_qs(query.encode("utf-8"))
             for name, values in arguments.iteritems():
                 values = [v for v in values if v]
                 if values:
-                    self.arguments[name] = values
+                    self._arguments[name] = values
 
         ### handle data, multipart or not
         if self.method in ("POST", "PUT") and self.content_type:
@@ -57,68 +112,38 @@ class Request(object):
                 for name, values in arguments.iteritems():
                     values = [v for v in values if v]
                     if values:
-                        self.arguments.setdefault(name, []).extend(values)
+                        self._arguments.setdefault(name, []).extend(values)
             # Not ready for this, but soon
             elif self.content_type.startswith("multipart/form-data"):
                 fields = self.content_type.split(";")
                 for field in fields:
                     k, sep, v = field.strip().partition("=")
                     if k == "boundary" and v:
-                        self.arguments = {}
-                        self.files = {}
-                        self._parse_mime_body(v, self.body, self.arguments,
-                                              self.files)
+                        self._arguments = {}
+                        stream = self.open_body()
+                        try:
+                            self._parse_mime_body(v, stream, self._arguments,
+                                                  self._files)
+                        finally:
+                            stream.close()
                         break
                 else:
                     logging.warning("Invalid multipart/form-data")
 
-    def _parse_mime_body(self, boundary, data, arguments, files):
+    def _parse_mime_body(self, boundary, stream, arguments, files):
+        """Reads a multipart/form-data body from `stream` a chunk at a time.
+        File parts larger than `MULTIPART_SPOOL_SIZE` are spooled to disk.
+        """
         if boundary.startswith('"') and boundary.endswith('"'):
             boundary = boundary[1:-1]
-        if data.endswith("\r\n"):
-            footer_length = len(boundary) + 6 
-        else:
-            footer_length = len(boundary) + 4
-        data = str(data)
-        parts = data[:-footer_length].split("--" + str(boundary) + "\r\n")
-        for part in parts:
-            if not part:
-                continue
-            eoh = part.find("\r\n\r\n")
-            if eoh == -1: 
-                logging.warning("multipart/form-data missing headers")
-                continue
-            #headers = HTTPHeaders.parse(part[:eoh].decode("utf-8"))
-            header_string = part[:eoh].decode("utf-8")
-            headers = dict()
-            last_key = ''
-            for line in header_string.splitlines():
-                if line[0].isspace():
-                    # continuation of a multi-line header
-                    new_part = ' ' + line.lstrip()
-                    headers[last_key] += new_part
-                else:
-                    name, value = line.split(":", 1)
-                    last_key = "-".join([w.capitalize() for w in name.split("-")])
-                    headers[name] = value.strip()
-    
-            disp_header = headers.get("Content-Disposition", "") 
-            disposition, disp_params = self._parse_header(disp_header)
-            if disposition != "form-data" or not part.endswith("\r\n"):
-                logging.warning("Invalid multipart/form-data")
-                continue
-            value = part[eoh + 4:-2]
-            if not disp_params.get("name"):
-                logging.warning("multipart/form-data value missing name")
-                continue
-            name = disp_params["name"]
-            if disp_params.get("filename"):
-                ctype = headers.get("Content-Type", "application/unknown")
-                files.setdefault(name, []).append(dict(
-                    filename=disp_params["filename"], body=value,
-                    content_type=ctype))
-            else:
-                arguments.setdefault(name, []).append(value)
+        collector = _FormDataCollector(self, arguments, files)
+        parser = MultipartParser(str(boundary), collector)
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.feed(chunk)
+        parser.close()
 
     def _parseparam(self, s):
         while s[:1] == ';':
@@ -167,6 +192,17 @@ class Request(object):
     def remote_addr(self):
         return self.headers.get('x-forwarded-for')
 
+    def get_header(self, name, default=None):
+        """Returns the value of the request header `name`, given in lower
+        case as Mongrel2 sends them. WSGI environ names are tried too.
+        """
+        value = self.headers.get(name)
+        if value is None:
+            value = self.headers.get('HTTP_' + name.upper().replace('-', '_'))
+        if value is None:
+            return default
+        return value
+
     @property
     def cookies(self):
         """Lazy generation of cookies from request headers."""
@@ -185,15 +221,93 @@ class Request(object):
     def url(self):
         return self.url_parts.geturl()
 
+    @property
+    def body(self):
+        """The request body as a string. Bodies parsed off a zmq message are
+        kept as a view into the message until they are first read here.
+        Bodies Mongrel2 streamed to disk are read from its temp file.
+        """
+        if isinstance(self._body, buffer):
+            self._body = str(self._body)
+        if not self._body and self.upload_path:
+            with open(self.upload_path, 'rb') as upload:
+                self._body = upload.read()
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+
+    @property
+    def body_view(self):
+        """A read-only buffer over the request body that never copies it,
+        for handlers that stream or hash large uploads.
+        """
+        if isinstance(self._body, buffer):
+            return self._body
+        return buffer(self._body)
+
+    def open_body(self):
+        """Returns a file-like object for reading the request body. Bodies
+        Mongrel2 streamed to disk are read straight from its temp file rather
+        than being loaded into memory.
+        """
+        if not self._body and self.upload_path:
+            return open(self.upload_path, 'rb')
+        return StringIO(self.body_view)
+
+    ###
+    ### Mongrel2 async uploads
+    ###
+
+    def is_upload_start(self):
+        """True for the message Mongrel2 sends when it begins streaming a
+        large body to a temp file. The request arrives again, with
+        `x-mongrel2-upload-done` set, once the body is complete.
+        """
+        return ('x-mongrel2-upload-start' in self.headers and
+                'x-mongrel2-upload-done' not in self.headers)
+
+    @property
+    def upload_path(self):
+        """The temp file holding a body Mongrel2 finished streaming to disk,
+        or None. Mongrel2 names it relative to its chroot, so it is resolved
+        against `UPLOAD_DIR`. Paths that resolve outside `UPLOAD_DIR` are
+        refused, as the headers naming them could come from a client.
+        """
+        done = self.headers.get('x-mongrel2-upload-done')
+        if not done or not self.UPLOAD_DIR:
+            return None
+        if done != self.headers.get('x-mongrel2-upload-start'):
+            logging.warning('Mongrel2 upload headers do not match')
+            return None
+
+        upload_dir = os.path.realpath(self.UPLOAD_DIR)
+        path = os.path.realpath(os.path.join(upload_dir, done.lstrip('/')))
+        if not path.startswith(os.path.join(upload_dir, '')):
+            logging.warning('Mongrel2 upload outside UPLOAD_DIR: %s' % done)
+            return None
+        return path
+
     @staticmethod
     def parse_msg(msg):
         """Static method for constructing a Request instance out of a
         message read straight off a zmq socket.
+
+        The message is scanned by offset, so the only copies made are of the
+        small leading fields and the headers. The body stays a view into
+        `msg` until something reads `Request.body`.
         """
-        sender, conn_id, path, rest = msg.split(' ', 3)
-        headers, rest = parse_netstring(rest)
-        body, _ = parse_netstring(rest)
-        headers = json.loads(headers)
+        sender_end = msg.index(' ')
+        conn_id_end = msg.index(' ', sender_end + 1)
+        path_end = msg.index(' ', conn_id_end + 1)
+        sender = msg[:sender_end]
+        conn_id = msg[sender_end + 1:conn_id_end]
+
+        start, end, offset = netstring_bounds(msg, path_end + 1)
+        headers = json.loads(msg[start:end])
+        start, end, _ = netstring_bounds(msg, offset)
+        body = buffer(msg, start, end - start)
         # construct url from request
         scheme = headers.get('URL_SCHEME', 'http')
         netloc = headers.get('host')
@@ -294,3 +408,66 @@ class Request(object):
         if not args:
             return default
         return args[-1]
+
+
+class _FormDataCollector(object):
+    """Receives parts from a `MultipartParser` and files them into a request's
+    arguments and files.
+    """
+    def __init__(self, request, arguments, files):
+        self.request = request
+        self.arguments = arguments
+        self.files = files
+        self._part = None
+
+    def part_begin(self, header_string):
+        self._part = None
+        headers = dict()
+        last_key = ''
+        for line in header_string.decode("utf-8").splitlines():
+            if line[0].isspace():
+                # continuation of a multi-line header
+                new_part = ' ' + line.lstrip()
+                headers[last_key] += new_part
+            else:
+                name, value = line.split(":", 1)
+                last_key = "-".join([w.capitalize() for w in name.split("-")])
+                headers[last_key] = value.strip()
+
+        disp_header = headers.get("Content-Disposition", "")
+        disposition, disp_params = self.request._parse_header(disp_header)
+        if disposition != "form-data":
+            logging.warning("Invalid multipart/form-data")
+            return
+        if not disp_params.get("name"):
+            logging.warning("multipart/form-data value missing name")
+            return
+
+        name = disp_params["name"]
+        if disp_params.get("filename"):
+            ctype = headers.get("Content-Type", "application/unknown")
+            target = spooled_file(self.request.MULTIPART_SPOOL_SIZE)
+            self._part = (name, disp_params["filename"], ctype, target)
+        else:
+            self._part = (name, None, None, [])
+
+    def part_data(self, data):
+        if self._part is not None:
+            target = self._part[3]
+            if isinstance(target, list):
+                target.append(data)
+            else:
+                target.write(data)
+
+    def part_end(self):
+        if self._part is None:
+            return
+        (name, filename, ctype, target) = self._part
+        if filename is None:
+            self.arguments.setdefault(name, []).append(''.join(target))
+        else:
+            size = target.tell()
+            target.seek(0)
+            self.files.setdefault(name, []).append(
+                UploadedFile(filename, ctype, target, size))
+        self._part = None
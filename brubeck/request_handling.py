@@ -15,26 +15,46 @@ See github.com/j2labs/brubeck for more information.
 try:
     from gevent import monkey
     monkey.patch_all()
-    from gevent import pool
+    import gevent
+    from gevent import pool, event
 
     coro_pool = pool.Pool
+    coro_event = event.Event
 
     def coro_spawn(function, app, message, *a, **kw):
         app.pool.spawn(function, app, message, *a, **kw)
 
+    def coro_spawn_later(seconds, function, *a, **kw):
+        return gevent.spawn_later(seconds, function, *a, **kw)
+
+    def coro_pool_free(pool):
+        return pool.free_count()
+
     CORO_LIBRARY = 'gevent'
 
 ### Fallback to eventlet
 except ImportError:
     try:
         import eventlet
+        from eventlet import event
         eventlet.patcher.monkey_patch(all=True)
 
         coro_pool = eventlet.GreenPool
 
+        class coro_event(event.Event):
+            """eventlet's Event with gevent's `set` spelling."""
+            def set(self):
+                self.send()
+
         def coro_spawn(function, app, message, *a, **kw):
             app.pool.spawn_n(function, app, message, *a, **kw)
 
+        def coro_spawn_later(seconds, function, *a, **kw):
+            return eventlet.spawn_after(seconds, function, *a, **kw)
+
+        def coro_pool_free(pool):
+            return pool.free()
+
         CORO_LIBRARY = 'eventlet'
 
     except ImportError:
@@ -50,10 +70,14 @@ import inspect
 import Cookie
 import base64
 import hmac
+import hashlib
+import email.utils
 import cPickle as pickle
 from itertools import chain
 import os, sys
+import signal
 from request import Request, to_bytes, to_unicode
+from routing import RouteTrie, RouteCache
 
 from schematics.serialize import for_jsonschema, from_jsonschema
 
@@ -67,6 +91,7 @@ HTTP_METHODS = ['get', 'post', 'put', 'delete',
                 'head', 'options', 'trace', 'connect']
 
 HTTP_FORMAT = "HTTP/1.1 %(code)s %(status)s\r\n%(headers)s\r\n\r\n%(body)s"
+HTTP_HEAD_FORMAT = "HTTP/1.1 %s %s\r\n%s\r\n"
 
 
 class FourOhFourException(Exception):
@@ -87,19 +112,65 @@ def render(body, status_code, status_msg, headers):
     return payload
 
 
+def http_response_parts(body, code, status, headers):
+    """Renders arguments into the pieces of an HTTP response, the status
+    line and headers followed by the body, as byte strings. Joining them
+    gives the same result as `http_response`.
+
+    Connections that add their own framing can join their header and these
+    parts in one pass instead of copying an already joined response.
+    """
+    if body is None:
+        body = ''
+    elif not isinstance(body, str):
+        body = to_bytes(body)
+
+    ### A 304 has no body, and its length would describe the full response
+    if code != 304:
+        headers['Content-Length'] = len(body)
+    head = HTTP_HEAD_FORMAT % (code, status, ''.join(
+        ['%s: %s\r\n' % header for header in headers.iteritems()]))
+
+    return [to_bytes(head), body]
+
+
 def http_response(body, code, status, headers):
-    """Renders arguments into an HTTP response.
+    """Renders arguments into an HTTP response. The body is encoded once,
+    and its encoded length is the Content-Length.
     """
-    payload = {'code': code, 'status': status, 'body': body}
-    content_length = 0
-    if body is not None:
-        content_length = len(to_bytes(body))
+    (head, body) = http_response_parts(body, code, status, headers)
+    return head + body
 
-    headers['Content-Length'] = content_length
-    payload['headers'] = "\r\n".join('%s: %s' % (k, v)
-                                     for k, v in headers.items())
 
-    return HTTP_FORMAT % payload
+def is_not_modified(request, headers):
+    """True if `request` is a conditional GET or HEAD and the copy the
+    client has is still current, according to the ETag or Last-Modified
+    header in `headers`, the headers of the response.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+
+    if_none_match = request.get_header('if-none-match')
+    if if_none_match is not None:
+        etag = headers.get('ETag')
+        if etag is None:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        ### GET uses the weak comparison, so W/ prefixes don't matter
+        etag = etag.replace('W/', '', 1)
+        return etag in [tag.strip().replace('W/', '', 1)
+                        for tag in if_none_match.split(',')]
+
+    if_modified_since = request.get_header('if-modified-since')
+    last_modified = headers.get('Last-Modified')
+    if if_modified_since and last_modified:
+        since = email.utils.parsedate_tz(if_modified_since)
+        modified = email.utils.parsedate_tz(last_modified)
+        if since and modified:
+            return (email.utils.mktime_tz(modified) <=
+                    email.utils.mktime_tz(since))
+    return False
 
 def _lscmp(a, b):
     """Compares two strings in a cryptographically safe way
@@ -363,6 +434,7 @@ class WebMessageHandler(MessageHandler):
     _UPDATED_CODE = 200
     _CREATED_CODE = 201
     _MULTI_CODE = 207
+    _NOT_MODIFIED = 304
     _FAILED_CODE = 400
     _AUTH_FAILURE = 401
     _FORBIDDEN = 403
@@ -372,6 +444,7 @@ class WebMessageHandler(MessageHandler):
 
     _response_codes = {
         200: 'OK',
+        304: 'Not modified',
         400: 'Bad request',
         401: 'Authentication failed',
         403: 'Forbidden',
@@ -380,6 +453,17 @@ class WebMessageHandler(MessageHandler):
         500: 'Server error',
     }
 
+    # Opts GET responses into the application's response cache
+    cache_ttl = None
+    cache_tags = ()
+
+    # Computes an ETag from the body of GET responses that lack one
+    auto_etag = False
+
+    # Headers a 304 response repeats from the response it stands in for
+    _NOT_MODIFIED_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control',
+                             'Expires', 'Vary', 'Set-Cookie')
+
     ###
     ### Payload extension
     ###
@@ -401,6 +485,65 @@ class WebMessageHandler(MessageHandler):
         if headers is not None:
             self.headers = headers
 
+    def cache_response(self, ttl, tags=()):
+        """Lets the application's response cache keep this response for
+        `ttl` seconds. `tags` name groups of responses that can be dropped
+        together with `application.response_cache.invalidate`.
+        """
+        self.cache_ttl = ttl
+        self.cache_tags = tuple(tags)
+
+    ###
+    ### Conditional requests
+    ###
+
+    def set_etag(self, version):
+        """Sets a strong ETag built from `version`, a string that changes
+        whenever the response does. If it's set before rendering, conditional
+        requests are answered without rendering the body.
+        """
+        self.headers['ETag'] = '"%s"' % version
+
+    def set_last_modified(self, timestamp):
+        """Sets the Last-Modified header from a Unix timestamp.
+        """
+        self.headers['Last-Modified'] = email.utils.formatdate(timestamp,
+                                                               usegmt=True)
+
+    def is_not_modified(self):
+        """True if the request is a conditional GET or HEAD and the copy the
+        client has is still current, according to the ETag or Last-Modified
+        header set on this response.
+        """
+        return is_not_modified(self.message, self.headers)
+
+    def render_not_modified(self):
+        """Renders a 304 response carrying the response's validators.
+        """
+        self.set_status(self._NOT_MODIFIED)
+        headers = dict((k, v) for (k, v) in self.headers.items()
+                       if k in self._NOT_MODIFIED_HEADERS)
+        logging.info('%s %s %s (%s)' % (self._NOT_MODIFIED,
+                                        self.message.method,
+                                        self.message.path,
+                                        self.message.remote_addr))
+        return render('', self._NOT_MODIFIED, self.status_msg, headers)
+
+    def _conditional_response(self, status_code, body=None):
+        """Returns a 304 response if the request's validators match this
+        response, otherwise None. Given a `body`, a missing ETag is computed
+        from it first.
+        """
+        if status_code != 200:
+            return None
+        if (body is not None and self.auto_etag and
+                'ETag' not in self.headers and
+                self.message.method in ('GET', 'HEAD')):
+            self.set_etag(hashlib.md5(to_bytes(body)).hexdigest())
+        if self.is_not_modified():
+            return self.render_not_modified()
+        return None
+
     ###
     ### Supported HTTP request methods are mapped to these functions
     ###
@@ -549,6 +692,10 @@ class WebMessageHandler(MessageHandler):
 
         self.convert_cookies()
 
+        not_modified = self._conditional_response(status_code, self.body)
+        if not_modified is not None:
+            return not_modified
+
         response = render(self.body, status_code, self.status_msg, self.headers)
 
         logging.info('%s %s %s (%s)' % (status_code, self.message.method,
@@ -572,10 +719,30 @@ class JSONMessageHandler(WebMessageHandler):
 
         self.headers['Content-Type'] = 'application/json'
 
+        ### An ETag set by the handler can answer the request unserialized
+        not_modified = self._conditional_response(self.status_code)
+        if not_modified is not None:
+            return not_modified
+
         if hide_status and 'data' in self._payload:
-            body = json.dumps(self._payload['data'])
+            payload = self._payload['data']
         else:
-            body = json.dumps(self._payload)
+            payload = self._payload
+        body = json.dumps(payload)
+
+        if 'ETag' not in self.headers:
+            ### The timestamp changes on every response, so an automatic
+            ### ETag is computed from the rest of the payload
+            version = body
+            if (self.auto_etag and payload is self._payload and
+                    self._TIMESTAMP in payload):
+                version = json.dumps(dict(
+                    (key, value) for (key, value) in payload.iteritems()
+                    if key != self._TIMESTAMP), sort_keys=True)
+            not_modified = self._conditional_response(self.status_code,
+                                                      version)
+            if not_modified is not None:
+                return not_modified
 
         response = render(body, self.status_code, self.status_msg,
                           self.headers)
@@ -620,7 +787,8 @@ class Brubeck(object):
     def __init__(self, msg_conn=None, handler_tuples=None, pool=None,
                  no_handler=None, base_handler=None, template_loader=None,
                  log_level=logging.INFO, login_url=None, db_conn=None,
-                 cookie_secret=None, api_base_url=None,
+                 cookie_secret=None, api_base_url=None, route_cache_size=None,
+                 max_in_flight=None, shed_load=False, response_cache=None,
                  *args, **kwargs):
         """Brubeck is a class for managing connections to webservers. It
         supports Mongrel2 and WSGI while providing an asynchronous system for
@@ -649,6 +817,18 @@ class Brubeck(object):
         `db_conn` is a database connection to be shared in this process
 
         `cookie_secret` is a string to use for signing secure cookies.
+
+        `route_cache_size` enables an LRU cache of that many paths mapped to
+        their resolved route. Its counters are available as `route_cache`.
+
+        `max_in_flight` caps the number of messages handled at once. Once the
+        cap is reached, the connection stops reading messages until a handler
+        finishes, or answers them with a 503 right away if `shed_load` is set.
+        Brubeck sizes its own pool to match, so it can't be combined with
+        `pool`. Current load is available as `load_stats`.
+
+        `response_cache` can be a `caching.ResponseCache`, which answers GET
+        requests for cacheable responses without routing them.
         """
         # All output is sent via logging
         # (while i figure out how to do a good abstraction via zmq)
@@ -663,6 +843,15 @@ class Brubeck(object):
         else:
             raise ValueError('No web server connection provided.')
 
+        # Route resolution can be cached per path. The cache is dropped any
+        # time the routing table changes.
+        self.route_cache = None
+        if route_cache_size:
+            self.route_cache = RouteCache(route_cache_size)
+
+        # Rendered responses can be cached, which handlers opt into
+        self.response_cache = response_cache
+
         # Class based route lists should be handled this way.
         # It is also possible to use `add_route`, a decorator provided by a
         # brubeck instance, that can extend routing tables.
@@ -670,8 +859,20 @@ class Brubeck(object):
         if self.handler_tuples is not None:
             self.init_routes(handler_tuples)
 
+        # Concurrency can be bounded, in which case the pool is sized to match
+        self.max_in_flight = max_in_flight
+        self.shed_load = shed_load
+        self.in_flight = 0
+        self.recv_blocked = False
+        self.shed_count = 0
+
         # We can accept an existing pool or initialize a new pool
-        if pool is None:
+        if pool is not None and max_in_flight:
+            raise ValueError('max_in_flight sizes its own pool, so it cannot '
+                             'be used with pool')
+        elif pool is None and max_in_flight:
+            self.pool = coro_pool(max_in_flight)
+        elif pool is None:
             self.pool = coro_pool()
         elif callable(pool):
             self.pool = pool()
@@ -686,6 +887,9 @@ class Brubeck(object):
         # A database connection is optional. The var name is now in place
         self.db_conn = db_conn
 
+        # Functions called once the application stops taking messages
+        self.shutdown_hooks = list()
+
         # Login url is optional
         self.login_url = login_url
 
@@ -742,8 +946,12 @@ class Brubeck(object):
         """
         if not hasattr(self, '_routes'):
             self._routes = list()
+            self._route_trie = RouteTrie()
         regex = re.compile(pattern, re.UNICODE)
+        self._route_trie.add(len(self._routes), regex)
         self._routes.append((regex, kallable))
+        if getattr(self, 'route_cache', None) is not None:
+            self.route_cache.clear()
 
     def add_route(self, url_pattern, method=None):
         """A decorator to facilitate building routes wth callables. Can be
@@ -787,39 +995,64 @@ class Brubeck(object):
         If a function is used (eg with the decorating routing pattern) a
         closure is created around the two arguments. The return value of this
         call is a function ready to be executed in a follow up coroutine.
+
+        Only routes whose literal prefix matches the path are tried, in the
+        order they were added, so the first matching route still wins.
+        """
+        route = self.resolve_route(message.path)
+        if route is None:
+            return self.base_handler(self, message)
+
+        (kallable, url_args) = route
+        if inspect.isclass(kallable):
+            ### Handler classes must be instantiated
+            handler = kallable(self, message)
+            ### Attach url args to handler. Resolved routes may be cached, so
+            ### the handler gets its own copy.
+            if isinstance(url_args, dict):
+                url_args = dict(url_args)
+            handler._url_args = url_args
+        else:
+            ### Can't instantiate a function
+            if isinstance(url_args, dict):
+                ### if the value was optional and not included, filter
+                ### it out so the functions default takes priority
+                kwargs = dict((k, v) for k, v in url_args.items() if v)
+
+                handler = lambda: kallable(self, message, **kwargs)
+            else:
+                handler = lambda: kallable(self, message, *url_args)
+        return handler
+
+    def resolve_route(self, path):
+        """Finds the first route matching `path` and returns a two-tuple of
+        the route's callable and the url args extracted from the path, or
+        `None` if no route matches.
+
+        If the route cache is enabled, results are looked up there first.
         """
-        handler = None
-        for (regex, kallable) in self._routes:
-            url_check = regex.match(message.path)
+        cache = self.route_cache
+        if cache is not None:
+            route = cache.get(path)
+            if route is not RouteCache.MISSING:
+                return route
+
+        route = None
+        for index in self._route_trie.candidates(path):
+            (regex, kallable) = self._routes[index]
+            url_check = regex.match(path)
 
             if url_check:
                 ### `None` will fail, so we have to use at least an empty list
                 ### We should try to use named arguments first, and if they're
                 ### not present fall back to positional arguments
                 url_args = url_check.groupdict() or url_check.groups() or []
+                route = (kallable, url_args)
+                break
 
-                if inspect.isclass(kallable):
-                    ### Handler classes must be instantiated
-                    handler = kallable(self, message)
-                    ### Attach url args to handler
-                    handler._url_args = url_args
-                    return handler
-                else:
-                    ### Can't instantiate a function
-                    if isinstance(url_args, dict):
-                        ### if the value was optional and not included, filter
-                        ### it out so the functions default takes priority
-                        kwargs = dict((k, v) for k, v in url_args.items() if v)
-
-                        handler = lambda: kallable(self, message, **kwargs)
-                    else:
-                        handler = lambda: kallable(self, message, *url_args)
-                    return handler
-
-        if handler is None:
-            handler = self.base_handler(self, message)
-
-        return handler
+        if cache is not None:
+            cache.set(path, route)
+        return route
 
     def register_api(self, APIClass, prefix=None):
         model, model_name = APIClass.model, APIClass.model.__name__.lower()
@@ -841,6 +1074,31 @@ class Brubeck(object):
         JsonSchemaMessageHandler.add_model(model)
 
 
+    ###
+    ### Load management
+    ###
+
+    def at_capacity(self):
+        """True if `max_in_flight` is set and no handler slots are free.
+        """
+        return bool(self.max_in_flight) and coro_pool_free(self.pool) < 1
+
+    @property
+    def load_stats(self):
+        """Gauges for the messages currently being handled and whether the
+        receive loop is blocked on a full pool, and a count of messages
+        answered with a 503 because the application was at capacity.
+
+        At most one received message waits for a free handler. The rest stay
+        queued in the connection, where Brubeck can't count them.
+        """
+        return {
+            'max_in_flight': self.max_in_flight,
+            'in_flight': self.in_flight,
+            'recv_blocked': self.recv_blocked,
+            'shed': self.shed_count,
+        }
+
     ###
     ### Application running functions
     ###
@@ -852,15 +1110,47 @@ class Brubeck(object):
         mc = self.msg_conn
         mc.recv_forever_ever(self)
 
-    def run(self):
+    def add_shutdown_hook(self, hook):
+        """Registers a function, called without arguments, to run once
+        Brubeck stops taking messages. With workers, each worker runs the
+        hooks before it exits.
+        """
+        self.shutdown_hooks.append(hook)
+        return hook
+
+    def _stop_receiving(self, signum, frame):
+        self.msg_conn.stop_receiving()
+
+    def run_shutdown_hooks(self):
+        for hook in self.shutdown_hooks:
+            try:
+                hook()
+            except Exception:
+                logging.error('Shutdown hook %s failed' % hook, exc_info=True)
+
+    def run(self, workers=None, **supervisor_kwargs):
         """This method turns on the message handling system and puts Brubeck
         in a never ending loop waiting for messages.
 
         The loop is actually the eventlet scheduler. A goal of Brubeck is to
         help users avoid thinking about complex things like an event loop while
         still getting the goodness of asynchronous and nonblocking I/O.
+
+        Passing `workers` forks that many worker processes, each running the
+        loop, and supervises them from this process. Any other keywords are
+        passed to `workers.WorkerSupervisor`.
+
+        Without workers, SIGTERM stops the loop the way ctrl-c does, so the
+        shutdown hooks run either way.
         """
         greeting = 'Brubeck v%s online ]-----------------------------------'
         print greeting % version
 
-        self.recv_forever_ever()
+        if workers:
+            from workers import WorkerSupervisor
+            supervisor = WorkerSupervisor(self, workers, **supervisor_kwargs)
+            supervisor.run()
+        else:
+            signal.signal(signal.SIGTERM, self._stop_receiving)
+            self.recv_forever_ever()
+            self.run_shutdown_hooks()
@@ -0,0 +1,202 @@
+"""Routing tables for Brubeck.
+
+Routes are regular expressions applied with `re.match`, checked in the order
+they were added. Scanning every regex for every message gets expensive as the
+routing table grows, so each pattern is reduced to the literal prefix any match
+must begin with and stored in a character trie. A lookup walks the path down
+the trie once and only tries the regexes whose prefix the path actually has,
+still in the order they were added.
+
+Resolved routes can also be remembered per path in a bounded LRU cache, which
+skips the regexes entirely for paths seen recently.
+"""
+
+import re
+from collections import OrderedDict
+
+
+###
+### Pattern inspection
+###
+
+_REGEX_SPECIAL = frozenset('.^$*+?{}[]\\|()')
+_QUANTIFIERS = frozenset('*+?{')
+
+
+def _has_toplevel_alternation(pattern):
+    """Returns True if `pattern` has a `|` outside of any group or character
+    class, meaning no single prefix is shared by every match.
+    """
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            i += 2
+            continue
+        if in_class:
+            if char == ']':
+                in_class = False
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+def literal_prefix(regex):
+    """Takes a compiled regex and returns the longest literal string that
+    every `regex.match` success must begin with. An empty string is returned
+    when nothing can be guaranteed, which places the route at the trie's root.
+    """
+    pattern = regex.pattern
+    if regex.flags & (re.IGNORECASE | re.VERBOSE):
+        return ''
+    if _has_toplevel_alternation(pattern):
+        return ''
+
+    i = 0
+    if pattern.startswith('^'):
+        i = 1
+
+    chars = []
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                break  # \d, \w, backreferences, etc.
+            literal, width = pattern[i + 1], 2
+        elif char in _REGEX_SPECIAL:
+            break
+        else:
+            literal, width = char, 1
+
+        ### A quantified character is optional or repeated, so it can't be
+        ### part of the prefix
+        following = pattern[i + width:i + width + 1]
+        if following and following in _QUANTIFIERS:
+            break
+
+        chars.append(literal)
+        i += width
+
+    return ''.join(chars)
+
+
+###
+### Route trie
+###
+
+class _TrieNode(object):
+    __slots__ = ('children', 'routes')
+
+    def __init__(self):
+        self.children = {}
+        self.routes = []
+
+
+class RouteTrie(object):
+    """A character trie mapping literal route prefixes to the positions of
+    their routes in the routing table.
+    """
+    def __init__(self):
+        self._root = _TrieNode()
+
+    def add(self, index, regex):
+        """Stores the routing table position `index` under the literal prefix
+        of `regex`.
+        """
+        node = self._root
+        for char in literal_prefix(regex):
+            child = node.children.get(char)
+            if child is None:
+                child = _TrieNode()
+                node.children[char] = child
+            node = child
+        node.routes.append(index)
+
+    def candidates(self, path):
+        """Returns the positions of every route whose literal prefix is a
+        prefix of `path`, in the order the routes were added.
+        """
+        node = self._root
+        found = list(node.routes)
+        for char in path:
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.routes:
+                found.extend(node.routes)
+        found.sort()
+        return found
+
+
+###
+### Route resolution cache
+###
+
+class RouteCache(object):
+    """A bounded LRU cache mapping request paths to resolved routes. Paths
+    that matched no route are cached too, as `None`.
+
+    `hits`, `misses` and `evictions` count cache activity since creation and
+    are meant for sizing the cache against real traffic.
+    """
+    MISSING = object()
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError('RouteCache size must be at least 1')
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, path):
+        """Returns the route cached for `path` and marks it recently used, or
+        `RouteCache.MISSING` if there isn't one.
+        """
+        try:
+            route = self._entries.pop(path)
+        except KeyError:
+            self.misses += 1
+            return self.MISSING
+        self._entries[path] = route
+        self.hits += 1
+        return route
+
+    def set(self, path, route):
+        """Caches `route` for `path`, evicting the least recently used entry
+        if the cache is full.
+        """
+        if path in self._entries:
+            del self._entries[path]
+        elif len(self._entries) >= self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        self._entries[path] = route
+
+    def clear(self):
+        """Drops every cached route. Counters are preserved.
+        """
+        self._entries.clear()
+
+    @property
+    def stats(self):
+        return {
+            'size': self.size,
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,284 @@
+"""Running Brubeck as several worker processes.
+
+A Brubeck process runs its handlers as coroutines, so it uses a single core.
+`WorkerSupervisor` forks a number of workers that each run the application
+and keeps them running. Mongrel2 connections are load balanced by zmq since
+each worker connects its own pull socket, and WSGI workers share a listening
+socket bound by the master.
+
+The master responds to a few signals:
+
+  * SIGHUP starts a fresh set of workers, then gracefully stops the old ones.
+  * SIGTERM and SIGINT gracefully stop every worker, then the master.
+  * SIGUSR1 logs the combined stats last reported by the workers.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import signal
+import logging
+
+import ujson as json
+
+from request_handling import coro_spawn_later
+
+
+class WorkerSupervisor(object):
+    """Forks `workers` processes running `application`, restarts workers that
+    die and gathers the stats they report every `stats_interval` seconds.
+
+    Workers asked to stop finish their in-flight messages, waiting at most
+    `graceful_timeout` seconds.
+
+    A worker that dies within `MIN_UPTIME` seconds of starting is replaced
+    after a delay. The delay starts at `RESTART_DELAY` and doubles with each
+    such death, up to `MAX_RESTART_DELAY`, so a worker that can't start
+    isn't forked over and over.
+    """
+    POLL_INTERVAL = 0.5
+    MIN_UPTIME = 5
+    RESTART_DELAY = 0.5
+    MAX_RESTART_DELAY = 30
+
+    def __init__(self, application, workers, graceful_timeout=30,
+                 stats_interval=5):
+        self.application = application
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.stats_interval = stats_interval
+
+        self.worker_pids = set()
+        self.worker_stats = dict()
+        self._started_at = dict()  # pid => time it was forked
+        self._restart_delay = 0
+        self._restart_at = 0
+        self._retiring = dict()  # pid => time it was asked to stop
+        self._stats_fd = None
+        self._stats_buffer = ''
+        self._signals = list()
+        self._stopping = False
+
+    ###
+    ### Master process
+    ###
+
+    def run(self):
+        """Starts the workers and supervises them until told to stop.
+        """
+        read_fd, write_fd = os.pipe()
+        flags = fcntl.fcntl(read_fd, fcntl.F_GETFL)
+        fcntl.fcntl(read_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._stats_fd = read_fd
+        self._stats_write_fd = write_fd
+
+        self.application.msg_conn.prefork()
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                       signal.SIGUSR1):
+            signal.signal(signum, self._queue_signal)
+
+        logging.info('Master %s starting %s workers' % (os.getpid(),
+                                                         self.workers))
+        for i in range(self.workers):
+            self.spawn_worker()
+
+        while self.worker_pids or self._retiring:
+            self._handle_signals()
+            self._reap_workers()
+            self._kill_stragglers()
+            self._read_stats()
+            if not self._stopping:
+                self._replace_workers()
+            time.sleep(self.POLL_INTERVAL)
+
+        logging.info('Master %s going down' % os.getpid())
+
+    def spawn_worker(self):
+        """Forks a single worker. Never returns in the worker.
+        """
+        pid = os.fork()
+        if pid:
+            self.worker_pids.add(pid)
+            self._started_at[pid] = time.time()
+            return pid
+
+        try:
+            self._run_worker()
+        except Exception:
+            logging.exception('Worker %s failed' % os.getpid())
+            os._exit(1)
+        os._exit(0)
+
+    def reload(self):
+        """Replaces every worker with a new one. The old workers finish what
+        they are doing before exiting.
+        """
+        old_pids = set(self.worker_pids)
+        self.worker_pids = set()
+        for i in range(self.workers):
+            self.spawn_worker()
+        for pid in old_pids:
+            self._retire(pid)
+
+    def stop(self):
+        """Gracefully stops every worker. `run` returns once they exit.
+        """
+        self._stopping = True
+        for pid in list(self.worker_pids):
+            self._retire(pid)
+        self.worker_pids = set()
+
+    @property
+    def combined_stats(self):
+        """Sums the stats most recently reported by each live worker. Workers
+        only report counts and gauges, which can be summed, and no averages.
+        Summed, `recv_blocked` is the number of workers blocked on a full
+        pool.
+        """
+        combined = dict()
+        for stats in self.worker_stats.values():
+            for section, values in stats.items():
+                if not isinstance(values, dict):
+                    continue
+                totals = combined.setdefault(section, dict())
+                for key, value in values.items():
+                    if isinstance(value, (int, long, float)):
+                        totals[key] = totals.get(key, 0) + value
+        combined['workers'] = len(self.worker_stats)
+        return combined
+
+    def _queue_signal(self, signum, frame):
+        ### Only record the signal. It is acted on by the supervising loop.
+        self._signals.append(signum)
+
+    def _handle_signals(self):
+        while self._signals:
+            signum = self._signals.pop(0)
+            if signum == signal.SIGHUP:
+                logging.info('Reloading workers')
+                self.reload()
+            elif signum in (signal.SIGTERM, signal.SIGINT):
+                logging.info('Stopping workers')
+                self.stop()
+            elif signum == signal.SIGUSR1:
+                logging.info('Worker stats: %s' % self.combined_stats)
+
+    def _retire(self, pid):
+        self._retiring[pid] = time.time()
+        self._signal_worker(pid, signal.SIGTERM)
+
+    def _signal_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+
+            self.worker_stats.pop(pid, None)
+            started_at = self._started_at.pop(pid, None)
+            if pid in self._retiring:
+                del self._retiring[pid]
+            elif pid in self.worker_pids:
+                self.worker_pids.discard(pid)
+                logging.error('Worker %s died unexpectedly (status %s)' % (
+                    pid, status))
+                self._schedule_restart(started_at)
+
+    def _schedule_restart(self, started_at):
+        """Delays the next fork if the worker that died didn't get past
+        `MIN_UPTIME`, doubling the delay each time that happens.
+        """
+        now = time.time()
+        if started_at is not None and now - started_at >= self.MIN_UPTIME:
+            self._restart_delay = 0
+            return
+        self._restart_delay = min(
+            max(self._restart_delay * 2, self.RESTART_DELAY),
+            self.MAX_RESTART_DELAY)
+        self._restart_at = now + self._restart_delay
+        logging.warning('Restarting workers in %s seconds' %
+                        self._restart_delay)
+
+    def _replace_workers(self):
+        """Forks workers until there are `workers` of them, unless a restart
+        is being delayed.
+        """
+        if time.time() < self._restart_at:
+            return
+        while len(self.worker_pids) < self.workers:
+            self.spawn_worker()
+
+    def _kill_stragglers(self):
+        deadline = time.time() - self.graceful_timeout
+        for pid, retired_at in self._retiring.items():
+            if retired_at < deadline:
+                logging.warning('Killing worker %s' % pid)
+                self._signal_worker(pid, signal.SIGKILL)
+
+    def _read_stats(self):
+        while True:
+            try:
+                data = os.read(self._stats_fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not data:
+                break
+            self._stats_buffer += data
+
+        lines = self._stats_buffer.split('\n')
+        self._stats_buffer = lines.pop()
+        for line in lines:
+            report = json.loads(line)
+            if report['pid'] in self.worker_pids:
+                self.worker_stats[report['pid']] = report['stats']
+
+    ###
+    ### Worker process
+    ###
+
+    def _run_worker(self):
+        os.close(self._stats_fd)
+        for signum in (signal.SIGHUP, signal.SIGUSR1):
+            signal.signal(signum, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self._stop_worker)
+        signal.signal(signal.SIGINT, self._stop_worker)
+
+        application = self.application
+        application.msg_conn.postfork()
+        self._report_stats()
+
+        application.recv_forever_ever()
+
+        ### Let in-flight handlers finish before exiting
+        deadline = time.time() + self.graceful_timeout
+        while application.in_flight and time.time() < deadline:
+            time.sleep(0.1)
+        application.run_shutdown_hooks()
+
+    def _stop_worker(self, signum, frame):
+        self.application.msg_conn.stop_receiving()
+
+    def _report_stats(self):
+        """Writes this worker's stats to the master, then schedules the next
+        report.
+        """
+        stats = {'load': self.application.load_stats}
+        if self.application.route_cache is not None:
+            stats['route_cache'] = self.application.route_cache.stats
+        report = json.dumps({'pid': os.getpid(), 'stats': stats})
+        os.write(self._stats_write_fd, report + '\n')
+        coro_spawn_later(self.stats_interval, self._report_stats)
@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+
+import time
+import unittest
+
+import gevent
+import mock
+import ujson as json
+
+from brubeck.request_handling import Brubeck, WebMessageHandler
+from brubeck.connections import Request, Mongrel2Connection
+from brubeck.caching import (BaseCacheStore, LRUCacheStore, RedisCacheStore,
+                             TieredCacheStore, ResponseCache, Serializer,
+                             InvalidationChannel, cached)
+
+
+class TestSerializer(unittest.TestCase):
+    """
+    a test class for cache value serializers
+    """
+
+    VALUE = {'name': 'brubeck', 'tags': ['a', 'b'], 'count': 5}
+
+    def test_backends_round_trip(self):
+        for backend in Serializer.BACKENDS:
+            serializer = Serializer(backend)
+            data = serializer.dumps(self.VALUE)
+            self.assertEqual(data[0], Serializer.RAW)
+            self.assertEqual(serializer.loads(data), self.VALUE)
+
+    def test_compression_above_threshold(self):
+        serializer = Serializer('marshal', compress_threshold=100)
+        small = serializer.dumps('x' * 10)
+        large = serializer.dumps('x' * 1000)
+        self.assertEqual(small[0], Serializer.RAW)
+        self.assertEqual(large[0], Serializer.ZLIB)
+        self.assertTrue(len(large) < 100)
+        self.assertEqual(serializer.loads(large), 'x' * 1000)
+        ### Values stored under other settings still load
+        self.assertEqual(Serializer('marshal').loads(large), 'x' * 1000)
+
+    def test_bad_input(self):
+        self.assertRaises(ValueError, Serializer, 'yaml')
+        self.assertRaises(ValueError, Serializer().loads, '\xffdata')
+
+    def test_stores_use_serializer(self):
+        serializer = Serializer('ujson')
+        for store in (BaseCacheStore(serializer=serializer),
+                      LRUCacheStore(serializer=serializer)):
+            store.save('a', [1, 2])
+            self.assertEqual(store.load('a'), [1, 2])
+            self.assertEqual(store.load_many(['a', 'b']), [[1, 2], None])
+
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            store = RedisCacheStore(redis_connection=redis_connection,
+                                    serializer=serializer)
+            redis_connection.get.return_value = '\x00[1,2]'
+            store.save('a', [1, 2])
+            self.assertEqual(store.load('a'), [1, 2])
+            redis_connection.pipeline().set.assert_called_with('a', '\x00[1,2]')
+
+
+class TestExpiry(unittest.TestCase):
+    """
+    a test class for expiring items from the in-memory stores
+    """
+
+    def test_delete_expired_skips_resaved_keys(self):
+        store = BaseCacheStore()
+        store.save('a', 1, expire=time.time() - 1)
+        store.save('b', 2, expire=time.time() - 1)
+        store.save('b', 3, expire=time.time() + 60)
+        store.delete_expired()
+        self.assertEqual(store.load_many(['a', 'b']), [None, 3])
+        self.assertEqual(store.expirations, 1)
+
+    def test_sweeper_works_in_slices(self):
+        store = BaseCacheStore()
+        store.save_many([('old:%d' % i, i) for i in range(5000)],
+                        expire=time.time() - 1)
+        store.save('fresh', 1, expire=time.time() + 60)
+
+        store.start_expiry_sweeper(interval=0, slice_time=0.0001)
+        for i in range(100):
+            gevent.sleep(0.001)
+            if store.sweep_stats['sweeps']:
+                break
+        store.stop_expiry_sweeper()
+
+        stats = store.sweep_stats
+        self.assertEqual(stats['reclaimed'], 5000)
+        self.assertTrue(stats['slices'] > 1)
+        self.assertTrue(stats['keys_per_second'] > 0)
+        self.assertEqual(store.load('fresh'), 1)
+        self.assertEqual(len(store._cache_store), 1)
+
+    def test_slices_stay_within_budget_on_a_stale_heap(self):
+        store = BaseCacheStore()
+        later = time.time() + 60
+        for offset in range(3):
+            store.save_many([(i, i) for i in xrange(100000)],
+                            expire=later + offset)
+        store.save('old', 1, expire=time.time() - 1)
+
+        slices = 0
+        remaining = True
+        while remaining:
+            started = time.time()
+            (deleted, remaining) = store._expire_due(started, started + 0.002)
+            self.assertTrue(time.time() - started < 0.05)
+            slices += 1
+        self.assertTrue(slices > 1)
+        self.assertEqual(len(store._expiry_heap), 100000)
+        self.assertEqual(store.load('old'), None)
+        self.assertEqual(store.load(5), 5)
+
+    def test_lru_hides_expired_items_while_sweeping(self):
+        store = LRUCacheStore()
+        store.start_expiry_sweeper(interval=60)
+        store.save('a', 'x', expire=time.time() - 1)
+        self.assertEqual(store.load('a'), None)
+        self.assertEqual(store.stats['bytes'], 0)
+        store.stop_expiry_sweeper()
+
+
+class TestMultiKeyOperations(unittest.TestCase):
+    """
+    a test class for load_many, save_many and delete_many
+    """
+
+    def check_store(self, store):
+        store.save_many({'a': '1', 'b': '2'})
+        store.save_many([('c', '3')], expire=time.time() - 1)
+        self.assertEqual(store.load_many(['a', 'b', 'c', 'd']),
+                         ['1', '2', None, None])
+        store.delete_many(['a', 'c'])
+        self.assertEqual(store.load_many(['a', 'b']), [None, '2'])
+
+    def test_base_cache_store(self):
+        self.check_store(BaseCacheStore())
+
+    def test_lru_cache_store(self):
+        self.check_store(LRUCacheStore())
+
+    def test_redis_cache_store(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            store = RedisCacheStore(redis_connection=redis_connection)
+            store.load_many(['a', 'b'])
+            store.delete_many(['a', 'b'])
+            store.save_many([('a', '1'), ('b', '2')], expire=time.time() + 60)
+
+            expected = [('mget', (['a', 'b'],), {}),
+                        ('delete', ('a', 'b'), {}),
+                        ('pipeline', (), {}),
+                        ('pipeline().set', ('a', '1'), {}),
+                        ('pipeline().expire', ('a', 59), {}),
+                        ('pipeline().set', ('b', '2'), {}),
+                        ('pipeline().expire', ('b', 59), {}),
+                        ('pipeline().execute', (), {})]
+            self.assertEqual(expected, redis_connection.mock_calls)
+
+
+class TestLRUCacheStore(unittest.TestCase):
+    """
+    a test class for the bounded in-memory cache store
+    """
+
+    def test_save_load_delete(self):
+        store = LRUCacheStore()
+        store.save('foo', 'bar')
+        self.assertEqual(store.load('foo'), 'bar')
+        store.delete('foo')
+        self.assertEqual(store.load('foo'), None)
+        self.assertEqual(store.stats['hits'], 1)
+        self.assertEqual(store.stats['misses'], 1)
+
+    def test_evicts_least_recently_used(self):
+        store = LRUCacheStore(max_entries=2)
+        store.save('a', '1')
+        store.save('b', '2')
+        store.load('a')
+        store.save('c', '3')
+        self.assertEqual(store.load('b'), None)
+        self.assertEqual(store.load('a'), '1')
+        self.assertEqual(store.load('c'), '3')
+        self.assertEqual(store.evictions, 1)
+
+    def test_evicts_by_size(self):
+        store = LRUCacheStore(max_bytes=10)
+        store.save('a', 'x' * 6)
+        store.save('b', 'y' * 6)
+        self.assertEqual(store.load('a'), None)
+        self.assertEqual(store.total_bytes, 6)
+
+    def test_expired_items_are_removed(self):
+        store = LRUCacheStore()
+        store.save('old', 'data', expire=time.time() - 1)
+        store.save('new', 'data', expire=time.time() + 60)
+        self.assertEqual(store.load('old'), None)
+        self.assertEqual(store.load('new'), 'data')
+        self.assertEqual(store.expirations, 1)
+        self.assertEqual(len(store._cache_store), 1)
+
+    def test_resaving_replaces_expiry(self):
+        store = LRUCacheStore()
+        store.save('key', 'old', expire=time.time() + 0.01)
+        store.save('key', 'new')
+        time.sleep(0.02)
+        self.assertEqual(store.load('key'), 'new')
+        self.assertEqual(store.expirations, 0)
+
+
+class TestTieredCacheStore(unittest.TestCase):
+    """
+    a test class for the near cache in front of redis
+    """
+
+    def test_repeated_loads_stay_local(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            pipe = redis_connection.pipeline.return_value
+            pipe.execute.return_value = ['cached', 30]
+            store = TieredCacheStore(redis_connection=redis_connection)
+
+            self.assertEqual(store.load('key'), 'cached')
+            self.assertEqual(store.load('key'), 'cached')
+            self.assertEqual(pipe.execute.call_count, 1)
+            self.assertEqual(store.stats['hits'], 1)
+
+    def test_local_copies_are_not_shared(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            store = TieredCacheStore(redis_connection=redis_connection,
+                                     serializer=Serializer(backend='ujson'))
+            session = {'user': 'a'}
+            store.save('key', session)
+            session['user'] = 'x'
+            self.assertEqual(store.load('key'), {'user': 'a'})
+
+            store.load('key')['user'] = 'y'
+            self.assertEqual(store.load_many(['key']), [{'user': 'a'}])
+            pipe = redis_connection.pipeline.return_value
+            pipe.set.assert_called_once_with('key', '\x00{"user":"a"}')
+
+    def test_invalidation_messages(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            store = TieredCacheStore(redis_connection=redis_connection,
+                                     invalidation_channel='cache')
+            store.save('key', 'value')
+            redis_connection.publish.assert_called_with(
+                'cache', '%s key' % store.sender_id)
+
+            store.invalidate('%s key' % store.sender_id)
+            self.assertEqual(store.near_cache.load('key'), 'value')
+            store.invalidate('someone-else key')
+            self.assertEqual(store.near_cache.load('key'), None)
+
+    def test_invalidation_channel(self):
+        redis_connection = mock.Mock()
+        invalidated = []
+        channel = InvalidationChannel(redis_connection, 'cache',
+                                      invalidated.append)
+        channel.publish([])
+        self.assertFalse(redis_connection.publish.called)
+        channel.publish(['a', 'b'])
+        pipe = redis_connection.pipeline.return_value
+        self.assertEqual(pipe.publish.call_args_list, [
+            mock.call('cache', '%s a' % channel.sender_id),
+            mock.call('cache', '%s b' % channel.sender_id),
+        ])
+
+        channel.receive('%s a' % channel.sender_id)
+        channel.receive('elsewhere b')
+        self.assertEqual(invalidated, ['b'])
+
+        self.assertRaises(ValueError, InvalidationChannel, {}, 'cache',
+                          invalidated.append)
+        InvalidationChannel({}, None, invalidated.append).publish(['a'])
+
+
+class TestCachedDecorator(unittest.TestCase):
+    """
+    a test class for the single-flight memoization decorator
+    """
+
+    def setUp(self):
+        self.calls = 0
+
+    def slow_double(self, n):
+        self.calls += 1
+        gevent.sleep(0.01)
+        return n * 2
+
+    def test_concurrent_misses_share_one_call(self):
+        double = cached(LRUCacheStore())(self.slow_double)
+        greenlets = [gevent.spawn(double, 4) for i in range(5)]
+        gevent.joinall(greenlets)
+        self.assertEqual([g.value for g in greenlets], [8] * 5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(double(4), 8)
+        self.assertEqual(self.calls, 1)
+
+    def test_errors_reach_every_waiter(self):
+        @cached(LRUCacheStore())
+        def broken():
+            gevent.sleep(0.01)
+            raise ValueError('nope')
+        greenlets = [gevent.spawn(broken) for i in range(3)]
+        gevent.joinall(greenlets)
+        for g in greenlets:
+            self.assertTrue(isinstance(g.exception, ValueError))
+
+    def test_stale_while_revalidate(self):
+        double = cached(LRUCacheStore(), ttl=0.01, stale_ttl=10)(
+            self.slow_double)
+        self.assertEqual(double(1), 2)
+        time.sleep(0.02)
+        self.assertEqual(double(1), 2)  # stale value, refresh started
+        self.assertEqual(self.calls, 1)
+        gevent.sleep(0.05)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(double(1), 2)
+        self.assertEqual(self.calls, 2)
+
+    def test_methods_and_invalidate(self):
+        class Handler(object):
+            @cached(BaseCacheStore())
+            def lookup(self, uid):
+                calls.append(uid)
+                return uid.upper()
+        calls = []
+        self.assertEqual(Handler().lookup('a'), 'A')
+        self.assertEqual(Handler().lookup('a'), 'A')
+        self.assertEqual(calls, ['a'])
+        Handler.lookup.invalidate(Handler(), 'a')
+        Handler().lookup('a')
+        self.assertEqual(calls, ['a', 'a'])
+
+    def handler(self, handler_class, query='', cookie=None):
+        headers = {'PATH': '/users', 'METHOD': 'GET', 'QUERY': query}
+        if cookie is not None:
+            headers['cookie'] = cookie
+        headers = json.dumps(headers)
+        message = 'sender 5 /users %d:%s,0:,' % (len(headers), headers)
+        conn = Mongrel2Connection('ipc://127.0.0.1:9999', 'ipc://127.0.0.1:9998')
+        return handler_class(Brubeck(msg_conn=conn), Request.parse_msg(message))
+
+    def test_handler_methods_are_keyed_on_the_request(self):
+        calls = []
+
+        class UsersHandler(WebMessageHandler):
+            @cached(BaseCacheStore(), ttl=0.01, stale_ttl=10)
+            def lookup(self):
+                calls.append(self)
+                return (self.get_argument('page'), self.get_cookie('user'))
+
+        self.assertEqual(self.handler(UsersHandler, 'page=1').lookup(),
+                         ('1', None))
+        self.assertEqual(self.handler(UsersHandler, 'page=2').lookup(),
+                         ('2', None))
+        self.assertEqual(
+            self.handler(UsersHandler, 'page=1', 'user=a').lookup(),
+            ('1', 'a'))
+        self.assertEqual(
+            self.handler(UsersHandler, 'b=&page=1', 'user=a').lookup(),
+            ('1', 'a'))
+        self.assertEqual(len(calls), 4)
+        self.handler(UsersHandler, 'page=2').lookup()
+        self.handler(UsersHandler, 'page=1&b=', 'user=a').lookup()
+        self.assertEqual(len(calls), 4)
+
+        ### Stale values are recomputed by the handler asking for them
+        time.sleep(0.02)
+        handler = self.handler(UsersHandler, 'page=2')
+        self.assertEqual(handler.lookup(), ('2', None))
+        self.assertEqual(calls[-1], handler)
+        gevent.sleep(0.01)
+        self.assertEqual(len(calls), 5)
+
+
+class MockRequest(object):
+    """ we are enough of a request to build response cache keys """
+    def __init__(self, path='/', query='', method='GET', **headers):
+        self.path = path
+        self.method = method
+        self.headers = dict(headers, QUERY=query)
+
+    get_header = Request.get_header.im_func
+
+
+class TestResponseCache(unittest.TestCase):
+    """
+    a test class for the HTTP response cache
+    """
+
+    RESPONSE = 'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nhi'
+
+    def setUp(self):
+        self.cache = ResponseCache(LRUCacheStore(), vary=['accept'])
+
+    def test_key_normalizes_query_and_varies_on_headers(self):
+        key = self.cache.key_for(MockRequest('/a', 'b=2&a=1', accept='json'))
+        self.assertEqual(key, self.cache.key_for(
+            MockRequest('/a', 'a=1&b=2', HTTP_ACCEPT='json')))
+        self.assertNotEqual(key, self.cache.key_for(
+            MockRequest('/a', 'a=1&b=2', accept='html')))
+
+    def test_only_get_requests_are_served(self):
+        self.cache.save(MockRequest('/a'), self.RESPONSE, 60)
+        self.assertEqual(self.cache.load(MockRequest('/a')), self.RESPONSE)
+        self.assertEqual(self.cache.load(MockRequest('/a', method='POST')),
+                         None)
+
+    def test_invalidate_tags(self):
+        self.cache.save(MockRequest('/a'), self.RESPONSE, 60, tags=['x'])
+        self.cache.save(MockRequest('/b'), self.RESPONSE, 60, tags=['y'])
+        self.cache.invalidate('x')
+        self.assertEqual(self.cache.load(MockRequest('/a')), None)
+        self.assertEqual(self.cache.load(MockRequest('/b')), self.RESPONSE)
+
+    def test_cached_validators_answer_with_304(self):
+        response = ('HTTP/1.1 200 OK\r\nETag: "v1"\r\nContent-Length: 2'
+                    '\r\nContent-Type: text/plain\r\n\r\nhi')
+        self.cache.save(MockRequest('/a'), response, 60)
+
+        not_modified = self.cache.load(
+            MockRequest('/a', **{'if-none-match': '"v1"'}))
+        self.assertEqual(ResponseCache.split_response(not_modified),
+                         ('304 Not modified', [('ETag', '"v1"')], ''))
+        self.assertEqual(self.cache.load(
+            MockRequest('/a', HTTP_IF_NONE_MATCH='"v0"')), response)
+        self.assertEqual(self.cache.stats['not_modified'], 1)
+
+    def test_split_response(self):
+        self.assertEqual(ResponseCache.split_response(self.RESPONSE),
+                         ('200 OK', [('Content-Length', '2')], 'hi'))
+
+
+##
+## This will run our tests
+##
+if __name__ == '__main__':
+    unittest.main()
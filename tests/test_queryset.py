@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 
 import unittest
+import zlib
 
+import ujson as json
 import mock
+import gevent
+import redis
 
 import brubeck
 from handlers.method_handlers import simple_handler_method
 from brubeck.request_handling import Brubeck, WebMessageHandler, JSONMessageHandler
-from brubeck.connections import to_bytes, Request
+from brubeck.connections import to_bytes, Request, Mongrel2Connection
 from brubeck.request_handling import(
     cookie_encode, cookie_decode,
     cookie_is_encoded, http_response
@@ -21,6 +25,9 @@ from fixtures import request_handler_fixtures as FIXTURES
 
 from brubeck.autoapi import AutoAPIBase
 from brubeck.queryset import DictQueryset, AbstractQueryset, RedisQueryset
+from brubeck.queryset import WriteBehindQueryset, CachedQueryset
+from brubeck.queryset.dict import ColumnStore
+from brubeck.caching import Serializer
 
 from dictshield.document import Document
 from dictshield.fields import StringField
@@ -56,6 +63,495 @@ class TestQuerySetPrimitives(unittest.TestCase):
        pass
 
 
+class TestReadPage(unittest.TestCase):
+    """
+    a test class for cursor based paging through querysets
+    """
+
+    def test_offset_paging_fallback(self):
+        class ListQueryset(AbstractQueryset):
+            def read_all(self):
+                return [(self.MSG_OK, i) for i in range(5)]
+
+        queryset = ListQueryset()
+        self.assertEqual(queryset.read_page(None, 2),
+                         (2, [('OK', 0), ('OK', 1)]))
+        self.assertEqual(queryset.read_page(4, 2), (None, [('OK', 4)]))
+        self.assertEqual([datum for (status, datum) in queryset.iter_all(2)],
+                         range(5))
+
+    def test_dict_pages_follow_id_order(self):
+        queryset = DictQueryset()
+        for iid in ['c', 'a', 'd', 'b']:
+            queryset._store(iid, {'id': iid})
+        (cursor, page) = queryset.read_page(None, 2)
+        self.assertEqual(cursor, 'b')
+        self.assertEqual([datum['id'] for (status, datum) in page], ['a', 'b'])
+
+        ### Items removed behind the cursor don't shift later pages
+        queryset.destroy_one('a')
+        (cursor, page) = queryset.read_page(cursor, 2)
+        self.assertEqual(cursor, None)
+        self.assertEqual([datum['id'] for (status, datum) in page], ['c', 'd'])
+
+    def test_dict_writes_leave_sorting_to_read_page(self):
+        queryset = DictQueryset()
+        for iid in ['c', 'a']:
+            queryset._store(iid, {'id': iid})
+        self.assertEqual(queryset._sorted_ids, None)
+        (cursor, page) = queryset.read_page(None, 1)
+        self.assertEqual(cursor, 'a')
+
+        ### Updates keep the sorted ids, new items drop them
+        queryset._store('a', {'id': 'a', 'data': 'x'})
+        self.assertEqual(queryset._sorted_ids, ['a', 'c'])
+        queryset._store('b', {'id': 'b'})
+        self.assertEqual(queryset._sorted_ids, None)
+        (cursor, page) = queryset.read_page(cursor, 5)
+        self.assertEqual([datum['id'] for (status, datum) in page], ['b', 'c'])
+
+    def test_redis_pages_use_hscan(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            instance = patchedRedis.return_value
+            instance.hscan.side_effect = [(17, {'foo': '{"id": "foo"}'}),
+                                          (0, {'bar': '{"id": "bar"}'})]
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            queryset = RedisQueryset(db_conn=redis_connection)
+
+            self.assertEqual(queryset.read_page(None, 10),
+                             (17, [('OK', {'id': 'foo'})]))
+            self.assertEqual(queryset.read_page(17, 10),
+                             (None, [('OK', {'id': 'bar'})]))
+            instance.hscan.assert_called_with('id', 17, count=10)
+
+    def get_page(self, queryset, query, **request_headers):
+        class API(AutoAPIBase):
+            queries = queryset
+            model = TestDoc
+
+            def _make_presentable(self, datum):
+                return datum
+
+        conn = Mongrel2Connection('ipc://127.0.0.1:9999', 'ipc://127.0.0.1:9998')
+        headers = json.dumps(dict(request_headers, PATH='/todo/',
+                                  METHOD='GET', QUERY=query))
+        msg = 'sender 5 /todo/ %d:%s,0:,' % (len(headers), headers)
+        handler = API(Brubeck(msg_conn=conn), Request.parse_msg(msg))
+        response = handler()
+        self.response_headers = response['headers']
+        return (response['status_code'], json.loads(response['body'] or 'null'))
+
+    def test_autoapi_get_pages(self):
+        queryset = DictQueryset()
+        for iid in ['a', 'b', 'c']:
+            queryset._store(iid, {'id': iid})
+
+        (status, body) = self.get_page(queryset, 'count=2')
+        self.assertEqual(status, 200)
+        self.assertEqual(body['next_cursor'], 'b')
+        (status, body) = self.get_page(queryset, 'count=2&cursor=b')
+        self.assertEqual(body['next_cursor'], None)
+
+        ### A count below 1 reads a page of one
+        for count in ('0', '-1'):
+            (status, body) = self.get_page(queryset, 'count=' + count)
+            self.assertEqual(status, 200)
+            self.assertEqual(body['next_cursor'], 'a')
+
+    def test_autoapi_pages_carry_etags(self):
+        queryset = DictQueryset()
+        queryset._store('a', {'id': 'a'})
+        self.get_page(queryset, 'count=2')
+        etag = self.response_headers['ETag']
+
+        (status, body) = self.get_page(queryset, 'count=2',
+                                       **{'if-none-match': etag})
+        self.assertEqual(status, 304)
+        queryset._store('b', {'id': 'b'})
+        (status, body) = self.get_page(queryset, 'count=2',
+                                       **{'if-none-match': etag})
+        self.assertEqual(status, 200)
+        self.assertNotEqual(self.response_headers['ETag'], etag)
+
+    def test_autoapi_get_rejects_bad_cursors(self):
+        class ListQueryset(AbstractQueryset):
+            def read_all(self):
+                return [(self.MSG_OK, {'id': str(i)}) for i in range(5)]
+
+        for cursor in ('abc', '-2'):
+            (status, body) = self.get_page(ListQueryset(), 'cursor=' + cursor)
+            self.assertEqual(status, 400)
+
+        queryset = ListQueryset()
+        self.assertRaises(ValueError, queryset.read_page, None, 0)
+
+
+class TestSecondaryIndexes(unittest.TestCase):
+    """
+    a test class for looking items up through secondary indexes
+    """
+
+    INDEXES = {'owner_id': 'hash', 'created_at': 'range'}
+
+    def test_dict_indexes_follow_writes(self):
+        queryset = DictQueryset(indexes=self.INDEXES)
+        queryset._store('a', {'id': 'a', 'owner_id': 'x', 'created_at': 30})
+        queryset._store('b', {'id': 'b', 'owner_id': 'y', 'created_at': 10})
+        queryset._store('c', {'id': 'c', 'owner_id': 'x', 'created_at': 20})
+
+        ids = lambda results: [datum['id'] for (status, datum) in results]
+        self.assertEqual(ids(queryset.read_by('owner_id', 'x')), ['a', 'c'])
+        self.assertEqual(ids(queryset.read_range('created_at', 10, 20)),
+                         ['b', 'c'])
+
+        queryset._store('a', {'id': 'a', 'owner_id': 'y', 'created_at': 5})
+        queryset.destroy_one('c')
+        self.assertEqual(ids(queryset.read_by('owner_id', 'x')), [])
+        self.assertEqual(ids(queryset.read_by('owner_id', 'y')), ['a', 'b'])
+        self.assertEqual(ids(queryset.read_range('created_at', 0, 100)),
+                         ['a', 'b'])
+
+    def test_range_index_is_sorted_on_read(self):
+        queryset = DictQueryset(indexes=self.INDEXES)
+        for (iid, created_at) in [('a', 3), ('b', 1), ('c', 2)]:
+            queryset._store(iid, {'id': iid, 'created_at': created_at})
+        self.assertEqual(queryset._sorted_ranges, {})
+        ids = lambda results: [datum['id'] for (status, datum) in results]
+        self.assertEqual(ids(queryset.read_range('created_at', 2, 3)),
+                         ['c', 'a'])
+
+        queryset._store('b', {'id': 'b', 'created_at': 5})
+        self.assertEqual(queryset._sorted_ranges, {})
+        self.assertEqual(ids(queryset.read_range('created_at', 2, 9)),
+                         ['c', 'a', 'b'])
+
+    def test_unindexed_fields_are_rejected(self):
+        queryset = DictQueryset(indexes=self.INDEXES)
+        self.assertRaises(ValueError, queryset.read_by, 'created_at', 1)
+        self.assertRaises(ValueError, queryset.read_range, 'data', 1, 2)
+        self.assertRaises(ValueError, DictQueryset, indexes={'data': 'tree'})
+
+    def test_redis_indexes_share_the_pipeline(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            instance = patchedRedis.return_value
+            instance.pipeline = mock.Mock()
+            pipe_instance = instance.pipeline.return_value
+            pipe_instance.execute.return_value = [1]
+            pipe_instance.hmget.return_value = ['{"owner_id": "y"}']
+
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            queryset = RedisQueryset(db_conn=redis_connection,
+                                     indexes={'owner_id': 'hash'})
+            shield = mock.Mock()
+            shield.id = 'foo'
+            shield.owner_id = 'x'
+            shield.to_json.return_value = '{}'
+            queryset.create_one(shield)
+
+            self.assertEqual(pipe_instance.mock_calls[:8], [
+                mock.call.watch('id:indexed'),
+                mock.call.hmget('id:indexed', ['foo']),
+                mock.call.multi(),
+                mock.call.hset('id', 'foo', '{}'),
+                mock.call.srem('id:index:owner_id:y', 'foo'),
+                mock.call.sadd('id:index:owner_id:x', 'foo'),
+                mock.call.hset('id:indexed', 'foo', '{"owner_id":"x"}'),
+                mock.call.execute(),
+            ])
+
+            instance.smembers.return_value = set(['foo'])
+            pipe_instance.execute.return_value = ['{"id": "foo"}']
+            queryset.read_by('owner_id', 'x')
+            instance.smembers.assert_called_with('id:index:owner_id:x')
+            pipe_instance.hget.assert_called_with('id', 'foo')
+
+    def test_redis_index_updates_retry_interleaved_writes(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            instance = patchedRedis.return_value
+            instance.pipeline = mock.Mock()
+            pipe_instance = instance.pipeline.return_value
+
+            ### Another client moves foo to owner z between our HMGET and
+            ### EXEC, so the first transaction is dropped
+            pipe_instance.hmget.side_effect = [['{"owner_id": "y"}'],
+                                               ['{"owner_id": "z"}']]
+            pipe_instance.execute.side_effect = [redis.WatchError(), [1]]
+
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            queryset = RedisQueryset(db_conn=redis_connection,
+                                     indexes={'owner_id': 'hash'})
+            shield = mock.Mock()
+            shield.id = 'foo'
+            shield.owner_id = 'x'
+            shield.to_json.return_value = '{}'
+            self.assertEqual(queryset.update_one(shield),
+                             (queryset.MSG_CREATED, shield))
+
+            self.assertEqual(pipe_instance.execute.call_count, 2)
+            retried = pipe_instance.mock_calls[
+                pipe_instance.mock_calls.index(mock.call.reset()) + 1:]
+            self.assertEqual(retried[:8], [
+                mock.call.watch('id:indexed'),
+                mock.call.hmget('id:indexed', ['foo']),
+                mock.call.multi(),
+                mock.call.hset('id', 'foo', '{}'),
+                mock.call.srem('id:index:owner_id:z', 'foo'),
+                mock.call.sadd('id:index:owner_id:x', 'foo'),
+                mock.call.hset('id:indexed', 'foo', '{"owner_id":"x"}'),
+                mock.call.execute(),
+            ])
+
+    def test_redis_index_retries_are_capped(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            instance = patchedRedis.return_value
+            instance.pipeline = mock.Mock()
+            pipe_instance = instance.pipeline.return_value
+            pipe_instance.hmget.return_value = [None]
+            pipe_instance.execute.side_effect = redis.WatchError()
+
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            queryset = RedisQueryset(db_conn=redis_connection,
+                                     indexes={'owner_id': 'hash'})
+            shield = mock.Mock(id='foo', owner_id='x')
+            shield.to_json.return_value = '{}'
+            with mock.patch('time.sleep') as sleep:
+                self.assertRaises(redis.WatchError, queryset.update_one,
+                                  shield)
+            self.assertEqual(pipe_instance.execute.call_count,
+                             queryset.WATCH_RETRIES)
+            self.assertEqual(sleep.call_args_list[:2],
+                             [mock.call(0.001), mock.call(0.002)])
+
+
+class TestCompactStorage(unittest.TestCase):
+    """
+    a test class for the column store behind DictQueryset(compact=True)
+    """
+
+    def test_rows_round_trip(self):
+        queryset = DictQueryset(compact=True)
+        queryset._store('a', {'id': 'a', 'count': 3, 'score': 1.5})
+        queryset._store('b', {'id': 'b', 'count': 4, 'score': 2.5})
+        columns = queryset.db_conn._columns
+        self.assertEqual(columns['count'].typecode, 'l')
+        self.assertEqual(columns['score'].typecode, 'd')
+
+        self.assertEqual(queryset.read_one('a'),
+                         (queryset.MSG_OK, {'id': 'a', 'count': 3, 'score': 1.5}))
+        self.assertEqual(queryset.read_page(count=1), ('a', [
+            (queryset.MSG_OK, {'id': 'a', 'count': 3, 'score': 1.5})]))
+
+    def test_columns_fall_back_to_lists(self):
+        queryset = DictQueryset(compact=True)
+        queryset._store('a', {'id': 'a', 'count': 3})
+        queryset._store('b', {'id': 'b', 'count': 'many', 'tag': True})
+        queryset._store('c', {'id': 'c'})
+        self.assertTrue(isinstance(queryset.db_conn._columns['count'], list))
+        self.assertTrue(isinstance(queryset.db_conn._columns['tag'], list))
+        self.assertEqual(queryset.read_one('b')[1],
+                         {'id': 'b', 'count': 'many', 'tag': True})
+        self.assertEqual(queryset.read_one('c')[1], {'id': 'c'})
+
+    def test_overwrites_without_indexes_skip_the_old_row(self):
+        queryset = DictQueryset(compact=True)
+        queryset._store('a', {'id': 'a', 'count': 3})
+        with mock.patch.object(ColumnStore, '__getitem__') as getitem, \
+                mock.patch.object(ColumnStore, 'get') as get:
+            queryset._store('a', {'id': 'a', 'count': 4})
+        self.assertFalse(getitem.called or get.called)
+        self.assertEqual(queryset.read_one('a')[1], {'id': 'a', 'count': 4})
+
+    def test_destroyed_rows_are_reused(self):
+        queryset = DictQueryset(compact=True, indexes={'count': 'range'})
+        queryset._store('a', {'id': 'a', 'count': 3})
+        queryset._store('b', {'id': 'b', 'count': 4})
+        queryset.destroy_one('a')
+        queryset._store('c', {'id': 'c', 'count': 5})
+        self.assertEqual(queryset.db_conn._row_count, 2)
+        self.assertEqual(queryset.read_one('a'),
+                         (queryset.MSG_FAILED, 'a'))
+        self.assertEqual(
+            [datum['id'] for (status, datum) in queryset.read_range('count', 0, 9)],
+            ['b', 'c'])
+
+
+class TestWriteBehind(unittest.TestCase):
+    """
+    a test class for buffering writes with WriteBehindQueryset
+    """
+
+    class Item(object):
+        def __init__(self, id, value=None):
+            self.id = id
+            self.value = value
+
+    def setUp(self):
+        self.wrapped = mock.Mock(db_conn=None, api_id='id', indexes={})
+        self.queryset = WriteBehindQueryset(self.wrapped, flush_size=3,
+                                            flush_interval=60)
+
+    def tearDown(self):
+        if self.queryset._timer is not None:
+            self.queryset._timer.kill()
+
+    def test_writes_are_coalesced(self):
+        first = self.Item('a', 1)
+        second = self.Item('a', 2)
+        other = self.Item('b')
+        self.assertEqual(self.queryset.create_one(first),
+                         (self.queryset.MSG_CREATED, first))
+        self.queryset.update_one(second)
+        self.queryset.update_one(other)
+        self.queryset.destroy_one('c')
+        self.assertEqual(self.queryset.stats['pending'], 3)
+        self.assertFalse(self.wrapped.create_many.called)
+
+        self.queryset.flush()
+        self.wrapped.create_many.assert_called_once_with([second])
+        self.wrapped.update_many.assert_called_once_with([other])
+        self.wrapped.destroy_many.assert_called_once_with(['c'])
+
+        stats = self.queryset.stats
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['max_pending'], 3)
+        self.assertEqual(stats['coalesced'], 1)
+        self.assertEqual(stats['flushed'], 3)
+
+    def test_destroying_a_buffered_create_drops_it(self):
+        self.queryset.create_one(self.Item('a'))
+        self.queryset.update_one(self.Item('a', 2))
+        self.queryset.destroy_one('a')
+        self.assertEqual(self.queryset.stats['pending'], 0)
+
+        self.queryset.flush()
+        self.assertFalse(self.wrapped.create_many.called)
+        self.assertFalse(self.wrapped.destroy_many.called)
+
+    def test_full_buffer_flushes_in_background(self):
+        for iid in 'abcd':
+            self.queryset.update_one(self.Item(iid))
+        gevent.sleep(0.01)
+        self.assertEqual([len(c[0][0]) for c in
+                          self.wrapped.update_many.call_args_list], [3, 1])
+
+    def test_reads_of_pending_ids_flush(self):
+        self.queryset.update_one(self.Item('a'))
+        self.queryset.read_one('b')
+        self.assertFalse(self.wrapped.update_many.called)
+        self.queryset.read_many(['b', 'a'])
+        self.assertTrue(self.wrapped.update_many.called)
+        self.wrapped.read_many.assert_called_once_with(['b', 'a'])
+
+    def test_failed_writes_are_counted(self):
+        self.wrapped.destroy_many.side_effect = ValueError
+        self.queryset.destroy_one('a')
+        self.queryset.update_one(self.Item('b'))
+        self.queryset.close()
+        stats = self.queryset.stats
+        self.assertEqual((stats['flushed'], stats['failed']), (1, 1))
+        self.assertEqual(self.queryset._timer, None)
+
+
+class TestCachedQueryset(unittest.TestCase):
+    """
+    a test class for reading documents through CachedQueryset
+    """
+
+    def setUp(self):
+        self.wrapped = mock.Mock(db_conn=mock.Mock(), api_id='id', indexes={})
+        self.wrapped.read_one.side_effect = lambda iid: ('OK', {'id': iid})
+        self.wrapped.read_many.side_effect = lambda ids: [
+            ('OK', {'id': iid}) if iid != 'gone' else ('Failed', iid)
+            for iid in ids]
+        self.queryset = CachedQueryset(self.wrapped, max_entries=10,
+                                       invalidation_channel='docs')
+
+    def test_reads_are_cached(self):
+        self.assertEqual(self.queryset.read_one('a'), ('OK', {'id': 'a'}))
+        self.assertEqual(self.queryset.read_one('a'), ('OK', {'id': 'a'}))
+        self.assertEqual(self.wrapped.read_one.call_count, 1)
+
+        self.assertEqual(self.queryset.read_many(['a', 'b', 'gone']),
+                         [('OK', {'id': 'a'}), ('OK', {'id': 'b'}),
+                          ('Failed', 'gone')])
+        self.wrapped.read_many.assert_called_once_with(['b', 'gone'])
+        self.queryset.read_many(['b', 'gone'])
+        self.wrapped.read_many.assert_called_with(['gone'])
+        self.assertEqual(self.queryset.stats['entries'], 2)
+
+    def test_writes_invalidate_and_publish(self):
+        self.queryset.read_many(['a', 'b'])
+        shield = mock.Mock(id='a')
+        self.queryset.update_one(shield)
+        self.wrapped.update_one.assert_called_once_with(shield)
+        self.wrapped.db_conn.publish.assert_called_once_with(
+            'docs', '%s a' % self.queryset.sender_id)
+
+        self.queryset.read_one('a')
+        self.assertEqual(self.wrapped.read_one.call_count, 1)
+
+        self.queryset.invalidate('%s b' % self.queryset.sender_id)
+        self.queryset.invalidate('elsewhere a')
+        self.queryset.read_many(['a', 'b'])
+        self.wrapped.read_many.assert_called_with(['a'])
+        self.assertEqual(self.queryset.stats['invalidations'], 2)
+
+    def test_invalidation_needs_a_redis_connection(self):
+        queryset = DictQueryset()
+        self.assertRaises(ValueError, CachedQueryset, queryset,
+                          invalidation_channel='docs')
+        CachedQueryset(queryset)
+
+    def test_reads_racing_writes_are_not_cached(self):
+        def read_during_write(iid):
+            self.queryset.destroy_one(iid)
+            return ('OK', {'id': iid})
+        self.wrapped.read_one.side_effect = read_during_write
+        self.queryset.read_one('a')
+        self.assertEqual(self.queryset.stats['entries'], 0)
+
+
+class TestRedisCodecs(unittest.TestCase):
+    """
+    a test class for how RedisQueryset encodes stored values
+    """
+
+    def shield(self, data):
+        return mock.Mock(to_json=mock.Mock(return_value=json.dumps(data)))
+
+    def test_small_values_stay_json(self):
+        queryset = RedisQueryset(compress=True, compress_threshold=100)
+        value = queryset._setvalue(self.shield({'id': 'a'}))
+        self.assertEqual(value, '{"id":"a"}')
+        self.assertEqual(queryset._readvalue(value), {'id': 'a'})
+        self.assertEqual(queryset._readvalue(None), None)
+
+    def test_codecs_are_tagged(self):
+        data = {'id': 'a', 'text': 'x' * 1000}
+        for codec in RedisQueryset.CODECS:
+            queryset = RedisQueryset(compress=True, codec=codec)
+            value = queryset._setvalue(self.shield(data))
+            self.assertEqual(value[:1], RedisQueryset.CODECS[codec][0])
+            self.assertTrue(len(value) < 1000)
+            ### Any queryset reads any codec
+            self.assertEqual(RedisQueryset()._readvalue(value), data)
+
+    def test_codecs_are_shared_with_the_cache_serializer(self):
+        self.assertTrue(RedisQueryset.CODECS is Serializer.COMPRESSORS)
+        serializer = Serializer(backend='ujson', compress_threshold=0)
+        value = serializer.dumps({'id': 'a', 'text': 'x' * 1000})
+        self.assertEqual(value[:1], RedisQueryset.ZLIB)
+
+    def test_untagged_zlib_values_are_read(self):
+        value = zlib.compress('{"id":"a"}')
+        self.assertEqual(RedisQueryset(compress=True)._readvalue(value),
+                         {'id': 'a'})
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, RedisQueryset, compress=True,
+                          codec='bogus')
+
+
 class TestDictQueryset(unittest.TestCase):
     """
     a test class for brubeck's dictqueryset's operations.
@@ -218,8 +714,8 @@ class TestRedisQueryset(TestQuerySetPrimitives):
                 ('pipeline().hset', (queryset.api_id, 'bar', '{"_types": ["TestDoc"], "id": "bar", "_cls": "TestDoc"}'), {}),
                 ('pipeline().hset', (queryset.api_id, 'baz', '{"_types": ["TestDoc"], "id": "baz", "_cls": "TestDoc"}'), {}),
                 ('pipeline().execute', (), {}),
+                ('pipeline().reset', (), {}),
                 ('pipeline().execute().__iter__', (), {}),
-                ('pipeline().reset', (), {})
                 ]
             for call in zip(expected, redis_connection.mock_calls):
                 self.assertEqual(call[0], call[1])
@@ -337,7 +833,9 @@ class TestRedisQueryset(TestQuerySetPrimitives):
             pipe_instance = instance.pipeline.return_value
             shields = self.seed_reads()
             json_shields = [shield.to_json() for shield in shields]
-            results = json_shields
+            results = list()
+            for json_shield in json_shields:
+                results.extend([json_shield, 1])
             pipe_instance.execute.return_value = results
             
             redis_connection = patchedRedis(host='localhost', port=6379, db=0)
@@ -348,17 +846,35 @@ class TestRedisQueryset(TestQuerySetPrimitives):
 
             expected = [('pipeline', (), {}),
                         ('pipeline().hget', (queryset.api_id, 'foo'), {}),
-                        ('pipeline().hget', (queryset.api_id, 'bar'), {}),
-                        ('pipeline().hget', (queryset.api_id, 'baz'), {}),
-                        ('pipeline().execute', (), {}),
                         ('pipeline().hdel', (queryset.api_id, 'foo'), {}),
+                        ('pipeline().hget', (queryset.api_id, 'bar'), {}),
                         ('pipeline().hdel', (queryset.api_id, 'bar'), {}),
+                        ('pipeline().hget', (queryset.api_id, 'baz'), {}),
                         ('pipeline().hdel', (queryset.api_id, 'baz'), {}),
                         ('pipeline().execute', (), {}),
                         ('pipeline().reset', (), {})
                         ]
             for call in zip(expected, redis_connection.mock_calls):
                 self.assertEqual(call[0], call[1])
+            self.assertEqual(len(expected), len(redis_connection.mock_calls))
+
+    def test_chunked_pipelines(self):
+        with mock.patch('redis.StrictRedis') as patchedRedis:
+            instance = patchedRedis.return_value
+            instance.pipeline = mock.Mock()
+            pipe_instance = instance.pipeline.return_value
+            pipe_instance.execute.side_effect = [['{"n": 1}', '{"n": 2}'],
+                                                 [None]]
+
+            redis_connection = patchedRedis(host='localhost', port=6379, db=0)
+            queryset = RedisQueryset(db_conn=redis_connection, chunk_size=2)
+            results = queryset.iter_read_many(['a', 'b', 'c'])
+
+            self.assertEqual(next(results), (queryset.MSG_OK, {'n': 1}))
+            self.assertEqual(pipe_instance.execute.call_count, 1)
+            self.assertEqual(list(results), [(queryset.MSG_OK, {'n': 2}),
+                                             (queryset.MSG_FAILED, None)])
+            self.assertEqual(pipe_instance.execute.call_count, 2)
 
 ##
 ## This will run our tests
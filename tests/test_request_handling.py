@@ -2,10 +2,21 @@
 
 import unittest
 import sys
+import os
+import json
+import signal
+import shutil
+import tempfile
+import mock
+import gevent
+import gevent.event
+import gevent.pool
 import brubeck
 from handlers.method_handlers import simple_handler_method
 from brubeck.request_handling import Brubeck, WebMessageHandler, JSONMessageHandler
-from brubeck.connections import to_bytes, Request, WSGIConnection
+from brubeck.caching import LRUCacheStore, ResponseCache
+from brubeck.connections import (to_bytes, Request, WSGIConnection,
+                                 Mongrel2Connection, load_zmq)
 from brubeck.request_handling import(
     cookie_encode, cookie_decode,
     cookie_is_encoded, http_response
@@ -146,6 +157,206 @@ class TestRequestHandling(unittest.TestCase):
         decoded_cookie_value = cookie_decode(encoded_cookie, cookie_key)
         self.assertEqual(decoded_cookie_value, cookie_value)
     
+    def test_parse_msg_body_view(self):
+        headers = '{"PATH":"/","METHOD":"POST","VERSION":"HTTP/1.1"}'
+        msg = 'sender 5 / %d:%s,11:hello world,' % (len(headers), headers)
+        request = Request.parse_msg(msg)
+        self.assertEqual(request.headers['METHOD'], 'POST')
+        self.assertEqual(str(request.body_view), 'hello world')
+        self.assertEqual(request.body, 'hello world')
+        self.assertEqual(request.conn_id, '5')
+
+    def test_arguments_parsed_lazily(self):
+        headers = '{"PATH":"/","METHOD":"GET","QUERY":"name=brubeck"}'
+        msg = 'sender 5 / %d:%s,0:,' % (len(headers), headers)
+        request = Request.parse_msg(msg)
+        self.assertFalse(hasattr(request, '_arguments'))
+        self.assertEqual(request.get_argument('name'), u'brubeck')
+        self.assertEqual(request.files, {})
+        self.assertEqual(request.data, {})
+
+    def test_multipart_body_spools_large_files(self):
+        body = ('--XyZ\r\n'
+                'Content-Disposition: form-data; name="a"\r\n\r\n'
+                'value a\r\n'
+                '--XyZ\r\n'
+                'Content-Disposition: form-data; name="f"; filename="f.txt"\r\n'
+                'Content-Type: text/plain\r\n\r\n'
+                + 'Q' * 5000 + '\r\n--XyZ--\r\n')
+        headers = ('{"PATH":"/","METHOD":"POST",'
+                   '"content-type":"multipart/form-data; boundary=XyZ"}')
+        msg = 'sender 5 / %d:%s,%d:%s,' % (len(headers), headers,
+                                          len(body), body)
+        request = Request.parse_msg(msg)
+        request.MULTIPART_SPOOL_SIZE = 1024
+        self.assertEqual(request.get_argument('a'), u'value a')
+        upload = request.files['f'][0]
+        self.assertEqual(upload['filename'], 'f.txt')
+        self.assertEqual(upload.content_type, 'text/plain')
+        self.assertEqual(upload.size, 5000)
+        self.assertEqual(upload.read(), 'Q' * 5000)
+
+    def upload_request(self, path):
+        headers = json.dumps({'PATH': '/', 'METHOD': 'POST',
+                              'x-mongrel2-upload-start': path,
+                              'x-mongrel2-upload-done': path})
+        msg = 'sender 5 / %d:%s,0:,' % (len(headers), headers)
+        return Request.parse_msg(msg)
+
+    def test_upload_read_from_upload_dir(self):
+        upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_dir)
+        os.mkdir(os.path.join(upload_dir, 'tmp'))
+        with open(os.path.join(upload_dir, 'tmp', 'upload.1'), 'w') as f:
+            f.write('streamed body')
+
+        request = self.upload_request('/tmp/upload.1')
+        self.assertEqual(request.body, '')
+        with mock.patch.object(Request, 'UPLOAD_DIR', upload_dir):
+            request = self.upload_request('/tmp/upload.1')
+            self.assertEqual(request.body, 'streamed body')
+
+    def test_forged_upload_headers_are_refused(self):
+        upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_dir)
+        with mock.patch.object(Request, 'UPLOAD_DIR', upload_dir):
+            for path in ('/../../../../etc/passwd', '../etc/passwd'):
+                request = self.upload_request(path)
+                self.assertEqual(request.upload_path, None)
+                self.assertEqual(request.body, '')
+
+    def test_shed_load_at_capacity(self):
+        conn = Mongrel2Connection('ipc://127.0.0.1:9999', 'ipc://127.0.0.1:9998')
+        conn.out_sock = mock.Mock()
+        app = Brubeck(msg_conn=conn, max_in_flight=1, shed_load=True)
+        app.add_route_rule('^/$', SimpleWebHandlerObject)
+
+        app.pool.spawn(lambda: None)  # occupy the only handler slot
+        self.assertTrue(app.at_capacity())
+        conn.shed_message(app, FIXTURES.HTTP_REQUEST_ROOT)
+
+        sent = conn.out_sock.send.call_args[0][0]
+        self.assertTrue('HTTP/1.1 503 Service Unavailable' in sent)
+        self.assertEqual(app.load_stats['shed'], 1)
+
+    def test_recv_blocks_while_pool_is_full(self):
+        conn = Mongrel2Connection('ipc://127.0.0.1:9999', 'ipc://127.0.0.1:9998')
+        zmq = load_zmq()
+        conn.recv = mock.Mock(side_effect=[FIXTURES.HTTP_REQUEST_ROOT,
+                                           FIXTURES.HTTP_REQUEST_ROOT,
+                                           zmq.ZMQError()])
+        conn.process_message = mock.Mock()
+        app = Brubeck(msg_conn=conn, max_in_flight=1)
+
+        release = gevent.event.Event()
+        app.pool.spawn(release.wait)  # occupy the only handler slot
+        receiving = gevent.spawn(conn.recv_forever_ever, app)
+        gevent.sleep(0.01)
+        self.assertEqual(conn.recv.call_count, 1)
+        self.assertTrue(app.load_stats['recv_blocked'])
+        self.assertFalse(conn.process_message.called)
+
+        conn.stop_receiving()  # the third recv ends the loop
+        release.set()
+        receiving.join(timeout=1)
+        self.assertTrue(receiving.successful())
+        self.assertEqual(conn.process_message.call_count, 2)
+        self.assertFalse(app.load_stats['recv_blocked'])
+
+    def test_max_in_flight_needs_its_own_pool(self):
+        conn = Mongrel2Connection('ipc://127.0.0.1:9999', 'ipc://127.0.0.1:9998')
+        self.assertRaises(ValueError, Brubeck, msg_conn=conn,
+                          pool=gevent.pool.Pool, max_in_flight=1)
+
+    def test_sigterm_stops_the_loop_and_runs_shutdown_hooks(self):
+        conn = Mongrel2Connection('ipc://127.0.0.1:9999', 'ipc://127.0.0.1:9998')
+        app = Brubeck(msg_conn=conn)
+        hook = app.add_shutdown_hook(mock.Mock())
+        self.addCleanup(signal.signal, signal.SIGTERM,
+                        signal.getsignal(signal.SIGTERM))
+
+        def receive(application):
+            os.kill(os.getpid(), signal.SIGTERM)
+            self.assertFalse(hook.called)
+
+        with mock.patch.object(conn, 'recv_forever_ever', side_effect=receive), \
+                mock.patch.object(conn, 'stop_receiving') as stop_receiving:
+            app.run()
+        stop_receiving.assert_called_once_with()
+        hook.assert_called_once_with()
+
+    def test_response_cache_skips_handlers(self):
+        conn = Mongrel2Connection('ipc://127.0.0.1:9999', 'ipc://127.0.0.1:9998')
+        conn.out_sock = mock.Mock()
+        cache = ResponseCache(LRUCacheStore())
+        app = Brubeck(msg_conn=conn, response_cache=cache)
+
+        class CachedHandler(SimpleWebHandlerObject):
+            calls = 0
+            cache_ttl = 60
+
+            def get(self):
+                CachedHandler.calls += 1
+                return super(CachedHandler, self).get()
+
+        app.add_route_rule('^/$', CachedHandler)
+        conn.process_message(app, FIXTURES.HTTP_REQUEST_ROOT)
+        conn.process_message(app, FIXTURES.HTTP_REQUEST_ROOT)
+
+        self.assertEqual(CachedHandler.calls, 1)
+        self.assertEqual(cache.stats['hits'], 1)
+        (first, second) = [c[0][0] for c in conn.out_sock.send.call_args_list]
+        self.assertEqual(first, second)
+
+    def conditional_request(self, **headers):
+        request = Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT)
+        request.headers.update(headers)
+        return route_message(self.app, request)
+
+    def test_etag_set_up_front_skips_serializing(self):
+        class VersionedHandler(JSONMessageHandler):
+            def get(self):
+                self.set_etag('v1')
+                self.add_to_payload('data', 'payload')
+                return self.render(status_code=200)
+
+        self.app.add_route_rule(r'^/$', VersionedHandler)
+        with mock.patch('brubeck.request_handling.json.dumps') as dumps:
+            result = self.conditional_request(**{'if-none-match': '"v1"'})
+            self.assertEqual(dumps.call_count, 0)
+        self.assertEqual(result['status_code'], 304)
+        self.assertEqual(result['body'], '')
+        self.assertEqual(result['headers'], {'ETag': '"v1"'})
+
+        result = self.conditional_request(**{'if-none-match': '"v0"'})
+        self.assertEqual(result['status_code'], 200)
+
+    def test_auto_etag_and_last_modified(self):
+        class DatedHandler(SimpleWebHandlerObject):
+            auto_etag = True
+
+            def get(self):
+                self.set_last_modified(1320456118)
+                return super(DatedHandler, self).get()
+
+        self.app.add_route_rule(r'^/$', DatedHandler)
+        result = self.conditional_request()
+        etag = result['headers']['ETag']
+        self.assertEqual(result['status_code'], 200)
+
+        result = self.conditional_request(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(result['status_code'], 304)
+        response = http_response(result['body'], result['status_code'],
+                                 result['status_msg'], result['headers'])
+        self.assertFalse('Content-Length' in response)
+
+        result = self.conditional_request(**{
+            'if-modified-since': 'Sat, 05 Nov 2011 01:21:58 GMT'})
+        self.assertEqual(result['status_code'], 304)
+        result = self.conditional_request(**{
+            'if-modified-since': 'Sat, 05 Nov 2011 01:21:57 GMT'})
+        self.assertEqual(result['status_code'], 200)
+
     ##
     ## test a bunch of very simple requests making sure we get the expected results
     ##
@@ -188,6 +399,13 @@ class TestRequestHandling(unittest.TestCase):
         response = http_response(FIXTURES.TEST_BODY_OBJECT_HANDLER, 200, 'OK', dict())
         self.assertEqual(FIXTURES.HTTP_RESPONSE_OBJECT_ROOT, response)
 
+    def test_http_response_encodes_body_once(self):
+        response = http_response(u'caf\xe9', 200, 'OK', dict())
+        self.assertEqual(response, 'HTTP/1.1 200 OK\r\nContent-Length: 5'
+                                   '\r\n\r\ncaf\xc3\xa9')
+        response = http_response(None, 304, 'Not Modified', dict())
+        self.assertEqual(response, 'HTTP/1.1 304 Not Modified\r\n\r\n')
+
     def test_handler_initialize_hook(self):
         ## create a handler that sets the expected body(and headers) in the initialize hook
         handler = InitializeHookWebHandlerObject(self.app, Request.parse_msg(FIXTURES.HTTP_REQUEST_ROOT))
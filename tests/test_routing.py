@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import re
+import unittest
+
+from brubeck.routing import literal_prefix, RouteTrie, RouteCache
+from brubeck.request_handling import Brubeck, WebMessageHandler
+from brubeck.connections import WSGIConnection
+
+
+class MockMessage(object):
+    """ we are enough of a message to test routing rules message """
+    def __init__(self, path='/'):
+        self.path = path
+
+
+class FirstHandler(WebMessageHandler):
+    pass
+
+
+class SecondHandler(WebMessageHandler):
+    pass
+
+
+class TestLiteralPrefix(unittest.TestCase):
+    """
+    a test class for extracting literal prefixes from route patterns
+    """
+
+    def prefix(self, pattern, flags=re.UNICODE):
+        return literal_prefix(re.compile(pattern, flags))
+
+    def test_plain_literals(self):
+        self.assertEqual(self.prefix(r'^/brubeck$'), '/brubeck')
+        self.assertEqual(self.prefix(r'/brubeck'), '/brubeck')
+
+    def test_stops_at_dynamic_segments(self):
+        self.assertEqual(self.prefix(r'^/user/(?P<uid>\d+)$'), '/user/')
+        self.assertEqual(self.prefix(r'^/files/.*'), '/files/')
+        self.assertEqual(self.prefix(r'^/\d+'), '/')
+
+    def test_escaped_literals(self):
+        self.assertEqual(self.prefix(r'^/feed\.json'), '/feed.json')
+
+    def test_quantified_characters_are_dropped(self):
+        self.assertEqual(self.prefix(r'^/items?/'), '/item')
+        self.assertEqual(self.prefix(r'^/a\.?b'), '/a')
+
+    def test_unsafe_patterns_have_no_prefix(self):
+        self.assertEqual(self.prefix(r'^/a|/b'), '')
+        self.assertEqual(self.prefix(r'^/a', re.IGNORECASE), '')
+        self.assertEqual(self.prefix(r'(?i)/a'), '')
+        self.assertEqual(self.prefix(r'^/(a|b)'), '/')
+
+
+class TestRouteTrie(unittest.TestCase):
+    """
+    a test class for the route trie used by `Brubeck.route_message`
+    """
+
+    def setUp(self):
+        self.trie = RouteTrie()
+        patterns = [r'^/$', r'^/api/(?P<ids>.*)', r'^/api/user', r'^/(?P<x>.*)']
+        for index, pattern in enumerate(patterns):
+            self.trie.add(index, re.compile(pattern))
+
+    def test_candidates_preserve_order(self):
+        self.assertEqual(self.trie.candidates('/api/user'), [0, 1, 2, 3])
+        self.assertEqual(self.trie.candidates('/other'), [0, 3])
+        self.assertEqual(self.trie.candidates('nope'), [])
+
+
+class TestRouteMessage(unittest.TestCase):
+    """
+    a test class for routing behaviour on a Brubeck instance
+    """
+
+    def setUp(self):
+        self.app = Brubeck(msg_conn=WSGIConnection())
+
+    def test_first_match_wins(self):
+        self.app.add_route_rule(r'^/api/(?P<ids>.*)', FirstHandler)
+        self.app.add_route_rule(r'^/api/user$', SecondHandler)
+        handler = self.app.route_message(MockMessage('/api/user'))
+        self.assertTrue(isinstance(handler, FirstHandler))
+        self.assertEqual(handler._url_args, {'ids': 'user'})
+
+    def test_positional_url_args(self):
+        self.app.add_route_rule(r'^/(\d+)/(\d+)$', FirstHandler)
+        handler = self.app.route_message(MockMessage('/10/20'))
+        self.assertEqual(handler._url_args, ('10', '20'))
+
+    def test_unmatched_path_uses_base_handler(self):
+        self.app.add_route_rule(r'^/api/user$', FirstHandler)
+        handler = self.app.route_message(MockMessage('/api/users/1'))
+        self.assertEqual(type(handler), WebMessageHandler)
+
+
+class TestRouteCache(unittest.TestCase):
+    """
+    a test class for the LRU route resolution cache
+    """
+
+    def test_lru_eviction(self):
+        cache = RouteCache(2)
+        cache.set('/a', 'a')
+        cache.set('/b', 'b')
+        self.assertEqual(cache.get('/a'), 'a')
+        cache.set('/c', 'c')
+        self.assertEqual(cache.get('/b'), RouteCache.MISSING)
+        self.assertEqual(cache.get('/c'), 'c')
+        self.assertEqual(cache.stats['hits'], 2)
+        self.assertEqual(cache.stats['misses'], 1)
+        self.assertEqual(cache.stats['evictions'], 1)
+
+    def test_brubeck_caches_resolution(self):
+        app = Brubeck(msg_conn=WSGIConnection(), route_cache_size=10)
+        app.add_route_rule(r'^/api/(?P<ids>.*)', FirstHandler)
+        app.route_message(MockMessage('/api/1'))
+        handler = app.route_message(MockMessage('/api/1'))
+        self.assertTrue(isinstance(handler, FirstHandler))
+        self.assertEqual(handler._url_args, {'ids': '1'})
+        self.assertEqual(app.route_cache.hits, 1)
+        self.assertEqual(app.route_cache.misses, 1)
+
+    def test_add_route_rule_clears_cache(self):
+        app = Brubeck(msg_conn=WSGIConnection(), route_cache_size=10)
+        app.add_route_rule(r'^/api/user$', FirstHandler)
+        handler = app.route_message(MockMessage('/other'))
+        self.assertEqual(type(handler), WebMessageHandler)
+        app.add_route_rule(r'^/other$', SecondHandler)
+        self.assertEqual(len(app.route_cache), 0)
+        handler = app.route_message(MockMessage('/other'))
+        self.assertTrue(isinstance(handler, SecondHandler))
+
+
+##
+## This will run our tests
+##
+if __name__ == '__main__':
+    unittest.main()
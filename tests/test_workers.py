@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import os
+import fcntl
+import itertools
+import unittest
+
+import mock
+import ujson as json
+
+from brubeck.workers import WorkerSupervisor
+
+
+class TestWorkerSupervisor(unittest.TestCase):
+    """
+    a test class for the worker supervisor's bookkeeping in the master
+    """
+
+    def setUp(self):
+        self.supervisor = WorkerSupervisor(mock.Mock(), 2)
+
+    def spawn(self, pid, started_at):
+        self.supervisor.worker_pids.add(pid)
+        self.supervisor._started_at[pid] = started_at
+
+    def reap(self, *exits):
+        waitpid = mock.Mock(side_effect=list(exits) + [(0, 0)])
+        with mock.patch('os.waitpid', waitpid):
+            self.supervisor._reap_workers()
+
+    def test_retired_workers_are_not_restarted(self):
+        supervisor = self.supervisor
+        supervisor._retiring[10] = 0
+        self.spawn(11, 0)
+        self.spawn(12, 0)
+        supervisor.worker_stats = {10: {}, 11: {}, 12: {}}
+
+        self.reap((10, 0), (11, 256))
+        self.assertEqual(supervisor._retiring, {})
+        self.assertEqual(supervisor.worker_pids, set([12]))
+        self.assertEqual(supervisor.worker_stats.keys(), [12])
+
+        with mock.patch.object(supervisor, 'spawn_worker') as spawn_worker:
+            spawn_worker.side_effect = lambda: supervisor.worker_pids.add(13)
+            supervisor._replace_workers()
+        self.assertEqual(spawn_worker.call_count, 1)
+
+    def test_crashing_workers_back_off(self):
+        supervisor = self.supervisor
+        now = [1000.0]
+        with mock.patch('time.time', lambda: now[0]), \
+                mock.patch.object(supervisor, 'spawn_worker') as spawn_worker:
+            pids = itertools.count(100)
+            spawn_worker.side_effect = lambda: self.spawn(next(pids), now[0])
+            delays = []
+            for pid in (1, 2, 3):
+                self.spawn(pid, now[0] - 1)
+                self.reap((pid, 256))
+                delays.append(supervisor._restart_delay)
+            self.assertEqual(delays, [0.5, 1.0, 2.0])
+
+            supervisor._replace_workers()
+            self.assertFalse(spawn_worker.called)
+            now[0] += 2
+            supervisor._replace_workers()
+            self.assertTrue(spawn_worker.called)
+
+            ### A worker that ran for a while resets the delay
+            self.spawn(4, now[0] - 60)
+            self.reap((4, 256))
+            self.assertEqual(supervisor._restart_delay, 0)
+
+    def test_read_stats_keeps_partial_lines(self):
+        supervisor = self.supervisor
+        (read_fd, write_fd) = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        fcntl.fcntl(read_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        supervisor._stats_fd = read_fd
+        supervisor.worker_pids = set([1])
+
+        line = json.dumps({'pid': 1, 'stats': {'load': {'in_flight': 3}}})
+        unknown = json.dumps({'pid': 9, 'stats': {}})
+        os.write(write_fd, unknown + '\n' + line[:10])
+        supervisor._read_stats()
+        self.assertEqual(supervisor.worker_stats, {})
+
+        os.write(write_fd, line[10:] + '\n')
+        supervisor._read_stats()
+        self.assertEqual(supervisor.worker_stats,
+                         {1: {'load': {'in_flight': 3}}})
+
+    def test_combined_stats(self):
+        self.supervisor.worker_stats = {
+            1: {'load': {'in_flight': 3, 'recv_blocked': True, 'shed': 1},
+                'route_cache': {'hits': 10, 'misses': 2}},
+            2: {'load': {'in_flight': 1, 'recv_blocked': False, 'shed': 0}},
+        }
+        self.assertEqual(self.supervisor.combined_stats, {
+            'load': {'in_flight': 4, 'recv_blocked': 1, 'shed': 1},
+            'route_cache': {'hits': 10, 'misses': 2},
+            'workers': 2,
+        })
+
+
+##
+## This will run our tests
+##
+if __name__ == '__main__':
+    unittest.main()